@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+""" orchestration overhead benchmark for ceph_rsnapshot
+
+    runs cli.rsnap_pool end to end for synthetic pools of each size given,
+    against the stand-in ssh, rbd, qemu-img, date and rsnapshot in
+    benchmarks/bin (or the in process fake ceph backend), and reports wall
+    time, per image overhead and the subprocesses started. the stand-ins move
+    no data, so everything measured is ceph_rsnapshot's own bookkeeping plus
+    the cost of the subprocesses it starts
+
+    each pool size runs in its own child process so per run caches start
+    empty, and the cpu time of that child is split into ceph_rsnapshot's own
+    (self) and the stand-ins' (children)
+"""
+import argparse
+import collections
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from ceph_rsnapshot import settings
+
+
+DEFAULT_SIZES = '10,100,1000'
+POOL = 'rbd'
+# the stand-ins write nothing, but the fake backend does
+FAKE_IMAGE_SIZE = 64 * 1024
+
+# result key and format of each column of the table
+COLUMNS = [
+    ('images', '%s'),
+    ('wall_s', '%.2f'),
+    ('ms_per_image', '%.2f'),
+    ('self_cpu_ms_per_image', '%.2f'),
+    ('child_cpu_ms_per_image', '%.2f'),
+    ('subprocesses', '%s'),
+    ('subprocesses_per_image', '%.2f'),
+    ('ssh_handshakes', '%s'),
+    ('failed', '%s'),
+]
+
+
+def get_rusage_cpu(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_child(images, args):
+    """ set up settings and a temp tree for a pool of images, rsnap it and
+        return the measurements
+    """
+    from ceph_rsnapshot import logs, dirs, ceph, cli, connections, dates
+    base = tempfile.mkdtemp(prefix='ceph_rsnapshot_bench_')
+    calls_file = '%s/calls' % base
+    open(calls_file, 'w').close()
+    # only our settings, never a ceph_rsnapshot.yaml found on the way
+    settings.load_settings(config_file=os.devnull)
+    settings.CEPH_HOST = 'localhost'
+    settings.POOLS = POOL
+    settings.POOL = POOL
+    settings.BACKUP_BASE_PATH = '%s/backups' % base
+    settings.LOG_BASE_PATH = '%s/logs' % base
+    settings.QCOW_TEMP_PATH = '%s/qcows' % base
+    settings.TEMP_CONF_DIR = '%s/conf' % base
+    settings.SSH_CONTROL_DIR = '%s/ssh' % base
+    settings.FAKE_BACKEND_PATH = '%s/fake' % base
+    settings.FAKE_IMAGE_COUNT = images
+    settings.FAKE_IMAGE_SIZE = FAKE_IMAGE_SIZE
+    settings.MIN_FREESPACE = 0
+    settings.CEPH_BACKEND = args.backend
+    settings.EXPORT_MODE = args.export_mode
+    # stream scripts run /usr/bin/qemu-img to make qcow2, not the stand-in
+    settings.STREAM_FORMAT = 'raw'
+    settings.NUM_WORKERS = args.workers
+    settings.PIPELINE_EXPORTS = args.pipeline
+    settings.BATCH_DISCOVERY = not args.no_batch_discovery
+    settings.SNAP_DATE = dates.get_absolute_date(settings.SNAP_DATE)
+    os.environ['PATH'] = '%s/bin:%s' % (BENCHMARKS_DIR, os.environ['PATH'])
+    os.environ['CEPH_RSNAPSHOT_BENCH_CALLS'] = calls_file
+    os.environ['CEPH_RSNAPSHOT_BENCH_IMAGES'] = str(images)
+    os.environ['CEPH_RSNAPSHOT_BENCH_SNAP'] = ceph.get_snapdate()
+    logs.setup_logging(stdout=False)
+    try:
+        # counted from here, as cli.ceph_rsnapshot does this for every run
+        ts = time.time()
+        self_cpu = get_rusage_cpu(resource.RUSAGE_SELF)
+        child_cpu = get_rusage_cpu(resource.RUSAGE_CHILDREN)
+        dirs.setup_log_dirs_for_pool(POOL)
+        dirs.setup_temp_conf_dir_for_pool(POOL)
+        dirs.setup_backup_dirs_for_pool(POOL)
+        dirs.setup_qcow_temp_path(POOL)
+        result = cli.rsnap_pool(POOL)
+        ssh_stats = connections.get_stats()
+        connections.close_all()
+        wall = time.time() - ts
+        self_cpu = get_rusage_cpu(resource.RUSAGE_SELF) - self_cpu
+        child_cpu = get_rusage_cpu(resource.RUSAGE_CHILDREN) - child_cpu
+        with open(calls_file) as f:
+            calls = collections.Counter(line.strip() for line in f)
+    finally:
+        if not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+    return {
+        'images': images,
+        'successful': len(result['successful']),
+        'failed': len(result['failed']),
+        'wall_s': wall,
+        'ms_per_image': wall * 10**3 / images,
+        'self_cpu_ms_per_image': self_cpu * 10**3 / images,
+        'child_cpu_ms_per_image': child_cpu * 10**3 / images,
+        'subprocesses': sum(calls.values()),
+        'subprocesses_per_image': float(sum(calls.values())) / images,
+        'calls': dict(calls),
+        'ssh_handshakes': sum(stats['handshakes'] for stats in
+                              ssh_stats.values()),
+    }
+
+
+def get_child_command(images, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child',
+               str(images), '--backend', args.backend, '--export-mode',
+               args.export_mode, '--workers', str(args.workers)]
+    if args.pipeline:
+        command.append('--pipeline')
+    if args.no_batch_discovery:
+        command.append('--no-batch-discovery')
+    if args.keep:
+        command.append('--keep')
+    return command
+
+
+def print_table(results):
+    print(' '.join([name.rjust(8) for name, fmt in COLUMNS]))
+    for result in results:
+        print(' '.join([(fmt % result[name]).rjust(max(len(name), 8)) for
+                        name, fmt in COLUMNS]))
+    print('')
+    for result in results:
+        print('%s images: %s' % (result['images'], ', '.join(
+            ['%s %s' % (name, count) for name, count in
+             sorted(result['calls'].items())])))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='benchmark ceph_rsnapshot orchestration overhead against'
+        ' stand-in executables',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated pool sizes to run, up to'
+                        ' 50000 images')
+    parser.add_argument('--backend', default='ssh', choices=['ssh', 'fake'],
+                        help='ssh uses the stand-ins in benchmarks/bin, fake'
+                        ' the in process fake ceph backend')
+    parser.add_argument('--export-mode', default='qcow',
+                        choices=['qcow', 'stream'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--no-batch-discovery', action='store_true')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temp trees of each run')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as json, one line per size')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.export_mode == 'stream' and args.backend == 'ssh':
+        # stream scripts run /usr/bin/ssh, not the stand-in
+        sys.stderr.write('stream export mode needs --backend fake\n')
+        sys.exit(2)
+    if args.child:
+        print(json.dumps(run_child(args.child, args)))
+        return
+    results = []
+    for images in [int(size) for size in args.sizes.split(',')]:
+        output = subprocess.check_output(get_child_command(images, args))
+        result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        if args.json:
+            print(json.dumps(result))
+        results.append(result)
+    if not args.json:
+        print_table(results)
+    failed = sum([result['failed'] for result in results])
+    if failed:
+        # timings of failing images are of the error path, not a real run
+        sys.stderr.write('%s images failed, the timings are not valid\n' %
+                         failed)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
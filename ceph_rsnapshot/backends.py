@@ -0,0 +1,303 @@
+# ways of reaching ceph: the real ceph node over ssh, or a fake local one
+import json
+import os
+import threading
+import time
+
+import sh
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import connections
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import compression
+
+
+BACKENDS = ['ssh', 'fake']
+
+# bytes of random data at the start of each fake image, the rest is sparse
+FAKE_IMAGE_DATA_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+class SshBackend(object):
+    """ the ceph node, running rbd and qemu-img over the multiplexed ssh
+        connection. methods raise the sh errors from ssh as they always have
+    """
+    name = 'ssh'
+    supports_export_diff = True
+
+    def run(self, cephhost, command):
+        """ run a shell command on the ceph node
+        """
+        return connections.ssh(cephhost, command)
+
+    def list_images(self, pool, cephhost, cephuser, cephcluster):
+        """ list of image names in the pool
+        """
+        logger = logs.get_logger()
+        RBD_LS_COMMAND = ('rbd ls %s --id=%s --cluster=%s --format=json' %
+                          (pool, cephuser, cephcluster))
+        logger.info('sshing to %s and running %s to get list of images' %
+                    (cephhost, RBD_LS_COMMAND))
+        return json.loads(self.run(cephhost, RBD_LS_COMMAND).stdout)
+
+    def list_images_long(self, pool, cephhost, cephuser, cephcluster):
+        """ rbd ls -l entries for the pool, one per image and one per snap
+        """
+        logger = logs.get_logger()
+        RBD_LS_LONG_COMMAND = ('rbd ls -l %s --id=%s --cluster=%s'
+                               ' --format=json' % (pool, cephuser, cephcluster))
+        logger.info('sshing to %s and running %s to get inventory of images'
+                    ' and snaps' % (cephhost, RBD_LS_LONG_COMMAND))
+        return json.loads(self.run(cephhost, RBD_LS_LONG_COMMAND).stdout)
+
+    def snap_exists(self, image, snap, pool, cephhost, cephuser, cephcluster):
+        """ whether image@snap exists
+        """
+        logger = logs.get_logger()
+        RBD_CHECK_SNAP_COMMAND = ('rbd info %s/%s@%s --id=%s --cluster=%s' %
+                                  (pool, image, snap, cephuser, cephcluster))
+        logger.info('checking for snap with command %s' %
+                    RBD_CHECK_SNAP_COMMAND)
+        try:
+            self.run(cephhost, RBD_CHECK_SNAP_COMMAND)
+        except sh.ErrorReturnCode:
+            # this just means no snap found
+            return False
+        return True
+
+    def du(self, pool, cephhost, cephuser, cephcluster, image='', snap=''):
+        """ rbd du entries for image@snap, or for the whole pool if no image
+            is given
+        """
+        logger = logs.get_logger()
+        if image:
+            RBD_DU_COMMAND = ('rbd du %s/%s@%s --user=%s --cluster=%s'
+                              ' --format=json' % (pool, image, snap, cephuser,
+                                                  cephcluster))
+        else:
+            RBD_DU_COMMAND = ('rbd du -p %s --user=%s --cluster=%s'
+                              ' --format=json' % (pool, cephuser, cephcluster))
+        logger.info('getting rbd sizes from ceph host %s with command %s' %
+                    (cephhost, RBD_DU_COMMAND))
+        return json.loads(self.run(cephhost, RBD_DU_COMMAND).stdout)['images']
+
+    def freespace(self, path, cephhost):
+        """ free bytes on the filesystem of path on the ceph node
+        """
+        DF_COMMAND = ("LANG='' LC_CTYPE='' df -P %s | grep / | awk '{print $4}';"
+                      " ( exit ${PIPESTATUS[0]} )" % path)
+        return int(self.run(cephhost, DF_COMMAND).stdout) * 1024
+
+    def export_qcow(self, image, snap, pool, dest, cephhost, cephuser,
+                    cephcluster, qemu_img_args=''):
+        """ export image@snap to a qcow at dest on the ceph node, with any
+            extra qemu_img_args. returns the sh result, with the cpu time of
+            qemu-img in its stderr if compressing
+        """
+        logger = logs.get_logger()
+        qemu_source_string = ("rbd:%s/%s@%s:id=%s:conf=/etc/ceph/%s.conf" %
+                              (pool, image, snap, cephuser, cephcluster))
+        QEMU_IMG_COMMAND = ('qemu-img convert %s %s -f raw'
+                            ' -O qcow2' % (qemu_source_string, dest))
+        if qemu_img_args:
+            QEMU_IMG_COMMAND = compression.get_bash_command(
+                compression.get_timed_command('%s %s' % (QEMU_IMG_COMMAND,
+                                                         qemu_img_args)))
+        logger.info('running rbd export on ceph host %s with command %s' %
+                    (cephhost, QEMU_IMG_COMMAND))
+        return self.run(cephhost, QEMU_IMG_COMMAND)
+
+    def remove_export(self, export_file, temp_path, cephhost):
+        """ remove an exported file and its now empty per image directory
+        """
+        self.run(cephhost, 'rm -f %s && rmdir %s' % (export_file, temp_path))
+
+    def get_export_stream_command(self, image, snap, pool, cephuser,
+                                  cephcluster):
+        """ command for get_remote_shell that writes the raw contents of
+            image@snap to stdout
+        """
+        return ('rbd export --no-progress %s/%s@%s - --id=%s --cluster=%s' %
+                (pool, image, snap, cephuser, cephcluster))
+
+    def get_export_diff_stream_command(self, image, from_snap, snap, pool,
+                                       cephuser, cephcluster):
+        """ command for get_remote_shell that writes the rbd export-diff of
+            image@snap since from_snap to stdout
+        """
+        return ('rbd export-diff --no-progress --from-snap %s %s/%s@%s -'
+                ' --id=%s --cluster=%s' % (from_snap, pool, image, snap,
+                                           cephuser, cephcluster))
+
+    def get_remote_shell(self, cephhost):
+        """ command line, for scripts, that runs its single quoted argument
+            on the ceph node
+        """
+        return ' '.join(['/usr/bin/ssh'] +
+                        connections.get_ssh_options(cephhost) +
+                        ['root@%s' % cephhost])
+
+    def get_rsync_source(self, cephhost, path):
+        """ rsnapshot source for the contents of path on the ceph node
+        """
+        # note using the . to tell rsnap where to start the relative dir
+        return 'root@%s:%s/.' % (cephhost, path)
+
+
+class FakeBackend(object):
+    """ a synthetic ceph node on local disk, for benchmarking and load testing
+        without a cluster. every pool has FAKE_IMAGE_COUNT images one-0 to
+        one-N with a snap for the run's snap date, each FAKE_IMAGE_SIZE bytes
+        and kept under FAKE_BACKEND_PATH. every call to it takes an extra
+        FAKE_LATENCY_MS, and commands for the ceph node run locally
+    """
+    name = 'fake'
+    supports_export_diff = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        if settings.FAKE_LATENCY_MS:
+            time.sleep(settings.FAKE_LATENCY_MS / 1000.0)
+
+    def _get_snap(self):
+        # imported here as ceph imports this module
+        from ceph_rsnapshot import ceph
+        return ceph.get_snapdate()
+
+    def _get_image_names(self):
+        return ['one-%s' % number for number in
+                range(settings.FAKE_IMAGE_COUNT)]
+
+    def _get_image_file(self, image, pool):
+        """ path of the synthetic raw image, made the first time it's asked
+            for
+        """
+        image_file = '%s/%s/%s.raw' % (settings.FAKE_BACKEND_PATH, pool,
+                                       image)
+        with self._lock:
+            if (not os.path.isfile(image_file) or
+                    os.path.getsize(image_file) != settings.FAKE_IMAGE_SIZE):
+                if not os.path.isdir(os.path.dirname(image_file)):
+                    os.makedirs(os.path.dirname(image_file), 0o700)
+                data_size = min(FAKE_IMAGE_DATA_SIZE,
+                                settings.FAKE_IMAGE_SIZE)
+                with open(image_file, 'wb') as f:
+                    f.write(os.urandom(data_size))
+                    f.truncate(settings.FAKE_IMAGE_SIZE)
+        return image_file
+
+    def run(self, cephhost, command):
+        self._delay()
+        # no tty, like commands run over ssh
+        return sh.bash('-c', command, _tty_out=False)
+
+    def list_images(self, pool, cephhost, cephuser, cephcluster):
+        self._delay()
+        return self._get_image_names()
+
+    def list_images_long(self, pool, cephhost, cephuser, cephcluster):
+        self._delay()
+        snap = self._get_snap()
+        entries = []
+        for image in self._get_image_names():
+            entries.append({'image': image, 'size': settings.FAKE_IMAGE_SIZE,
+                            'format': 2})
+            entries.append({'image': image, 'snapshot': snap,
+                            'size': settings.FAKE_IMAGE_SIZE,
+                            'format': 2, 'protected': 'false'})
+        return entries
+
+    def snap_exists(self, image, snap, pool, cephhost, cephuser, cephcluster):
+        self._delay()
+        return image in self._get_image_names() and snap == self._get_snap()
+
+    def du(self, pool, cephhost, cephuser, cephcluster, image='', snap=''):
+        self._delay()
+        if image:
+            images = [image]
+        else:
+            images = self._get_image_names()
+        used_size = min(FAKE_IMAGE_DATA_SIZE, settings.FAKE_IMAGE_SIZE)
+        entries = []
+        for name in images:
+            entry = {'name': name,
+                     'provisioned_size': settings.FAKE_IMAGE_SIZE,
+                     'used_size': used_size}
+            if image:
+                entry['snapshot'] = snap
+            entries.append(entry)
+        return entries
+
+    def freespace(self, path, cephhost):
+        self._delay()
+        # path may not exist yet, so look at its nearest existing parent
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    def export_qcow(self, image, snap, pool, dest, cephhost, cephuser,
+                    cephcluster, qemu_img_args=''):
+        """ copies the synthetic raw image keeping it sparse, it's not
+            really a qcow, nor compressed
+        """
+        self._delay()
+        image_file = self._get_image_file(image, pool)
+        with open(image_file, 'rb') as source:
+            with open(dest, 'wb') as target:
+                while True:
+                    chunk = source.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if chunk.count(b'\0') == len(chunk):
+                        target.seek(len(chunk), os.SEEK_CUR)
+                    else:
+                        target.write(chunk)
+                target.truncate()
+
+    def remove_export(self, export_file, temp_path, cephhost):
+        self._delay()
+        if os.path.exists(export_file):
+            os.remove(export_file)
+        os.rmdir(temp_path)
+
+    def get_export_stream_command(self, image, snap, pool, cephuser,
+                                  cephcluster):
+        return ('/bin/dd if=%s bs=4M status=none' %
+                self._get_image_file(image, pool))
+
+    def get_export_diff_stream_command(self, image, from_snap, snap, pool,
+                                       cephuser, cephcluster):
+        # startup refuses incremental exports with this backend, as
+        # supports_export_diff is False
+        raise NameError('export-diff is not supported by the fake backend')
+
+    def get_remote_shell(self, cephhost):
+        return '/bin/bash -c'
+
+    def get_rsync_source(self, cephhost, path):
+        return '%s/.' % path
+
+
+def get_backend(name=''):
+    """ the backend instance for name, CEPH_BACKEND by default, shared for the
+        run
+    """
+    if not name:
+        name = settings.CEPH_BACKEND
+    with _backends_lock:
+        if name not in _backends:
+            if name == 'ssh':
+                _backends[name] = SshBackend()
+            elif name == 'fake':
+                _backends[name] = FakeBackend()
+            else:
+                raise NameError('unknown ceph backend %s, must be one of %s' %
+                                (name, ', '.join(BACKENDS)))
+        return _backends[name]
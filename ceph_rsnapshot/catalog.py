@@ -0,0 +1,274 @@
+# index of the generations and files on the backup node in a local sqlite
+# database, so what is backed up can be asked without walking the tree
+import hashlib
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS images ('
+    ' pool TEXT NOT NULL,'
+    ' image TEXT NOT NULL,'
+    ' generations INTEGER NOT NULL,'
+    ' updated REAL NOT NULL,'
+    ' PRIMARY KEY (pool, image))',
+    'CREATE TABLE IF NOT EXISTS files ('
+    ' pool TEXT NOT NULL,'
+    ' image TEXT NOT NULL,'
+    ' generation INTEGER NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' snap TEXT,'
+    ' format TEXT,'
+    ' size INTEGER NOT NULL,'
+    ' virtual_size INTEGER,'
+    ' allocated_size INTEGER NOT NULL,'
+    ' inode INTEGER NOT NULL,'
+    ' mtime REAL NOT NULL,'
+    ' checksum TEXT,'
+    ' backed_up REAL NOT NULL,'
+    ' PRIMARY KEY (pool, image, generation, name))',
+]
+
+FILE_COLUMNS = ['pool', 'image', 'generation', 'name', 'snap', 'format',
+                'size', 'virtual_size', 'allocated_size', 'inode', 'mtime',
+                'checksum', 'backed_up']
+
+CHECKSUMS = ['md5', 'sha1', 'sha256', 'sha512']
+
+# stripped in this order from image@snap file names to get the snap
+SNAP_FILE_SUFFIXES = ['.blocks', '.manifest', '.qcow2', '.raw', '.chain',
+                      '.compression']
+
+QCOW2_MAGIC = b'QFI\xfb'
+CHECKSUM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# one writer at a time, as image workers update the catalog concurrently
+_lock = threading.Lock()
+
+
+def get_catalog_db():
+    """ CATALOG_DB, or ceph_rsnapshot_catalog.sqlite in LOG_BASE_PATH
+    """
+    if settings.CATALOG_DB:
+        return settings.CATALOG_DB
+    return '%s/ceph_rsnapshot_catalog.sqlite' % settings.LOG_BASE_PATH
+
+
+def connect(catalog_db=''):
+    """ open the catalog, making its tables if they are not there
+    """
+    if not catalog_db:
+        catalog_db = get_catalog_db()
+    conn = sqlite3.connect(catalog_db)
+    conn.row_factory = sqlite3.Row
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+    return conn
+
+
+def get_format(path):
+    """ (format, virtual size) of an exported image file, from the qcow2
+        header if it has one, else raw
+    """
+    with open(path, 'rb') as f:
+        header = f.read(32)
+    if len(header) == 32 and header[:4] == QCOW2_MAGIC:
+        return 'qcow2', struct.unpack('>Q', header[24:32])[0]
+    return 'raw', os.path.getsize(path)
+
+
+def get_checksum(path, algorithm=''):
+    if not algorithm:
+        algorithm = settings.CATALOG_CHECKSUM
+    checksum = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHECKSUM_CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return '%s:%s' % (algorithm, checksum.hexdigest())
+
+
+def scan_image(image, pool='', known=None, checksums=True):
+    """ file rows for every generation of an image's backup dir, and how
+        many generations it has. files hardlinked from a known row keep its
+        checksum, so only new files are read
+    """
+    if not pool:
+        pool = settings.POOL
+    if known is None:
+        known = {}
+    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+    generation_re = re.compile(r'^%s\.([0-9]+)$' %
+                               re.escape(settings.RETAIN_INTERVAL))
+    rows = []
+    generations = 0
+    for generation_name in os.listdir(destination):
+        match = generation_re.match(generation_name)
+        generation_dir = os.path.join(destination, generation_name)
+        if not match or not os.path.isdir(generation_dir):
+            continue
+        generation = int(match.group(1))
+        generations += 1
+        backed_up = os.path.getmtime(generation_dir)
+        for name in os.listdir(generation_dir):
+            path = os.path.join(generation_dir, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            file_stat = os.stat(path)
+            snap = None
+            if '@' in name:
+                snap = name.split('@', 1)[1]
+                for suffix in SNAP_FILE_SUFFIXES:
+                    if snap.endswith(suffix):
+                        snap = snap[:-len(suffix)]
+            image_format = None
+            virtual_size = None
+            if name.endswith('.qcow2') or name.endswith('.raw'):
+                image_format, virtual_size = get_format(path)
+            checksum = known.get((file_stat.st_ino, file_stat.st_size,
+                                  file_stat.st_mtime))
+            if checksum is None and checksums and settings.CATALOG_CHECKSUM:
+                checksum = get_checksum(path)
+            rows.append({
+                'pool': pool, 'image': image, 'generation': generation,
+                'name': name, 'snap': snap, 'format': image_format,
+                'size': file_stat.st_size, 'virtual_size': virtual_size,
+                'allocated_size': file_stat.st_blocks * 512,
+                'inode': file_stat.st_ino, 'mtime': file_stat.st_mtime,
+                'checksum': checksum, 'backed_up': backed_up,
+            })
+    return rows, generations
+
+
+def update_image(image, pool='', checksums=True, conn=None):
+    """ bring the catalog rows of an image up to date with its backup dir,
+        dropping them if the dir is gone
+    """
+    if not pool:
+        pool = settings.POOL
+    if settings.NOOP:
+        return
+    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+    close = conn is None
+    if conn is None:
+        with _lock:
+            conn = connect()
+    try:
+        known = dict(((row['inode'], row['size'], row['mtime']),
+                      row['checksum']) for row in conn.execute(
+            'SELECT inode, size, mtime, checksum FROM files WHERE pool = ?'
+            ' AND image = ? AND checksum IS NOT NULL', (pool, image)))
+        rows = []
+        generations = 0
+        exists = os.path.isdir(destination)
+        if exists:
+            # outside the lock, as checksumming new files reads them whole
+            rows, generations = scan_image(image, pool=pool, known=known,
+                                           checksums=checksums)
+        with _lock:
+            with conn:
+                conn.execute('DELETE FROM files WHERE pool = ? AND image = ?',
+                             (pool, image))
+                conn.execute('DELETE FROM images WHERE pool = ? AND'
+                             ' image = ?', (pool, image))
+                if exists:
+                    conn.execute('INSERT INTO images (pool, image,'
+                                 ' generations, updated) VALUES (?, ?, ?, ?)',
+                                 (pool, image, generations, time.time()))
+                conn.executemany(
+                    'INSERT INTO files (%s) VALUES (%s)' % (
+                        ', '.join(FILE_COLUMNS),
+                        ', '.join(['?'] * len(FILE_COLUMNS))),
+                    [[row[column] for column in FILE_COLUMNS] for row in rows])
+    finally:
+        if close:
+            conn.close()
+
+
+def rebuild(pools, checksums=True, catalog_db=''):
+    """ re-index every image dir of pools from disk, for a lost or stale
+        catalog. returns the number of images indexed
+    """
+    logger = logs.get_logger()
+    conn = connect(catalog_db)
+    count = 0
+    try:
+        for pool in pools:
+            backup_path = '%s/%s' % (settings.BACKUP_BASE_PATH, pool)
+            on_disk = []
+            if os.path.isdir(backup_path):
+                on_disk = [name for name in os.listdir(backup_path) if
+                           os.path.isdir(os.path.join(backup_path, name))]
+            in_catalog = [row['image'] for row in conn.execute(
+                'SELECT image FROM images WHERE pool = ?', (pool,))]
+            for image in set(on_disk + in_catalog):
+                logger.info('indexing %s/%s' % (pool, image))
+                update_image(image, pool=pool, checksums=checksums, conn=conn)
+                count += 1
+    finally:
+        conn.close()
+    return count
+
+
+def get_images(conn, pool=None):
+    """ per image generations, newest snap and sizes of the files in all its
+        generations, counting hardlinked files once
+    """
+    query = ('SELECT images.pool, images.image, images.generations,'
+             ' MAX(files.snap) AS newest_snap,'
+             ' MIN(files.generation) AS newest_generation,'
+             ' COUNT(files.name) AS files,'
+             ' MAX(files.backed_up) AS backed_up FROM images LEFT JOIN files'
+             ' ON images.pool = files.pool AND images.image = files.image')
+    params = []
+    if pool:
+        query += ' WHERE images.pool = ?'
+        params.append(pool)
+    query += ' GROUP BY images.pool, images.image ORDER BY images.pool,' \
+             ' images.image'
+    images = [dict(row) for row in conn.execute(query, params)]
+    allocated = {}
+    for row in conn.execute('SELECT DISTINCT pool, image, inode,'
+                            ' allocated_size FROM files'):
+        key = (row['pool'], row['image'])
+        allocated[key] = allocated.get(key, 0) + row['allocated_size']
+    for image in images:
+        image['allocated_size'] = allocated.get((image['pool'],
+                                                 image['image']), 0)
+    return images
+
+
+def get_generations(conn, image, pool=''):
+    """ file rows of every generation of an image, newest first
+    """
+    if not pool:
+        pool = settings.POOL
+    return [dict(row) for row in conn.execute(
+        'SELECT * FROM files WHERE pool = ? AND image = ? ORDER BY'
+        ' generation, name', (pool, image))]
+
+
+def get_latest(conn, image, pool=''):
+    """ file rows of the newest generation of an image that has an exported
+        image file in it, or [] if none has
+    """
+    if not pool:
+        pool = settings.POOL
+    row = conn.execute('SELECT MIN(generation) AS generation FROM files'
+                       ' WHERE pool = ? AND image = ? AND format IS NOT NULL',
+                       (pool, image)).fetchone()
+    if row is None or row['generation'] is None:
+        return []
+    return [dict(row) for row in conn.execute(
+        'SELECT * FROM files WHERE pool = ? AND image = ? AND generation = ?'
+        ' ORDER BY name', (pool, image, row['generation']))]
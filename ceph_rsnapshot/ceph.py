@@ -1,16 +1,39 @@
 # functions to work on ceph
 import sh
-import json
 import time
 import re
+import threading
 
 from ceph_rsnapshot import logs
+from ceph_rsnapshot import backends
+from ceph_rsnapshot import compression
+from ceph_rsnapshot import throttle
+from ceph_rsnapshot import dates
 from ceph_rsnapshot import dirs
+from ceph_rsnapshot import freespace
 from ceph_rsnapshot import settings
 from ceph_rsnapshot import helpers
 from ceph_rsnapshot import exceptions
 
 
+# ways to get an image from the ceph node into a backup generation:
+# qcow exports a temp qcow on the ceph node for rsnapshot to pull, stream
+# pipes rbd export over ssh into the generation from an rsnapshot
+# backup_script
+EXPORT_MODES = ['qcow', 'stream']
+STREAM_FORMATS = ['qcow2', 'raw']
+
+# per run cache of pool inventories from get_pool_inventory, keyed by
+# (cephhost, cephcluster, pool)
+_pool_inventories = {}
+
+# per run cache of rbd du sizes keyed by
+# (cephhost, cephcluster, pool, image, snap), snap is '' for the image head,
+# and the pools get_pool_sizes has loaded into it
+_rbd_sizes_lock = threading.Lock()
+_rbd_sizes = {}
+_pool_sizes_loaded = {}
+
 def check_snap_status_file(cephhost='', snap_status_file_path=''):
     logger = logs.get_logger()
     if not cephhost:
@@ -21,7 +44,8 @@ def check_snap_status_file(cephhost='', snap_status_file_path=''):
     logger.info('checking snap status directory %s on ceph host'
              % snap_status_file_path)
     try:
-        snap_status_dir_result = sh.ssh(cephhost, CHECK_SNAP_STATUS_DIR_COMMAND).strip('\n')
+        snap_status_dir_result = backends.get_backend().run(cephhost,
+            CHECK_SNAP_STATUS_DIR_COMMAND).strip('\n')
     except sh.ErrorReturnCode as e:
         if e.exit_code == 2:
             raise exceptions.NoSnapStatusFilesFoundError(cephhost=cephhost,
@@ -87,12 +111,88 @@ def remove_snap_status_file(snap_date, cephhost='', snap_status_file_path='',
         logger.info('would have run %s' % REMOVE_SNAP_STATUS_FILE_COMMAND)
         remove_snap_status_file_result = 'noop'
     else:
-        remove_snap_status_file_result = sh.ssh(cephhost, REMOVE_SNAP_STATUS_FILE_COMMAND).strip('\n')
+        remove_snap_status_file_result = backends.get_backend().run(
+            cephhost, REMOVE_SNAP_STATUS_FILE_COMMAND).strip('\n')
     # TODO handle some errors gracefully here
     logger.info("done removing snap status file: %s" % remove_snap_status_file_result)
     return True
 
 
+def get_pool_inventory(pool='', cephhost='', cephuser='', cephcluster='',
+                       refresh=False):
+    """ ssh to ceph node and list every image in the pool along with its
+        snaps, sizes and parent in one rbd ls -l call. cached for the run.
+        returns a list of image records in rbd ls order of the form
+        {'image': name, 'size': bytes, 'format': 2, 'parent': {...} or None,
+         'snaps': {snapname: {'size': bytes, 'protected': 'true'}}}
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not cephuser:
+        cephuser = settings.CEPH_USER
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    inventory_key = (cephhost, cephcluster, pool)
+    if inventory_key in _pool_inventories and not refresh:
+        return _pool_inventories[inventory_key]['records']
+    try:
+        rbd_ls_entries = backends.get_backend().list_images_long(
+            pool, cephhost, cephuser, cephcluster)
+    except sh.ErrorReturnCode as e:
+        logger.info('error getting inventory of images from ceph node')
+        logger.exception(e.stderr)
+        raise
+    except Exception as e:
+        logger.info('error getting inventory of images from ceph node')
+        logger.exception(e)
+        raise
+    records = []
+    records_by_image = {}
+    # one entry per image plus one entry per snap, snaps have a snapshot key
+    for entry in rbd_ls_entries:
+        image = entry['image']
+        if image not in records_by_image:
+            record = {'image': image, 'size': None, 'format': None,
+                      'parent': None, 'snaps': {}}
+            records.append(record)
+            records_by_image[image] = record
+        record = records_by_image[image]
+        if 'snapshot' in entry:
+            record['snaps'][entry['snapshot']] = {
+                'size': entry.get('size'),
+                'protected': entry.get('protected'),
+            }
+        else:
+            record['size'] = entry.get('size')
+            record['format'] = entry.get('format')
+            record['parent'] = entry.get('parent')
+    logger.info('found %s images with %s snaps in pool %s' % (len(records),
+        sum([len(record['snaps']) for record in records]), pool))
+    _pool_inventories[inventory_key] = {'records': records,
+                                        'by_image': records_by_image}
+    return records
+
+
+def get_image_record(image, pool='', cephhost='', cephcluster=''):
+    """ look up an image in the cached pool inventory, without touching the
+        ceph node. returns None if the pool has no inventory this run or the
+        image is not in it
+    """
+    if not pool:
+        pool = settings.POOL
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    inventory = _pool_inventories.get((cephhost, cephcluster, pool))
+    if not inventory:
+        return None
+    return inventory['by_image'].get(image)
+
+
 def check_snap(image, snap='', pool='', cephhost='', cephuser='', cephcluster='',
                snap_naming_date_format='', snap_date=''):
     """ ssh to ceph host and check for a snapshot
@@ -113,22 +213,25 @@ def check_snap(image, snap='', pool='', cephhost='', cephuser='', cephcluster=''
         cephuser = settings.CEPH_USER
     if not cephcluster:
         cephcluster = settings.CEPH_CLUSTER
-    RBD_CHECK_SNAP_COMMAND = ('rbd info %s/%s@%s --id=%s --cluster=%s' %
-                              (pool, image, snap, cephuser, cephcluster))
-    logger.info('checking for snap with command %s' % RBD_CHECK_SNAP_COMMAND)
-    try:
-        rbd_check_result = sh.ssh(cephhost, RBD_CHECK_SNAP_COMMAND)
-    except sh.ErrorReturnCode as e:
-        # this just means no snap found, log but don't raise
+    # answer from the pool inventory if we have one for this run
+    record = get_image_record(image, pool=pool, cephhost=cephhost,
+                              cephcluster=cephcluster)
+    if record is not None:
+        if snap in record['snaps']:
+            return True
         logger.warning('no snap found for image %s' % image)
-        # return false we didn't find one
         return False
+    try:
+        snap_found = backends.get_backend().snap_exists(
+            image, snap, pool, cephhost, cephuser, cephcluster)
     except Exception as e:
         logger.info('error getting list of images from ceph node')
         logger.exception(e)
         raise
-    # if here then rbd snap found, so return True
-    return True
+    if not snap_found:
+        # this just means no snap found, log but don't raise
+        logger.warning('no snap found for image %s' % image)
+    return snap_found
 
 
 def gathernames(pool='', cephhost='', cephuser='', cephcluster='',
@@ -151,21 +254,25 @@ def gathernames(pool='', cephhost='', cephuser='', cephcluster='',
         snap_date = settings.SNAP_DATE
     if not image_re:
         image_re = settings.IMAGE_RE
-    RBD_LS_COMMAND = ('rbd ls %s --id=%s --cluster=%s --format=json' %
-                      (pool, cephuser, cephcluster))
-    logger.info('sshing to %s and running %s to get list of images' %
-        (cephhost,RBD_LS_COMMAND))
-    try:
-        rbd_ls_result = sh.ssh(cephhost, RBD_LS_COMMAND)
-    except sh.ErrorReturnCode as e:
-        logger.info('error getting list of images from ceph node')
-        logger.exception(e.stderr)
-        raise
-    except Exception as e:
-        logger.info('error getting list of images from ceph node')
-        logger.exception(e)
-        raise
-    rbd_images_unfiltered = json.loads(rbd_ls_result.stdout)
+    if settings.BATCH_DISCOVERY:
+        # one round trip for all images and snaps, check_snap and
+        # get_rbd_size then answer from this inventory
+        inventory = get_pool_inventory(pool=pool, cephhost=cephhost,
+                                       cephuser=cephuser,
+                                       cephcluster=cephcluster)
+        rbd_images_unfiltered = [record['image'] for record in inventory]
+    else:
+        try:
+            rbd_images_unfiltered = backends.get_backend().list_images(
+                pool, cephhost, cephuser, cephcluster)
+        except sh.ErrorReturnCode as e:
+            logger.info('error getting list of images from ceph node')
+            logger.exception(e.stderr)
+            raise
+        except Exception as e:
+            logger.info('error getting list of images from ceph node')
+            logger.exception(e)
+            raise
     logger.info('all images: %s' % ' '.join(rbd_images_unfiltered))
     # filter by image_re
     rbd_images_filtered = [image for image in rbd_images_unfiltered if
@@ -190,8 +297,11 @@ def gathernames(pool='', cephhost='', cephuser='', cephcluster='',
     # now check for snaps
     images_with_snaps = []
     images_without_snaps = []
+    snap = get_snapdate(snap_naming_date_format=snap_naming_date_format,
+                        snap_date=snap_date)
     for image in rbd_images_filtered:
-        if check_snap(image):
+        if check_snap(image, snap=snap, pool=pool, cephhost=cephhost,
+                      cephuser=cephuser, cephcluster=cephcluster):
             images_with_snaps.append(image)
         else:
             images_without_snaps.append(image)
@@ -205,19 +315,17 @@ def gathernames(pool='', cephhost='', cephuser='', cephcluster='',
     return images_with_snaps
 
 
-def get_freespace(path=''):
+def get_freespace(path='', cephhost=''):
     """ssh to ceph node and get freespace for a path
        if not specified, use settings.QCOW_TEMP_PATH/settings.POOL
     """
     logger = logs.get_logger()
     if not path:
         path = "%s/%s" % (settings.QCOW_TEMP_PATH, settings.POOL)
-    DF_COMMAND = ("LANG='' LC_CTYPE='' df -P %s | grep / | awk '{print $4}';"
-                  " ( exit ${PIPESTATUS[0]} )" % path)
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
     try:
-        free_space_kb = sh.ssh(settings.CEPH_HOST, DF_COMMAND)
-        free_space_bytes = int(free_space_kb.stdout) * 1024
-        return free_space_bytes
+        return backends.get_backend().freespace(path, cephhost)
     except sh.ErrorReturnCode as e:
         logger.error('error getting free space on ceph node for %s' % path)
         logger.exception(e.stderr)
@@ -232,6 +340,7 @@ def get_freespace(path=''):
 
 def get_snapdate(snap_naming_date_format='', snap_date=''):
     """get todays date in iso format, this can run on either node
+       resolved in process and memoized for the run, see dates.format_date
     """
     logger=logs.get_logger()
     if not snap_naming_date_format:
@@ -239,8 +348,8 @@ def get_snapdate(snap_naming_date_format='', snap_date=''):
     if not snap_date:
         snap_date = settings.SNAP_DATE
     try:
-        converted_snap_date = sh.date('+%s' % snap_naming_date_format,
-                   date=snap_date).strip('\n')
+        converted_snap_date = dates.format_date(snap_naming_date_format,
+                                                snap_date)
     except sh.ErrorReturnCode as e:
         if e.exit_code == 1:
             raise(exceptions.SnapDateNotValidDateError(snap_date=snap_date,
@@ -250,9 +359,57 @@ def get_snapdate(snap_naming_date_format='', snap_date=''):
     return converted_snap_date
 
 
-def get_rbd_size(image, snap='', pool='', cephhost='', cephuser='',
+def get_pool_sizes(pool='', cephhost='', cephuser='', cephcluster='',
+                   refresh=False):
+    """ ssh to ceph node and get the provisioned and used sizes of every
+        image and snap in the pool with one rbd du call, into the per run
+        size cache that get_rbd_sizes reads. returns the number of entries
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not cephuser:
+        cephuser = settings.CEPH_USER
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    pool_key = (cephhost, cephcluster, pool)
+    with _rbd_sizes_lock:
+        if pool_key in _pool_sizes_loaded and not refresh:
+            return _pool_sizes_loaded[pool_key]
+        logger.info('getting rbd sizes of all images in pool %s from ceph host'
+                    ' %s' % (pool, cephhost))
+        try:
+            entries = backends.get_backend().du(pool, cephhost, cephuser,
+                                                cephcluster)
+        except sh.ErrorReturnCode as e:
+            logger.error('error getting rbd sizes for pool %s, output from'
+                         ' ssh:' % pool)
+            logger.exception(e.stderr)
+            raise
+        except Exception as e:
+            logger.error('error getting rbd sizes for pool %s' % pool)
+            logger.exception(e)
+            raise
+        for entry in entries:
+            # head of the image has no snapshot key
+            _rbd_sizes[pool_key + (entry['name'], entry.get('snapshot', ''))] = {
+                'provisioned_size': entry['provisioned_size'],
+                'used_size': entry['used_size'],
+            }
+        _pool_sizes_loaded[pool_key] = len(entries)
+    logger.info('got sizes of %s images and snaps in pool %s' %
+                (len(entries), pool))
+    return len(entries)
+
+
+def get_rbd_sizes(image, snap='', pool='', cephhost='', cephuser='',
         cephcluster='', snap_naming_date_format='', snap_date=''):
-    """ssh to ceph node check the size of this image@snap
+    """ provisioned and used size of this image@snap, as a dict with
+        provisioned_size and used_size. with POOL_SIZE_INVENTORY these come
+        from one rbd du of the whole pool, otherwise ssh to ceph node and
+        rbd du just this image@snap. cached for the run either way
     """
     logger = logs.get_logger()
     if not snap_naming_date_format:
@@ -270,20 +427,19 @@ def get_rbd_size(image, snap='', pool='', cephhost='', cephuser='',
         cephuser = settings.CEPH_USER
     if not cephcluster:
         cephcluster = settings.CEPH_CLUSTER
+    size_key = (cephhost, cephcluster, pool, image, snap)
+    if settings.POOL_SIZE_INVENTORY:
+        get_pool_sizes(pool=pool, cephhost=cephhost, cephuser=cephuser,
+                       cephcluster=cephcluster)
+    with _rbd_sizes_lock:
+        if size_key in _rbd_sizes:
+            return _rbd_sizes[size_key]
     rbd_image_string = "%s/%s@%s" % (pool, image, snap)
-    RBD_COMMAND = ('rbd du %s --user=%s --cluster=%s --format=json' %
-                   (rbd_image_string, cephuser, cephcluster))
-    logger.info('getting rbd size from ceph host %s with command %s' %
-                (cephhost, RBD_COMMAND))
     try:
-        rbd_du_result = sh.ssh(cephhost, RBD_COMMAND)
-        rbd_image_used_size = (json.loads(rbd_du_result.stdout)['images'][0]
-                               ['used_size'])
-        rbd_image_provisioned_size = (json.loads(rbd_du_result.stdout)['images']
-                                      [0]['provisioned_size'])
-        # using provisioned_size as these are snaps and space could be on the
-        # parent
-        return rbd_image_provisioned_size
+        rbd_du_image = backends.get_backend().du(
+            pool, cephhost, cephuser, cephcluster, image=image, snap=snap)[0]
+        sizes = {'provisioned_size': rbd_du_image['provisioned_size'],
+                 'used_size': rbd_du_image['used_size']}
     except sh.ErrorReturnCode as e:
         logger.error('error getting rbd size for %s, output from ssh:' %
                      rbd_image_string)
@@ -293,12 +449,46 @@ def get_rbd_size(image, snap='', pool='', cephhost='', cephuser='',
         logger.error('error getting rbd size for %s' % rbd_image_string)
         logger.exception(e)
         raise
+    with _rbd_sizes_lock:
+        _rbd_sizes[size_key] = sizes
+    return sizes
+
+
+def get_rbd_size(image, snap='', pool='', cephhost='', cephuser='',
+        cephcluster='', snap_naming_date_format='', snap_date=''):
+    """ provisioned size of this image@snap, from the pool inventory if we
+        have one or else get_rbd_sizes
+    """
+    if not snap_naming_date_format:
+        snap_naming_date_format = settings.SNAP_NAMING_DATE_FORMAT
+    if not snap_date:
+        snap_date = settings.SNAP_DATE
+    if not snap:
+        snap = get_snapdate(snap_naming_date_format=snap_naming_date_format,
+                            snap_date=snap_date)
+    if not pool:
+        pool = settings.POOL
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    # provisioned size of the snap is in the pool inventory if we have one
+    record = get_image_record(image, pool=pool, cephhost=cephhost,
+                              cephcluster=cephcluster)
+    if record is not None and record['snaps'].get(snap, {}).get('size'):
+        return record['snaps'][snap]['size']
+    # using provisioned_size as these are snaps and space could be on the
+    # parent
+    return get_rbd_sizes(image, snap=snap, pool=pool, cephhost=cephhost,
+                         cephuser=cephuser,
+                         cephcluster=cephcluster)['provisioned_size']
 
 
 def export_qcow(image, snap='', pool='', cephhost='', cephuser='', cephcluster='',
                 noop=None, snap_naming_date_format='', snap_date=''):
-    """ssh to ceph node, check free space vs rbd provisioned size, 
-        and export a qcow to qcow_temp_path/pool/imagename.qcow2
+    """ssh to ceph node, reserve free space for the rbd provisioned size,
+        and export a qcow to qcow_temp_path/pool/imagename/imagename@snap.qcow2
+        the reservation is released by remove_qcow
     """
     logger = logs.get_logger()
     if not snap_naming_date_format:
@@ -323,51 +513,107 @@ def export_qcow(image, snap='', pool='', cephhost='', cephuser='', cephcluster='
                 cephuser))
 
     # if any of these errors, fail this export and raise the errors up
-    avail_bytes = get_freespace(settings.QCOW_TEMP_PATH)
-    rbd_image_used_size = get_rbd_size(image)
+    rbd_image_used_size = get_rbd_size(image, snap=snap, pool=pool,
+                                       cephhost=cephhost, cephuser=cephuser,
+                                       cephcluster=cephcluster)
 
     logger.info("image size %s" % rbd_image_used_size)
-    if rbd_image_used_size > (avail_bytes - settings.MIN_FREESPACE):
-        logger.error("not enough free space to export this qcow")
-        raise NameError('not enough space to export this qcow')
-
-    # build source and dest strings
-    qemu_source_string = ("rbd:%s/%s@%s:id=%s:conf=/etc/ceph/%s.conf" %
-                          (pool, image, snap, cephuser, cephcluster))
-    qemu_dest_string = "%s/%s/%s@%s.qcow2" % (
-        settings.QCOW_TEMP_PATH, pool, image, snap)
+    # raises NameError if there isn't space even with nothing else in flight
+    freespace.reserve('%s/%s' % (pool, image), rbd_image_used_size,
+                      cephhost=cephhost)
+
+    qemu_dest_string = "%s/%s@%s.qcow2" % (
+        dirs.get_qcow_temp_path(pool=pool, image=image), image, snap)
     # do the export
-    QEMU_IMG_COMMAND = ('qemu-img convert %s %s -f raw'
-                        ' -O qcow2' % (qemu_source_string, qemu_dest_string))
-    logger.info('running rbd export on ceph host %s with command %s' %
-                (cephhost, QEMU_IMG_COMMAND))
     try:
         ts = time.time()
         if noop:
             logger.info('NOOP: would have exported qcow')
         else:
-            export_result = sh.ssh(cephhost, QEMU_IMG_COMMAND)
+            compression_args = compression.get_qemu_img_args(pool)
+            qemu_img_args = compression_args
+            export_kbps = throttle.get_rate('export', pool)
+            if export_kbps:
+                # qemu-img's own rate limit, in bytes per second
+                qemu_img_args = ('%s -r %s' % (qemu_img_args,
+                                               export_kbps * 1024)).strip()
+                logger.info('limiting export of %s to %s KB/s' %
+                            (image, export_kbps))
+            result = backends.get_backend().export_qcow(
+                image, snap, pool, qemu_dest_string, cephhost, cephuser,
+                cephcluster, qemu_img_args=qemu_img_args)
+            if compression_args and result is not None:
+                cpu_seconds = compression.parse_stats(
+                    result.stderr.decode('utf-8', 'replace'))[0]
+                compression.record(image, pool=pool, cpu_seconds=cpu_seconds)
         tf = time.time()
         elapsed_time = tf - ts
         elapsed_time_ms = elapsed_time * 10**3
     except sh.ErrorReturnCode as e:
-        logger.error('error exporting qcow with command %s on ceph host %s,'
-                     ' output from ssh:' % (cephhost, QEMU_IMG_COMMAND))
+        logger.error('error exporting qcow %s on ceph host %s, output from'
+                     ' ssh:' % (qemu_dest_string, cephhost))
         logger.exception(e.stderr)
         raise
     except Exception as e:
-        logger.error('error exporting qcow with command %s on ceph host %s,'
-                     ' output from ssh:' % (cephhost, QEMU_IMG_COMMAND))
+        logger.error('error exporting qcow %s on ceph host %s' %
+                     (qemu_dest_string, cephhost))
         logger.exception(e)
         raise
     logger.info('qcow exported in %s ms' % elapsed_time_ms)
     return elapsed_time_ms
 
 
+def get_export_stream_command(image, snap='', pool='', cephuser='',
+                              cephcluster='', snap_naming_date_format='',
+                              snap_date=''):
+    """ command to run on the ceph node to write the raw contents of
+        image@snap to stdout, for the stream export mode
+    """
+    if not snap_naming_date_format:
+        snap_naming_date_format = settings.SNAP_NAMING_DATE_FORMAT
+    if not snap_date:
+        snap_date = settings.SNAP_DATE
+    if not snap:
+        snap = get_snapdate(snap_naming_date_format=snap_naming_date_format,
+                            snap_date=snap_date)
+    if not pool:
+        pool = settings.POOL
+    if not cephuser:
+        cephuser = settings.CEPH_USER
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    return backends.get_backend().get_export_stream_command(
+        image, snap, pool, cephuser, cephcluster)
+
+
+def get_export_diff_stream_command(image, from_snap, snap='', pool='',
+                                   cephuser='', cephcluster='',
+                                   snap_naming_date_format='', snap_date=''):
+    """ command to run on the ceph node to write the rbd export-diff of
+        image@snap since from_snap to stdout, for incremental stream exports
+    """
+    if not snap_naming_date_format:
+        snap_naming_date_format = settings.SNAP_NAMING_DATE_FORMAT
+    if not snap_date:
+        snap_date = settings.SNAP_DATE
+    if not snap:
+        snap = get_snapdate(snap_naming_date_format=snap_naming_date_format,
+                            snap_date=snap_date)
+    if not pool:
+        pool = settings.POOL
+    if not cephuser:
+        cephuser = settings.CEPH_USER
+    if not cephcluster:
+        cephcluster = settings.CEPH_CLUSTER
+    return backends.get_backend().get_export_diff_stream_command(
+        image, from_snap, snap, pool, cephuser, cephcluster)
+
+
 def remove_qcow(image, pool='', cephhost='', cephuser='', cephcluster='',
                 snap_naming_date_format='', snap_date='', snap='', noop=None):
     """ ssh to ceph node and remove a qcow from path
-        qcow_temp_path/pool/imagename.qcow2
+        qcow_temp_path/pool/imagename/imagename@snap.qcow2 and its per image
+        subdirectory
     """
     logger = logs.get_logger()
     if not snap_naming_date_format:
@@ -388,18 +634,18 @@ def remove_qcow(image, pool='', cephhost='', cephuser='', cephcluster='',
         cephcluster = settings.CEPH_CLUSTER
     if not noop:
         noop = settings.NOOP
-    temp_qcow_file = ("%s/%s/%s@%s.qcow2" % (settings.QCOW_TEMP_PATH,
-                                          settings.POOL, image, snap))
+    temp_path = dirs.get_qcow_temp_path(pool=pool, image=image)
+    temp_qcow_file = "%s/%s@%s.qcow2" % (temp_path, image, snap)
     logger.info("deleting temp qcow from path %s on ceph host %s" %
                 (temp_qcow_file, cephhost))
-    SSH_RM_QCOW_COMMAND = 'rm %s' % temp_qcow_file
     try:
         if settings.NOOP:
-            logger.info('NOOP: would have removed temp qcow for image %s from'
-                        ' ceph host %s with command %s' % (image, cephhost,
-                                                           SSH_RM_QCOW_COMMAND))
+            logger.info('NOOP: would have removed temp qcow %s for image %s'
+                        ' from ceph host %s' % (temp_qcow_file, image,
+                                                cephhost))
         else:
-            sh.ssh(cephhost, SSH_RM_QCOW_COMMAND)
+            backends.get_backend().remove_export(temp_qcow_file, temp_path,
+                                                 cephhost)
     except sh.ErrorReturnCode as e:
         logger.error('error removing temp qcow %s with error from ssh:'
                      % temp_qcow_file)
@@ -410,5 +656,8 @@ def remove_qcow(image, pool='', cephhost='', cephuser='', cephcluster='',
                      % temp_qcow_file)
         logger.exception(e)
         raise
+    finally:
+        # a qcow left behind is in the next sample of the real free space
+        freespace.release('%s/%s' % (pool, image), cephhost=cephhost)
     logger.info("successfully removed qcow for %s" % image)
     return True
@@ -0,0 +1,264 @@
+# content defined chunk store, to keep each distinct chunk of the exports of
+# all images and generations once, with a manifest per export
+import glob
+import hashlib
+import os
+import stat
+import tempfile
+import zlib
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+
+
+MANIFEST_HEADER = 'ceph_rsnapshot chunk manifest v1'
+MANIFEST_SUFFIX = '.manifest'
+CHUNK_HASH = 'sha256'
+# chunk boundaries fall only between blocks of this size, where the crc of
+# the block before them matches, so aligned content always cuts the same way
+CHUNK_ALIGN = 4096
+ZERO_BLOCK = b'\0' * CHUNK_ALIGN
+# export files kept in the store instead of in the generations
+EXPORT_SUFFIXES = ['.qcow2', '.raw']
+
+
+def get_store_path():
+    """ CHUNK_STORE_PATH, or .chunk_store in BACKUP_BASE_PATH
+    """
+    if settings.CHUNK_STORE_PATH:
+        return settings.CHUNK_STORE_PATH
+    return '%s/.chunk_store' % settings.BACKUP_BASE_PATH
+
+
+def get_chunk_path(chunk_id, store_path=''):
+    if not store_path:
+        store_path = get_store_path()
+    return '%s/%s/%s/%s' % (store_path, chunk_id[:2], chunk_id[2:4], chunk_id)
+
+
+def iter_chunks(stream, avg_size=None):
+    """ split stream into content defined chunks averaging avg_size bytes,
+        between a quarter and four times that
+    """
+    if avg_size is None:
+        avg_size = settings.CHUNK_AVG_SIZE
+    blocks_per_chunk = max(avg_size // CHUNK_ALIGN, 1)
+    min_size = avg_size // 4
+    max_size = avg_size * 4
+    chunk = []
+    chunk_size = 0
+    while True:
+        block = stream.read(CHUNK_ALIGN)
+        while block and len(block) < CHUNK_ALIGN:
+            more = stream.read(CHUNK_ALIGN - len(block))
+            if not more:
+                break
+            block += more
+        if not block:
+            break
+        chunk.append(block)
+        chunk_size += len(block)
+        if chunk_size >= max_size or (
+                chunk_size >= min_size and
+                (zlib.crc32(block) & 0xffffffff) % blocks_per_chunk == 0):
+            yield b''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def put_chunk(chunk, store_path=''):
+    """ store chunk under its hash unless it's there already. returns the
+        chunk id and whether it was new
+    """
+    chunk_id = hashlib.new(CHUNK_HASH, chunk).hexdigest()
+    chunk_path = get_chunk_path(chunk_id, store_path)
+    if os.path.exists(chunk_path):
+        return chunk_id, False
+    chunk_dir = os.path.dirname(chunk_path)
+    if not os.path.isdir(chunk_dir):
+        try:
+            os.makedirs(chunk_dir, 0o700)
+        except OSError:
+            # made by another worker meanwhile
+            if not os.path.isdir(chunk_dir):
+                raise
+    fd, temp_path = tempfile.mkstemp(prefix='.%s.' % chunk_id, dir=chunk_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(chunk)
+        os.rename(temp_path, chunk_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return chunk_id, True
+
+
+def store_stream(stream, manifest_path, store_path=''):
+    """ chunk stream into the store and write its manifest. returns the
+        size, chunk counts and bytes newly stored
+    """
+    stats = {'size': 0, 'chunks': 0, 'new_chunks': 0, 'zero_chunks': 0,
+             'new_bytes': 0}
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest:
+        entries = []
+        for chunk in iter_chunks(stream):
+            stats['chunks'] += 1
+            stats['size'] += len(chunk)
+            if chunk.count(b'\0') == len(chunk):
+                stats['zero_chunks'] += 1
+                entries.append('zero %s\n' % len(chunk))
+                continue
+            chunk_id, new = put_chunk(chunk, store_path)
+            if new:
+                stats['new_chunks'] += 1
+                stats['new_bytes'] += len(chunk)
+            entries.append('%s %s\n' % (chunk_id, len(chunk)))
+        manifest.write('%s %s\n' % (MANIFEST_HEADER, stats['size']))
+        manifest.writelines(entries)
+    os.rename(temp_path, manifest_path)
+    return stats
+
+
+def read_manifest(manifest_path):
+    """ (size, [(chunk id or None for zeros, length)]) of a manifest
+    """
+    with open(manifest_path) as manifest:
+        header = manifest.readline().rstrip('\n')
+        if not header.startswith(MANIFEST_HEADER + ' '):
+            raise ValueError('%s is not a chunk manifest' % manifest_path)
+        size = int(header[len(MANIFEST_HEADER) + 1:])
+        entries = []
+        for line in manifest:
+            chunk_id, length = line.split()
+            if chunk_id == 'zero':
+                chunk_id = None
+            entries.append((chunk_id, int(length)))
+    if sum([length for chunk_id, length in entries]) != size:
+        raise ValueError('chunks of %s do not add up to its size' %
+                         manifest_path)
+    return size, entries
+
+
+def restore(manifest_path, target, store_path=''):
+    """ write the export of a manifest to the file object target, a chunk at
+        a time, checking each chunk's hash. zeros are seeked over if target
+        is a regular file, so it stays sparse. returns the bytes written
+    """
+    size, entries = read_manifest(manifest_path)
+    try:
+        seekable = stat.S_ISREG(os.fstat(target.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        seekable = False
+    for chunk_id, length in entries:
+        if chunk_id is None:
+            if seekable:
+                target.seek(length, os.SEEK_CUR)
+            else:
+                while length > 0:
+                    target.write(ZERO_BLOCK[:min(length, CHUNK_ALIGN)])
+                    length -= CHUNK_ALIGN
+            continue
+        with open(get_chunk_path(chunk_id, store_path), 'rb') as f:
+            chunk = f.read()
+        if (len(chunk) != length or
+                hashlib.new(CHUNK_HASH, chunk).hexdigest() != chunk_id):
+            raise ValueError('chunk %s of %s is corrupt' % (chunk_id,
+                                                            manifest_path))
+        target.write(chunk)
+    if seekable:
+        target.truncate(size)
+    return size
+
+
+def get_export_files(generation_dir):
+    return sorted([path for suffix in EXPORT_SUFFIXES for path in
+                   glob.glob('%s/*%s' % (generation_dir, suffix))])
+
+
+def store_generation(generation_dir, store_path=''):
+    """ move the export files of a generation into the store, leaving a
+        manifest in place of each. returns the summed stats
+    """
+    logger = logs.get_logger()
+    totals = {'size': 0, 'chunks': 0, 'new_chunks': 0, 'zero_chunks': 0,
+              'new_bytes': 0}
+    for export_file in get_export_files(generation_dir):
+        with open(export_file, 'rb') as stream:
+            stats = store_stream(stream, export_file + MANIFEST_SUFFIX,
+                                 store_path)
+        os.remove(export_file)
+        logger.info('stored %s in the chunk store: %s chunks, %s new, %s new'
+                    ' bytes of %s' % (export_file, stats['chunks'],
+                                      stats['new_chunks'], stats['new_bytes'],
+                                      stats['size']))
+        for key in totals:
+            totals[key] += stats[key]
+    return totals
+
+
+def get_manifests(backup_base_path=''):
+    """ every manifest in every generation of every image under
+        backup_base_path
+    """
+    if not backup_base_path:
+        backup_base_path = settings.BACKUP_BASE_PATH
+    return glob.glob('%s/*/*/*/*%s' % (backup_base_path, MANIFEST_SUFFIX))
+
+
+def get_store_stats(store_path='', backup_base_path=''):
+    """ manifests and the bytes they stand for, against the chunks and bytes
+        actually in the store
+    """
+    if not store_path:
+        store_path = get_store_path()
+    stats = {'manifests': 0, 'logical_bytes': 0, 'chunks': 0,
+             'stored_bytes': 0}
+    for manifest_path in get_manifests(backup_base_path):
+        size, entries = read_manifest(manifest_path)
+        stats['manifests'] += 1
+        stats['logical_bytes'] += size
+    for dirpath, dirnames, filenames in os.walk(store_path):
+        for filename in filenames:
+            if not filename.startswith('.'):
+                stats['chunks'] += 1
+                stats['stored_bytes'] += os.path.getsize(
+                    os.path.join(dirpath, filename))
+    return stats
+
+
+def gc(dry_run=False, store_path='', backup_base_path=''):
+    """ remove the chunks no manifest refers to any more, now that the
+        generations that did have rotated off. returns the chunks and bytes
+        removed (or that would be)
+    """
+    logger = logs.get_logger()
+    if not store_path:
+        store_path = get_store_path()
+    referenced = set()
+    manifests = get_manifests(backup_base_path)
+    for manifest_path in manifests:
+        # any unreadable manifest stops the gc, its chunks may be in use
+        size, entries = read_manifest(manifest_path)
+        referenced.update([chunk_id for chunk_id, length in entries
+                           if chunk_id])
+    logger.info('%s chunks referenced by %s manifests' % (len(referenced),
+                                                         len(manifests)))
+    removed = {'chunks': 0, 'bytes': 0}
+    for dirpath, dirnames, filenames in os.walk(store_path):
+        for filename in filenames:
+            if filename.startswith('.') or filename in referenced:
+                continue
+            chunk_path = os.path.join(dirpath, filename)
+            removed['chunks'] += 1
+            removed['bytes'] += os.path.getsize(chunk_path)
+            if not dry_run:
+                os.remove(chunk_path)
+    logger.info('%s %s unreferenced chunks, %s bytes' % (
+        'would remove' if dry_run else 'removed', removed['chunks'],
+        removed['bytes']))
+    return removed
+
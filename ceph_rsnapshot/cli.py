@@ -2,21 +2,49 @@
 import sh
 import os
 import sys
+import subprocess
 import argparse
 import time
-import re
 import logging
 import json
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from ceph_rsnapshot import logs
 from ceph_rsnapshot import settings
 from ceph_rsnapshot import templates
 from ceph_rsnapshot import dirs
 from ceph_rsnapshot import ceph
+from ceph_rsnapshot import backends
+from ceph_rsnapshot import catalog
+from ceph_rsnapshot import chunkstore
+from ceph_rsnapshot import compression
+from ceph_rsnapshot import connections
+from ceph_rsnapshot import dates
 from ceph_rsnapshot import helpers
+from ceph_rsnapshot import history
+from ceph_rsnapshot import incremental
+from ceph_rsnapshot import locks
+from ceph_rsnapshot import metrics
+from ceph_rsnapshot import reflink
+from ceph_rsnapshot import rotate
+from ceph_rsnapshot import schedule
+from ceph_rsnapshot import throttle
 from ceph_rsnapshot import exceptions
 
 
+# max number of exported qcows on the ceph node at once when pipelining
+# exports, one being rsnapped and the next one exported behind it
+PIPELINE_STAGED_QCOWS = 2
+
+# ceph_rsnapshot args passed on to the run of each of CLUSTER_CONFIGS
+CLUSTER_ARGS = ['pools', 'image_re', 'extralongargs']
+CLUSTER_FLAGS = ['verbose', 'noop', 'no_rotate_orphans', 'printsettings',
+                 'keepconf']
+
 # TODO FIXME add a timeout on the first ssh connection and error
 # differently if the source is not responding
 
@@ -44,69 +72,173 @@ def get_names_on_dest(pool=''):
     return names_on_dest
 
 
-def rotate_orphans(orphans, pool=''):
+def update_catalog(image, pool='', image_phase=True):
+    """ re-index image's backup dir in the catalog, if CATALOG is set.
+        errors are logged, as the catalog can be rebuilt
+    """
     logger = logs.get_logger()
-    if not pool:
-        pool = settings.POOL
-    backup_base_path = settings.BACKUP_BASE_PATH
+    if not settings.CATALOG or settings.NOOP:
+        return
+    with metrics.PhaseTimer('catalog', pool=pool,
+                            image=image if image_phase else ''):
+        try:
+            catalog.update_image(image, pool=pool)
+        except Exception as e:
+            logger.error('error updating catalog for image %s: %s' %
+                         (image, e))
 
-    # now check for ophans on dest
-    backup_path = "%s/%s" % (backup_base_path, pool)
 
-    orphans_rotated = []
-    orphans_failed_to_rotate = []
+def record_compression(image, pool=''):
+    """ log the compression ratio and cpu time of image's new export, if its
+        pool is compressed
+    """
+    logger = logs.get_logger()
+    if settings.NOOP:
+        return
+    try:
+        sample = compression.record_generation(
+            image, incremental.get_generation_path(image, pool=pool),
+            pool=pool, raw_bytes=metrics.get_image_phases(
+                image, pool=pool).get('export', {}).get('bytes', 0))
+        if sample:
+            logger.info('compressed image %s: %s' % (
+                image, compression.format_stats(sample)))
+    except Exception as e:
+        logger.error('error getting compression of image %s: %s' %
+                     (image, e))
 
-    template = templates.get_template()
 
-    empty_tempdir = dirs.make_empty_tempdir()
+def store_chunks(image, pool=''):
+    """ move the exports of image's new generation into the chunk store, if
+        CHUNK_STORE is set. errors are logged, as the exports stay in place
+        until their manifests are written
+    """
+    logger = logs.get_logger()
+    if not settings.CHUNK_STORE or settings.NOOP:
+        return
+    with metrics.PhaseTimer('chunk_store', pool=pool, image=image) as timer:
+        try:
+            stats = chunkstore.store_generation(
+                incremental.get_generation_path(image, pool=pool))
+            timer.bytes = stats['new_bytes']
+        except Exception as e:
+            logger.error('error storing image %s in the chunk store: %s' %
+                         (image, e))
+
 
-    for orphan in orphans:
-        logger.info('rotating orphan: %s' % orphan)
+def gc_chunks():
+    """ remove the chunks of generations rotated off this run, if
+        CHUNK_STORE is set
+    """
+    logger = logs.get_logger()
+    if not settings.CHUNK_STORE or settings.NOOP:
+        return
+    try:
+        # runs of other clusters may be storing chunks into it
+        with locks.lock_chunk_store(chunkstore.get_store_path()):
+            chunkstore.gc()
+    except exceptions.LockHeldError as e:
+        logger.info('not collecting chunk store garbage this run: %s' % e)
+    except Exception as e:
+        logger.error('error with chunk store gc, skipping it: %s' % e)
+
+
+def rotate_orphan(orphan, pool=''):
+    """ rotate one orphan's generations, leaving an empty newest one. returns
+        True if it was rotated, False if not, or None for NOOP
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    logger.info('rotating orphan: %s' % orphan)
+    if settings.NOOP:
+        logger.info('NOOP: would have rotated orphan %s/%s/%s' %
+                    (settings.BACKUP_BASE_PATH, pool, orphan))
+        return None
+    rotated = False
+    with metrics.PhaseTimer('orphan_rotation', pool=pool):
         try:
-            # do this every time to be sure it's empty
-            dirs.check_empty_dir(empty_tempdir)
-        except NameError as e:
-            logger.error('error with verifying temp empty source,'
-                         ' cannot rotate orphans. error: %s' % e)
-            # fail out
-            return({'orphans_rotated': orphans_rotated, 'orphans_failed_to_rotate':
-                    [orphan for orphan in orphans if orphan not in orphans_rotated]})
-        # note this uses temp_path on the dest - which we check to be empty
-        # note needs to end in a trailing /
-        source = "%s/" % empty_tempdir
-        conf_file = templates.write_conf(orphan,
-                                         pool=pool,
-                                         source=source,
-                                         template=template)
-        logger.info("rotating orphan %s" % orphan)
+            rotate.rotate_orphan(orphan, pool=pool)
+            rotated = True
+        except (IOError, OSError) as e:
+            logger.error('failed to rotate orphan %s: %s' % (orphan, e))
+    update_catalog(orphan, pool=pool, image_phase=False)
+    return rotated
+
+
+def reclaim_orphans(orphans, pool=''):
+    """ remove the backup dirs of orphans with no data left in any
+        generation, so they stop being rotated. returns the reclaimed and the
+        remaining orphans
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    rotated_out = rotate.get_rotated_out(orphans, pool=pool)
+    reclaimed = []
+    for orphan in rotated_out:
         if settings.NOOP:
-            logger.info(
-                'NOOP: would have rotated orphan here using rsnapshot conf see previous lines')
-        else:
+            logger.info('NOOP: would have reclaimed orphan %s/%s/%s, it has'
+                        ' no data left' % (settings.BACKUP_BASE_PATH, pool,
+                                           orphan))
+            continue
+        logger.info('reclaiming orphan %s, it has no data left' % orphan)
+        try:
+            rotate.reclaim(orphan, pool=pool)
+        except (IOError, OSError) as e:
+            logger.error('failed to reclaim orphan %s: %s' % (orphan, e))
+            continue
+        finally:
+            update_catalog(orphan, pool=pool, image_phase=False)
+        reclaimed.append(orphan)
+    return ([{'pool': pool, 'orphan': orphan} for orphan in reclaimed],
+            [orphan for orphan in orphans if orphan not in reclaimed])
+
+
+def rotate_orphans(orphans, pool='', num_workers=None):
+    """ rotate orphans with only filesystem renames, no rsnapshot or rsync,
+        num_workers at once
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    if num_workers is None:
+        num_workers = settings.ORPHAN_WORKERS
+    num_workers = max(min(num_workers, len(orphans)), 1)
+    if orphans:
+        logger.info('rotating %s orphans in pool %s with %s workers' %
+                    (len(orphans), pool, num_workers))
+    results = [False] * len(orphans)
+    work_queue = queue.Queue()
+    for index, orphan in enumerate(orphans):
+        work_queue.put((index, orphan))
+
+    def worker():
+        while True:
             try:
-                rsnap_result = sh.rsnapshot(
-                    '-c', '%s/%s/%s.conf' % (settings.TEMP_CONF_DIR, pool, orphan), settings.RETAIN_INTERVAL)
-                # if ssuccessful, log
-                if rsnap_result.stdout.strip("\n"):
-                    logger.info("successful; stdout from rsnap:\n" +
-                                rsnap_result.stdout.strip("\n"))
-                orphans_rotated.append({'pool': pool, 'orphan': orphan})
-            except sh.ErrorReturnCode as e:
-                orphans_failed_to_rotate.append({'pool': pool, 'orphan': orphan})
-                logger.error("failed to rotate orphan %s with code %s" %
-                             (orphan, e.exit_code))
-                logger.error("stdout from source node:\n" +
-                             e.stdout.strip("\n"))
-                logger.error("stderr from source node:\n" +
-                             e.stderr.strip("\n"))
-        # unless flag to keep it for debug
-        if not settings.KEEPCONF:
-            templates.remove_conf(orphan, pool)
+                index, orphan = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = rotate_orphan(orphan, pool=pool)
+            except Exception as e:
+                logger.error('error rotating orphan %s' % orphan)
+                logger.exception(e)
 
-    dirs.remove_empty_dir(empty_tempdir)
+    workers = [threading.Thread(target=worker, name='orphan-worker-%s' % n)
+               for n in range(num_workers)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    orphans_rotated = [{'pool': pool, 'orphan': orphan} for orphan, rotated
+                       in zip(orphans, results) if rotated]
+    orphans_failed_to_rotate = [{'pool': pool, 'orphan': orphan} for orphan,
+                                rotated in zip(orphans, results)
+                                if rotated is False]
 
-    # TODO now check for any image dirs that are entirely empty and remove
-    # them (and the empty daily.NN inside them)
     return({'orphans_rotated': orphans_rotated, 'orphans_failed_to_rotate': orphans_failed_to_rotate})
 
 
@@ -126,35 +258,80 @@ def rsnap_image_sh(image, pool=''):
     else:
         try:
             ts = time.time()
-            rsnap_result = sh.rsnapshot(
-                '-c', rsnap_conf_file, settings.RETAIN_INTERVAL)
+            # the limit for the time of day this image is transferred at
+            if settings.EXPORT_MODE == 'stream':
+                bwlimit = throttle.get_stream_rate(pool)
+            else:
+                bwlimit = throttle.get_rate('transfer', pool)
+            if bwlimit:
+                logger.info('limiting transfer of %s to %s KB/s' %
+                            (image, bwlimit))
+            if settings.ROTATION_ENGINE == 'native':
+                backup_script = ''
+                if settings.EXPORT_MODE == 'stream':
+                    backup_script = templates.get_stream_script_path(
+                        image, pool=pool)
+                rsnap_stdout = rotate.rsnap(image, pool=pool,
+                                            backup_script=backup_script,
+                                            bwlimit=bwlimit)
+            else:
+                if settings.EXPORT_MODE != 'stream':
+                    # rsnapshot's rsync takes its limit from the conf, so
+                    # rewrite it if the limit changed since it was written
+                    rsnap_conf_file = templates.write_conf(image, pool=pool,
+                                                           bwlimit=bwlimit)
+                rsnap_stdout = sh.rsnapshot(
+                    '-c', rsnap_conf_file, settings.RETAIN_INTERVAL,
+                    _env=dict(os.environ, **{
+                        throttle.BWLIMIT_ENV: str(bwlimit)})).stdout
+            # sh output is bytes on python 3
+            if isinstance(rsnap_stdout, bytes):
+                rsnap_stdout = rsnap_stdout.decode('utf-8', 'replace')
             tf = time.time()
             elapsed_time = tf - ts
             elapsed_time_ms = elapsed_time * 10**3
             rsnap_ok = True
             logger.info("rsnap successful for image %s in %sms" %
                         (image, elapsed_time_ms))
-            if rsnap_result.stdout.strip("\n"):
+            if rsnap_stdout.strip("\n"):
                 logger.info("stdout from rsnap:\n" +
-                            rsnap_result.stdout.strip("\n"))
+                            rsnap_stdout.strip("\n"))
         except sh.ErrorReturnCode as e:
             logger.error("failed to rsnap %s with code %s" %
                          (image, e.exit_code))
             # TODO move log formatting and writing to a function
-            logger.error("stdout from rsnap:\n" + e.stdout.strip("\n"))
-            logger.error("stderr from rsnap:\n" + e.stderr.strip("\n"))
+            logger.error("stdout from rsnap:\n" +
+                         e.stdout.decode('utf-8', 'replace').strip("\n"))
+            logger.error("stderr from rsnap:\n" +
+                         e.stderr.decode('utf-8', 'replace').strip("\n"))
+            rsnap_ok = False
+        except (IOError, OSError) as e:
+            # from rotating the generations with the native engine
+            logger.error("failed to rotate generations of %s: %s" %
+                         (image, e))
             rsnap_ok = False
     return rsnap_ok
 
 
-def rsnap_image(image, pool='', template=None):
+def get_export_bytes(image, pool):
+    """ bytes read from ceph to export image, its rbd used size. 0 if that
+        can't be had, as this is only for metrics
+    """
+    logger = logs.get_logger()
+    try:
+        return ceph.get_rbd_sizes(image, pool=pool)['used_size']
+    except Exception as e:
+        logger.warning('cannot get used size of %s for metrics: %s' %
+                       (image, e))
+        return 0
+
+
+def export_image(image, pool='', template=None):
+    """ first stage of rsnap_image: write the rsnap conf, make the temp qcow
+        dir and export the qcow. returns the status flags for transfer_image
+    """
     if not pool:
         pool = settings.POOL
-    temp_path = settings.QCOW_TEMP_PATH
-    extra_args = settings.EXTRA_ARGS
-
-    conf_base_path = settings.TEMP_CONF_DIR
-    backup_base_path = settings.BACKUP_BASE_PATH
 
     # get logger we setup earlier
     logger = logs.get_logger()
@@ -162,66 +339,116 @@ def rsnap_image(image, pool='', template=None):
     # setup flags
     qcow_temp_path_empty = False
     export_qcow_ok = False
-    rsnap_ok = False
-    remove_qcow_ok = False
 
     # only reopen if we haven't pulled this yet - ie, are we part of a pool run
     if not template:
         template = templates.get_template()
 
+    if settings.EXPORT_MODE == 'stream':
+        # nothing to stage on the ceph node, rsnapshot runs the stream script
+        # to pull the export straight into the new generation
+        try:
+            with metrics.PhaseTimer('conf_write', pool=pool, image=image):
+                backup_script = templates.write_stream_script(image,
+                                                              pool=pool)
+                conf_file = templates.write_conf(image, pool=pool,
+                                                 template=template,
+                                                 backup_script=backup_script)
+            logger.info(conf_file)
+            export_qcow_ok = True
+        except Exception as e:
+            logger.error('error writing stream script for image %s' % image)
+            logger.exception(e)
+        return {'qcow_temp_path_empty': True,
+                'export_qcow_ok': export_qcow_ok}
+
     # create the temp conf file
-    conf_file = templates.write_conf(image, pool=pool, template=template)
+    with metrics.PhaseTimer('conf_write', pool=pool, image=image):
+        conf_file = templates.write_conf(image, pool=pool, template=template)
     logger.info(conf_file)
 
-    # make sure temp qcow dir is empty
-    try:
-        if dirs.check_qcow_temp_path_empty_for_pool(pool=pool):
-            qcow_temp_path_empty = True
-    except Exception as e:
-        # if it's not empty, fail this image
-        logger.error('qcow temp path not empty, failing this image')
-        logger.exception(e)
-        qcow_temp_path_empty = False
-
-    # ssh to source and export temp qcow of this image
-    if qcow_temp_path_empty:
+    with metrics.PhaseTimer('export', pool=pool, image=image) as timer:
+        # make the per image temp qcow dir and make sure it is empty
         try:
-            ceph.export_qcow(image, pool=pool)
-            export_qcow_ok = True
-        except NameError as e:
-            # probably not enough space. set to false and try to go and remove this
-            # one, or go to next image in case it was temporary
-            logger.error('error from export qcow: %s' % e)
-            export_qcow_ok = False
+            if dirs.setup_qcow_temp_path_for_image(image, pool=pool):
+                qcow_temp_path_empty = True
         except Exception as e:
-            logger.error('error from export qcow')
+            # if it's not empty, fail this image
+            logger.error('qcow temp path not empty, failing this image')
             logger.exception(e)
-            export_qcow_ok = False
+            qcow_temp_path_empty = False
+
+        # ssh to source and export temp qcow of this image
+        if qcow_temp_path_empty:
+            try:
+                ceph.export_qcow(image, pool=pool)
+                export_qcow_ok = True
+            except NameError as e:
+                # probably not enough space. set to false and try to go and remove this
+                # one, or go to next image in case it was temporary
+                logger.error('error from export qcow: %s' % e)
+                export_qcow_ok = False
+            except Exception as e:
+                logger.error('error from export qcow')
+                logger.exception(e)
+                export_qcow_ok = False
+        if export_qcow_ok and not settings.NOOP:
+            timer.bytes = get_export_bytes(image, pool)
+
+    return {'qcow_temp_path_empty': qcow_temp_path_empty,
+            'export_qcow_ok': export_qcow_ok}
+
+
+def transfer_image(image, status, pool=''):
+    """ second stage of rsnap_image: rsnap the exported qcow, then remove it
+        and the rsnap conf. returns the result dict for the image
+    """
+    if not pool:
+        pool = settings.POOL
+    logger = logs.get_logger()
+    qcow_temp_path_empty = status['qcow_temp_path_empty']
+    export_qcow_ok = status['export_qcow_ok']
+    rsnap_ok = False
+    remove_qcow_ok = False
 
     # if exported ok, then rsnap this image
     if export_qcow_ok:
-        try:
-            rsnap_ok = rsnap_image_sh(image, pool=pool)
-        except Exception as e:
-            # TODO
-            logger.error('error with rsnapping image %s' % image)
+        with metrics.PhaseTimer('rsync', pool=pool, image=image) as timer:
+            try:
+                rsnap_ok = rsnap_image_sh(image, pool=pool)
+            except Exception as e:
+                # TODO
+                logger.error('error with rsnapping image %s' % image)
+            if rsnap_ok:
+                timer.bytes = metrics.get_dir_bytes(
+                    incremental.get_generation_path(image, pool=pool))
+        if rsnap_ok:
+            record_compression(image, pool=pool)
+            store_chunks(image, pool=pool)
+        # even if rsnap failed, as it may have rotated the generations
+        update_catalog(image, pool=pool)
     else:
         logger.error(
             "skipping rsnap of image %s because export to qcow failed" % image)
 
-    # either way remove the temp qcow
-    logger.info("removing temp qcow for %s" % image)
-    try:
-        remove_qcow_ok = ceph.remove_qcow(image, pool=pool)
-    except Exception as e:
-        logger.error('error removing qcow. will continue to next image anyways,'
-                     ' note that we check for free space so wont entirely fill disk if they'
-                     ' all fail')
+    with metrics.PhaseTimer('cleanup', pool=pool, image=image):
+        # either way remove the temp qcow
+        if settings.EXPORT_MODE == 'stream':
+            # streamed, so there is no temp qcow on the ceph node
+            remove_qcow_ok = True
+        else:
+            logger.info("removing temp qcow for %s" % image)
+            try:
+                remove_qcow_ok = ceph.remove_qcow(image, pool=pool)
+            except Exception as e:
+                logger.error('error removing qcow. will continue to next image'
+                             ' anyways, note that we check for free space so'
+                             ' wont entirely fill disk if they all fail')
 
-    # either way remove the temp conf file
-    # unless flag to keep it for debug
-    if not settings.KEEPCONF:
-        templates.remove_conf(image, pool=pool)
+        # either way remove the temp conf file
+        # unless flag to keep it for debug
+        if not settings.KEEPCONF:
+            templates.remove_conf(image, pool=pool)
 
     if export_qcow_ok and rsnap_ok and remove_qcow_ok:
         successful = True
@@ -240,6 +467,171 @@ def rsnap_image(image, pool='', template=None):
             })
 
 
+def rsnap_image(image, pool='', template=None):
+    if not pool:
+        pool = settings.POOL
+    status = export_image(image, pool=pool, template=template)
+    return transfer_image(image, status, pool=pool)
+
+
+def check_image_name(image, pool):
+    """ just to be safe, sanitize image names here too. returns None if the
+        name is ok, or a failed result dict for the image if not
+    """
+    logger = logs.get_logger()
+    try:
+        helpers.validate_string(image)
+    except NameError as e:
+        logger.error('bad character in image name %s: error %s' %
+            (image, e))
+        # fake return value from image
+        return({'image': image,
+                'pool': pool,
+                'successful': False,
+                'status': {
+                    'export_qcow_ok': False,
+                    'rsnap_ok': False,
+                    'remove_qcow_ok': False
+                }
+                })
+    return None
+
+
+def log_image_result(image, result):
+    logger = logs.get_logger()
+    if result['successful']:
+        logger.info('successfully done with %s' % image)
+    else:
+        logger.error('error on %s : result: %s' %
+                    (image, result['status']))
+
+
+def rsnap_pool_image(image, index, len_names, pool, template):
+    """ validate and rsnap one image of a pool run. returns the result dict
+        from rsnap_image, or None if it raised
+    """
+    logger = logs.get_logger()
+    bad_name_result = check_image_name(image, pool)
+    if bad_name_result:
+        return bad_name_result
+    # TODO catch other exceptions here?
+    logger.info('working on name %s of %s in pool %s: %s' %
+                (index, len_names, pool, image))
+    try:
+        result = rsnap_image(image, pool=pool, template=template)
+        log_image_result(image, result)
+        return result
+    except Exception as e:
+        logger.error('error with pool %s at image %s' % (pool, image))
+        logger.exception(e)
+        return None
+
+
+def rsnap_images_pipelined(images, pool, template):
+    """ rsnap images one at a time, but export the next image on the ceph
+        node while the previous one is being rsnapped. at most
+        PIPELINE_STAGED_QCOWS qcows are staged at once, and the free space
+        ledger makes an export wait for the staged one to be removed if
+        there isn't room for both.
+        returns the rsnap_pool_image results in the order of images
+    """
+    logger = logs.get_logger()
+    len_names = len(images)
+    results = [None] * len_names
+    # slots for qcows exported or being exported but not yet removed
+    staged = threading.Semaphore(PIPELINE_STAGED_QCOWS)
+    exported = queue.Queue()
+
+    def exporter():
+        for index, image in enumerate(images):
+            staged.acquire()
+            status = None
+            try:
+                bad_name_result = check_image_name(image, pool)
+                if bad_name_result:
+                    status = bad_name_result
+                else:
+                    logger.info('exporting name %s of %s in pool %s: %s' %
+                                (index + 1, len_names, pool, image))
+                    status = export_image(image, pool=pool,
+                                          template=template)
+            except Exception as e:
+                logger.error('error with pool %s at image %s' % (pool, image))
+                logger.exception(e)
+            exported.put((index, image, status))
+        exported.put(None)
+
+    logger.info('rsnapping %s images in pool %s, exporting each next image'
+                ' while the previous is rsnapped' % (len_names, pool))
+    export_thread = threading.Thread(target=exporter, name='rsnap-exporter')
+    export_thread.daemon = True
+    export_thread.start()
+    while True:
+        item = exported.get()
+        if item is None:
+            break
+        index, image, status = item
+        try:
+            if status is None or 'successful' in status:
+                # export stage raised, or the name failed validation
+                results[index] = status
+            else:
+                logger.info('rsnapping name %s of %s in pool %s: %s' %
+                            (index + 1, len_names, pool, image))
+                results[index] = transfer_image(image, status, pool=pool)
+                log_image_result(image, results[index])
+        except Exception as e:
+            logger.error('error with pool %s at image %s' % (pool, image))
+            logger.exception(e)
+        staged.release()
+    export_thread.join()
+    return results
+
+
+def rsnap_images(images, pool, template, num_workers=None):
+    """ rsnap a list of images with num_workers images in flight at once,
+        each in its own temp qcow subdirectory on the ceph node.
+        returns the rsnap_pool_image results in the order of images
+    """
+    logger = logs.get_logger()
+    if num_workers is None:
+        num_workers = settings.NUM_WORKERS
+    len_names = len(images)
+    results = [None] * len_names
+    if num_workers <= 1 and settings.PIPELINE_EXPORTS:
+        return rsnap_images_pipelined(images, pool, template)
+    if num_workers <= 1:
+        for index, image in enumerate(images):
+            results[index] = rsnap_pool_image(image, index + 1, len_names,
+                                              pool, template)
+        return results
+
+    num_workers = min(num_workers, len_names)
+    logger.info('rsnapping %s images in pool %s with %s workers' %
+                (len_names, pool, num_workers))
+    work_queue = queue.Queue()
+    for index, image in enumerate(images):
+        work_queue.put((index, image))
+
+    def worker():
+        while True:
+            try:
+                index, image = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = rsnap_pool_image(image, index + 1, len_names,
+                                              pool, template)
+
+    workers = [threading.Thread(target=worker, name='rsnap-worker-%s' % n)
+               for n in range(num_workers)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
 def rsnap_pool(pool):
     # get values from settings
     host = settings.CEPH_HOST
@@ -249,6 +641,7 @@ def rsnap_pool(pool):
     logger.debug("starting rsnap of ceph pool %s to qcows in %s/%s" %
                  (pool, settings.BACKUP_BASE_PATH, pool))
 
+    ts = time.time()
     # get list of images from source
     try:
         names_on_source = ceph.gathernames(pool=pool)
@@ -258,6 +651,19 @@ def rsnap_pool(pool):
         raise NameError('cannot get names on source, failing run')
     logger.info("names on source: %s" % ",".join(names_on_source))
 
+    # log how much we are about to back up, from the pool size inventory
+    if settings.POOL_SIZE_INVENTORY and names_on_source:
+        try:
+            sizes = [ceph.get_rbd_sizes(image, pool=pool) for image in
+                     names_on_source]
+            logger.info('images to back up in pool %s: %s bytes provisioned,'
+                        ' %s bytes used' % (pool,
+                        sum([size['provisioned_size'] for size in sizes]),
+                        sum([size['used_size'] for size in sizes])))
+        except Exception as e:
+            logger.warning('cannot get sizes of images in pool %s: %s' %
+                           (pool, e))
+
     # get list of images on backup dest already
     try:
         names_on_dest = get_names_on_dest(pool=pool)
@@ -272,60 +678,49 @@ def rsnap_pool(pool):
         image for image in names_on_dest if image not in names_on_source]
     if orphans_on_dest:
         logger.info("orphans on dest: %s" % ",".join(orphans_on_dest))
+    metrics.record('discovery', time.time() - ts, pool=pool)
 
     # get template string for rsnap conf
     template = templates.get_template()
 
+    # write every image's conf in one pass from the compiled template, the
+    # image workers then only reuse them
+    if names_on_source and names_on_source != [u'']:
+        try:
+            with metrics.PhaseTimer('conf_write', pool=pool):
+                templates.write_confs(names_on_source, pool=pool,
+                                      template=template)
+        except Exception as e:
+            logger.warning('error batch writing confs for pool %s, images'
+                           ' will write their own: %s' % (pool, e))
+
     successful = []
     failed = []
     orphans_rotated = []
     orphans_failed_to_rotate = []
+    orphans_reclaimed = []
 
     len_names = len(names_on_source)
-    index = 1
     if len_names == 1 and names_on_source[0] == u'':
         # TODO decide if this is critical/stop or just warn
         logger.critical('no images found on source')
         # sys.exit(1)
     else:
-        for image in names_on_source:
-            # just to be safe, sanitize image names here too
+        images = names_on_source
+        if settings.SCHEDULE == 'longest_first':
             try:
-                helpers.validate_string(image)
-            except NameError as e:
-                logger.error('bad character in image name %s: error %s' % 
-                    (image, e))
-                # fake return value from image
-                failed.append({'image': image,
-                    'pool': pool,
-                    'successful': False,
-                    'status': {
-                        'export_qcow_ok': False,
-                        'rsnap_ok': False,
-                        'remove_qcow_ok': False
-                    }
-                })
-                continue
-            # TODO catch other exceptions here?
-            logger.info('working on name %s of %s in pool %s: %s' %
-                        (index, len_names, pool, image))
-
-            try:
-                result = rsnap_image(image, pool=pool, template=template)
-                if result['successful']:
-                    logger.info('successfully done with %s' % image)
-                    # store in array
-                    successful.append(result)
-                else:
-                    logger.error('error on %s : result: %s' %
-                                (image, result['status']))
-                    # store dict in dict
-                    failed.append(result)
+                images = schedule.order_images(names_on_source, pool=pool)
             except Exception as e:
-                logger.error('error with pool %s at image %s' % (pool, image))
-                logger.exception(e)
-            # done with this image, increment counter
-            index = index + 1
+                logger.warning('cannot schedule images in pool %s, backing'
+                               ' them up in source order: %s' % (pool, e))
+        for result in rsnap_images(images, pool=pool, template=template):
+            if result is None:
+                # exception already logged by the worker
+                continue
+            if result['successful']:
+                successful.append(result)
+            else:
+                failed.append(result)
 
     # {'orphans_rotated': orphans_rotated, 'orphans_failed_to_rotate': orphans_failed_to_rotate}
     if settings.NO_ROTATE_ORPHANS:
@@ -333,17 +728,27 @@ def rsnap_pool(pool):
       orphan_result=dict(orphans_rotated=['no_rotate_orphans was set True'],
         orphans_failed_to_rotate=['no_rotate_orphans was set True'])
     else:
+        if settings.RECLAIM_ORPHANS:
+            try:
+                orphans_reclaimed, orphans_on_dest = reclaim_orphans(
+                    orphans_on_dest, pool=pool)
+            except Exception as e:
+                logger.error('error with reclaiming orphans:')
+                logger.exception(e)
         try:
             orphan_result = rotate_orphans(orphans_on_dest, pool=pool)
         except Exception as e:
             logger.error('error with rotating orphans:')
             logger.exception(e)
-            # just orphans so continue on 
+            # just orphans so continue on, counting them all as failed
+            orphan_result = dict(orphans_rotated=[], orphans_failed_to_rotate=[
+                {'pool': pool, 'orphan': orphan} for orphan in orphans_on_dest])
 
     return({'successful': successful,
             'failed': failed,
             'orphans_rotated': orphan_result['orphans_rotated'],
             'orphans_failed_to_rotate': orphan_result['orphans_failed_to_rotate'],
+            'orphans_reclaimed': orphans_reclaimed,
             })
 
 
@@ -355,6 +760,8 @@ def write_status(all_result):
     # write header
     if all_result['failed']:
         status_file.write("CRITICAL some rbd devices failed to back up|")
+    elif all_result.get('pools_locked'):
+        status_file.write('CRITICAL some pools were locked by another run|')
     elif all_result['orphans_failed_to_rotate']:
         status_file.write('WARNING all rbd devices backed up successfully but'
             'some orphans failed to rotate|')
@@ -377,6 +784,452 @@ def write_status(all_result):
         failed_orphans_string = " ".join(["%s=orphan_failed_to_rotate" % orphan
             for orphan in failed_orphans])
         status_file.write('%s ' % failed_orphans_string)
+    if all_result.get('pools_locked'):
+        status_file.write('%s ' % " ".join(["%s=locked" % pool for pool in
+            all_result['pools_locked']]))
+    # and per phase times, bytes and throughput
+    status_file.write('%s ' % metrics.get_perfdata())
+    status_file.close()
+
+
+# entry to query the run history database
+def ceph_rsnapshot_history():
+    parser = argparse.ArgumentParser(description='query the ceph_rsnapshot'
+                                     ' run history database')
+    parser.add_argument("-c", "--config", required=False,
+                        help="path to alternate config file")
+    parser.add_argument("--db", required=False,
+                        help="path to the history database, instead of"
+                        " HISTORY_DB")
+    parser.add_argument("-r", "--runs", type=int, required=False,
+                        help="number of most recent runs to look at"
+                        " (default 7, 30 for growth)")
+    parser.add_argument("-n", "--limit", type=int, default=20,
+                        help="max number of images to list")
+    parser.add_argument("--host", required=False,
+                        help="only look at the runs of this ceph node")
+    subparsers = parser.add_subparsers(dest='query')
+    # python 3 makes subcommands optional by default
+    subparsers.required = True
+    subparsers.add_parser('runs', help='list the most recent runs')
+    subparsers.add_parser('slowest', help='images with the highest mean'
+                          ' backup time')
+    regressions_parser = subparsers.add_parser(
+        'regressions', help='images whose last backup was much slower than'
+        ' their mean')
+    regressions_parser.add_argument("--factor", type=float, default=1.5,
+                                    help="slowdown or throughput drop to"
+                                    " report")
+    growth_parser = subparsers.add_parser(
+        'growth', help='images whose used size or backup time is growing'
+        ' fastest')
+    growth_parser.add_argument("--by", choices=['seconds', 'bytes'],
+                               default='seconds',
+                               help="sort by backup seconds or used bytes"
+                               " growth per day")
+    subparsers.add_parser('predict', help='predict the length of the next'
+                          ' run')
+    args = parser.parse_args()
+
+    if args.config:
+        settings.load_settings(args.config)
+    else:
+        settings.load_settings()
+    history_db = args.db or history.get_history_db()
+    if not os.path.isfile(history_db):
+        sys.stderr.write('no history database at %s\n' % history_db)
+        sys.exit(1)
+    conn = history.connect(history_db)
+    runs = args.runs or 7
+    if args.query == 'runs':
+        rows = [dict(row, duration=row['finished'] - row['started'],
+                     started=time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.localtime(row['started'])))
+                for row in history.get_runs(conn, runs, args.host)]
+        print(history.format_rows(rows, ['id', 'started', 'duration',
+                                         'cephhost', 'snap_date',
+                                         'num_workers', 'successful',
+                                         'failed']))
+    elif args.query == 'slowest':
+        print(history.format_rows(
+            history.get_slowest(conn, runs=runs, limit=args.limit,
+                                cephhost=args.host),
+            ['cephhost', 'image', 'runs', 'mean_seconds', 'last_seconds',
+             'mean_mb_per_second']))
+    elif args.query == 'regressions':
+        print(history.format_rows(
+            history.get_regressions(conn, runs=runs, factor=args.factor,
+                                    limit=args.limit, cephhost=args.host),
+            ['cephhost', 'image', 'last_seconds', 'mean_seconds', 'slowdown',
+             'throughput_drop']))
+    elif args.query == 'growth':
+        print(history.format_rows(
+            history.get_growth(conn, runs=args.runs or 30, limit=args.limit,
+                               by=args.by, cephhost=args.host),
+            ['cephhost', 'image', 'used_size', 'bytes_per_day', 'seconds',
+             'seconds_per_day']))
+    elif args.query == 'predict':
+        prediction = history.predict_run(conn, runs=runs,
+                                         cephhost=args.host)
+        if prediction is None:
+            print('no runs recorded yet')
+        else:
+            print('the %(images)s images of the last run take'
+                  ' %(image_seconds).0f seconds between them on average, so'
+                  ' the next run should take about %(predicted_seconds).0f'
+                  ' seconds; the last run took %(last_run_seconds).0f and'
+                  ' recent runs %(mean_run_seconds).0f on average' %
+                  prediction)
+    conn.close()
+
+
+# entry to query and rebuild the catalog of the backup node
+def ceph_rsnapshot_catalog():
+    parser = argparse.ArgumentParser(description='query or rebuild the'
+                                     ' ceph_rsnapshot catalog of backed up'
+                                     ' images and generations')
+    parser.add_argument("-c", "--config", required=False,
+                        help="path to alternate config file")
+    parser.add_argument("--db", required=False,
+                        help="path to the catalog, instead of CATALOG_DB")
+    parser.add_argument('-p', '--pool', required=False,
+                        help='pool of the image, or comma separated pools to'
+                        ' list or rebuild, instead of POOLS')
+    subparsers = parser.add_subparsers(dest='query')
+    # python 3 makes subcommands optional by default
+    subparsers.required = True
+    subparsers.add_parser('images', help='list images with their generations'
+                          ' and sizes')
+    generations_parser = subparsers.add_parser(
+        'generations', help='list the files in every generation of an image')
+    generations_parser.add_argument('image')
+    latest_parser = subparsers.add_parser(
+        'latest', help='the newest generation of an image with an export in'
+        ' it')
+    latest_parser.add_argument('image')
+    rebuild_parser = subparsers.add_parser(
+        'rebuild', help='re-index the backup dirs of the pools from disk')
+    rebuild_parser.add_argument('--no_checksums', action='store_true',
+                                help="don't checksum files not already in"
+                                " the catalog")
+    args = parser.parse_args()
+
+    if args.config:
+        settings.load_settings(args.config)
+    else:
+        settings.load_settings()
+    pools = [pool for pool in (args.pool or settings.POOLS).split(',')
+             if pool]
+    catalog_db = args.db or catalog.get_catalog_db()
+    if args.query == 'rebuild':
+        logs.setup_logging()
+        count = catalog.rebuild(pools, checksums=not args.no_checksums,
+                                catalog_db=catalog_db)
+        print('indexed %s images in %s' % (count, catalog_db))
+        return
+    if not os.path.isfile(catalog_db):
+        sys.stderr.write('no catalog at %s, make one with rebuild\n' %
+                         catalog_db)
+        sys.exit(1)
+    conn = catalog.connect(catalog_db)
+    file_columns = ['generation', 'name', 'snap', 'format', 'virtual_size',
+                    'allocated_size', 'checksum']
+    if args.query == 'images':
+        rows = []
+        for pool in pools or [None]:
+            rows.extend(catalog.get_images(conn, pool=pool))
+        for row in rows:
+            if row['backed_up']:
+                row['backed_up'] = time.strftime(
+                    '%Y-%m-%d %H:%M', time.localtime(row['backed_up']))
+        print(history.format_rows(rows, ['pool', 'image', 'generations',
+                                         'files', 'newest_snap',
+                                         'newest_generation', 'backed_up',
+                                         'allocated_size']))
+    elif args.query == 'generations':
+        print(history.format_rows(
+            catalog.get_generations(conn, args.image, pool=pools[0]),
+            file_columns))
+    elif args.query == 'latest':
+        print(history.format_rows(
+            catalog.get_latest(conn, args.image, pool=pools[0]),
+            file_columns))
+    conn.close()
+
+
+# entry to report and remove backup dirs with no data left
+def ceph_rsnapshot_reclaim():
+    parser = argparse.ArgumentParser(description='report and remove the'
+                                     ' backup dirs of orphans with no data'
+                                     ' left in any generation')
+    parser.add_argument("-c", "--config", required=False,
+                        help="path to alternate config file")
+    parser.add_argument('-p', '--pools', required=False,
+                        help='comma separated list of pools to look in,'
+                        ' instead of POOLS')
+    parser.add_argument("--dry_run", action='store_true',
+                        help="only report what would be removed")
+    args = parser.parse_args()
+
+    if args.config:
+        settings.load_settings(args.config)
+    else:
+        settings.load_settings()
+    if args.pools:
+        settings.POOLS = args.pools
+    logs.setup_logging()
+    rows = []
+    for pool in [pool for pool in settings.POOLS.split(',') if pool]:
+        settings.POOL = pool
+        backup_path = '%s/%s' % (settings.BACKUP_BASE_PATH, pool)
+        if not os.path.isdir(backup_path):
+            continue
+        # so no backup run rotates or syncs into a dir while it is removed
+        try:
+            pool_locks = locks.lock_pool(pool)
+        except exceptions.LockHeldError as e:
+            e.log()
+            rows.append({'image': '%s/*' % pool,
+                         'action': 'skipped, pool is locked'})
+            continue
+        try:
+            # only orphans, like reclaim_orphans: an image still on the ceph
+            # node gets a new generation on its next backup
+            try:
+                names_on_source = ceph.gathernames(pool=pool)
+            except Exception as e:
+                rows.append({'image': '%s/*' % pool,
+                             'action': 'skipped, cannot list images on ceph'
+                             ' node: %s' % e})
+                continue
+            orphans = [image for image in os.listdir(backup_path) if image
+                       not in names_on_source]
+            for image in sorted(rotate.get_rotated_out(orphans, pool=pool)):
+                action = 'would remove'
+                if not args.dry_run:
+                    try:
+                        rotate.reclaim(image, pool=pool)
+                        action = 'removed'
+                    except (IOError, OSError) as e:
+                        action = 'failed: %s' % e
+                    update_catalog(image, pool=pool, image_phase=False)
+                rows.append({'image': '%s/%s' % (pool, image),
+                             'action': action})
+        finally:
+            locks.release(pool_locks)
+    connections.close_all()
+    if rows:
+        print(history.format_rows(rows, ['image', 'action']))
+    else:
+        print('no orphan backup dirs without data')
+
+
+# entry to restore exports from the chunk store, and to gc or report on it
+def ceph_rsnapshot_chunks():
+    parser = argparse.ArgumentParser(description='restore exports from the'
+                                     ' ceph_rsnapshot chunk store, or gc or'
+                                     ' report on it')
+    parser.add_argument("-c", "--config", required=False,
+                        help="path to alternate config file")
+    parser.add_argument("--store", required=False,
+                        help="path to the chunk store, instead of"
+                        " CHUNK_STORE_PATH")
+    subparsers = parser.add_subparsers(dest='command')
+    # python 3 makes subcommands optional by default
+    subparsers.required = True
+    restore_parser = subparsers.add_parser(
+        'restore', help='write the export of a manifest to a file or stdout')
+    restore_parser.add_argument('manifest')
+    restore_parser.add_argument('-o', '--output', required=False,
+                                help='file to restore to, instead of stdout')
+    gc_parser = subparsers.add_parser(
+        'gc', help='remove chunks no generation refers to any more')
+    gc_parser.add_argument("--dry_run", action='store_true',
+                           help="only report what would be removed")
+    subparsers.add_parser('stats', help='report the size of the exports'
+                          ' against that of the chunk store')
+    args = parser.parse_args()
+
+    if args.config:
+        settings.load_settings(args.config)
+    else:
+        settings.load_settings()
+    store_path = args.store or chunkstore.get_store_path()
+    try:
+        if args.command == 'restore':
+            if args.output:
+                with open(args.output, 'wb') as target:
+                    chunkstore.restore(args.manifest, target,
+                                       store_path=store_path)
+            else:
+                chunkstore.restore(args.manifest,
+                                   getattr(sys.stdout, 'buffer', sys.stdout),
+                                   store_path=store_path)
+        elif args.command == 'gc':
+            logs.setup_logging()
+            with locks.lock_chunk_store(store_path, timeout=None):
+                removed = chunkstore.gc(dry_run=args.dry_run,
+                                        store_path=store_path)
+            print('%s %s chunks, %s bytes' % (
+                'would remove' if args.dry_run else 'removed',
+                removed['chunks'], removed['bytes']))
+        elif args.command == 'stats':
+            stats = chunkstore.get_store_stats(store_path=store_path)
+            ratio = 0.0
+            if stats['stored_bytes']:
+                ratio = float(stats['logical_bytes']) / stats['stored_bytes']
+            stats['dedup_ratio'] = '%.2f' % ratio
+            print(history.format_rows([stats], ['manifests', 'logical_bytes',
+                                                'chunks', 'stored_bytes',
+                                                'dedup_ratio']))
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('error with chunk store %s: %s\n' % (store_path, e))
+        sys.exit(1)
+
+
+def add_pool_result(all_result, pool_result):
+    """ append the lists of a pool's result to those of the run
+    """
+    for key in pool_result:
+        # they are all arrays so append
+        # but we need to make the array first if not yet there
+        if key not in all_result:
+            all_result[key] = []
+        all_result[key].extend(pool_result[key])
+
+
+def get_cluster_args(args):
+    """ the ceph_rsnapshot args of this run to pass on to the run of each
+        of CLUSTER_CONFIGS
+    """
+    cluster_args = []
+    for arg in CLUSTER_ARGS:
+        if args.__contains__(arg):
+            cluster_args.append('--%s=%s' % (arg, getattr(args, arg)))
+    for flag in CLUSTER_FLAGS:
+        if args.__contains__(flag) and getattr(args, flag):
+            cluster_args.append('--%s' % flag)
+    return cluster_args
+
+
+def check_cluster_configs(config_files):
+    """ raise NameError if two of config_files export qcows to the same
+        QCOW_TEMP_PATH on the same ceph node, as each run's free space
+        ledger only knows of its own exports, or share a chunk store but
+        not a BACKUP_BASE_PATH, as gc only keeps the chunks of the manifests
+        in its own
+    """
+    temp_paths = {}
+    store_paths = {}
+    for config_file in config_files:
+        if not os.path.isfile(config_file):
+            raise NameError('cluster config %s not found' % config_file)
+        config = settings.read_settings(config_file)
+        if config['CHUNK_STORE']:
+            backup_base_path = os.path.normpath(config['BACKUP_BASE_PATH'])
+            store_path = os.path.normpath(
+                config['CHUNK_STORE_PATH'] or
+                '%s/.chunk_store' % config['BACKUP_BASE_PATH'])
+            if (store_path in store_paths and
+                    store_paths[store_path][1] != backup_base_path):
+                raise NameError('cluster configs %s and %s share the chunk'
+                                ' store %s but not a backup_base_path, give'
+                                ' each its own chunk_store_path' %
+                                (store_paths[store_path][0], config_file,
+                                 store_path))
+            store_paths[store_path] = (config_file, backup_base_path)
+        if config['EXPORT_MODE'] != 'qcow':
+            continue
+        temp_path = (config['CEPH_HOST'],
+                     os.path.normpath(config['QCOW_TEMP_PATH']))
+        if temp_path in temp_paths:
+            raise NameError('cluster configs %s and %s both export qcows to'
+                            ' %s on ceph host %s, give each its own'
+                            ' qcow_temp_path' % (temp_paths[temp_path],
+                                                 config_file, temp_path[1],
+                                                 temp_path[0]))
+        temp_paths[temp_path] = config_file
+
+
+def run_cluster(config_file, cluster_args):
+    """ back up the cluster of config_file in its own ceph_rsnapshot
+        process. returns its exit status
+    """
+    logger = logs.get_logger()
+    logger.info('starting run of cluster config %s' % config_file)
+    started = time.time()
+    # --cluster_configs= so its own config can't start the clusters again
+    status = subprocess.call([sys.executable, '-m', 'ceph_rsnapshot.cli',
+                              '--config=%s' % config_file,
+                              '--cluster_configs='] + cluster_args)
+    log = logger.info if status == 0 else logger.error
+    log('run of cluster config %s exited %s after %.0fs' %
+        (config_file, status, time.time() - started))
+    return status
+
+
+def run_clusters(config_files, cluster_args, num_workers=None):
+    """ run each of config_files at once, or num_workers at a time if that
+        is not 0. returns the exit status of each run, 1 for one killed by
+        a signal
+    """
+    logger = logs.get_logger()
+    if num_workers is None:
+        num_workers = settings.CLUSTER_WORKERS
+    if num_workers <= 0:
+        num_workers = len(config_files)
+    num_workers = min(num_workers, len(config_files))
+    logger.info('running %s cluster configs with %s at once: %s' % (
+        len(config_files), num_workers, ', '.join(config_files)))
+    statuses = [None] * len(config_files)
+    work_queue = queue.Queue()
+    for index, config_file in enumerate(config_files):
+        work_queue.put((index, config_file))
+
+    def worker():
+        while True:
+            try:
+                index, config_file = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                statuses[index] = run_cluster(config_file, cluster_args)
+            except Exception as e:
+                logger.error('error running cluster config %s' % config_file)
+                logger.exception(e)
+                statuses[index] = 1
+
+    workers = [threading.Thread(target=worker, name='cluster-worker-%s' % n)
+               for n in range(num_workers)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+    # killed by a signal is a negative status
+    return [status if status >= 0 else 1 for status in statuses]
+
+
+def write_clusters_status(config_files, statuses):
+    """ write the status of the runs of config_files, from their exit
+        statuses, to LOG_BASE_PATH/STATUS_FILENAME. each run writes its own
+        status and history in the LOG_BASE_PATH of its config
+    """
+    status_file = open("%s/%s" % (settings.LOG_BASE_PATH,
+                                  settings.STATUS_FILENAME), 'w')
+    failed = [status for status in statuses if status not in [0, 2]]
+    if failed:
+        status_file.write('CRITICAL some cluster runs failed|')
+    elif 2 in statuses:
+        status_file.write('WARNING all cluster runs backed up their rbd'
+                          ' devices but some orphans failed to rotate|')
+    else:
+        status_file.write('OK all cluster runs completed successfully|')
+    status_file.write('num_clusters=%s num_failed=%s num_warning=%s ' % (
+        len(statuses), len(failed), statuses.count(2)))
+    status_file.write('%s ' % ' '.join([
+        "'%s'=%s" % (config_file, status) for config_file, status in
+        zip(config_files, statuses)]))
     status_file.close()
 
 
@@ -408,6 +1261,9 @@ def ceph_rsnapshot():
                         required=False, help="keep conf files after run")
     parser.add_argument("-e", "--extralongargs", required=False,
                         help="extra long args for rsync of format foo,bar for arg --foo --bar")
+    parser.add_argument("--cluster_configs", required=False,
+                        help="comma separated config files of ceph clusters"
+                        " to back up at once, each in its own process")
     # TODO add param options:
     # to show names on source only
     args = parser.parse_args()
@@ -442,6 +1298,8 @@ def ceph_rsnapshot():
         settings.IMAGE_RE = args.image_re
     if args.__contains__('no_rotate_orphans'):
         settings.NO_ROTATE_ORPHANS = args.no_rotate_orphans
+    if args.__contains__('cluster_configs'):
+        settings.CLUSTER_CONFIGS = args.cluster_configs
 
     logger = logs.setup_logging()
     logger.info("starting ceph_rsnapshot")
@@ -453,6 +1311,119 @@ def ceph_rsnapshot():
         logger.error('error with settings strings: %s' % e)
         sys.exit(1)
 
+    # back up each cluster in its own run of this, with its own config
+    if settings.CLUSTER_CONFIGS:
+        config_files = [config_file for config_file in
+                        settings.CLUSTER_CONFIGS.split(',') if config_file]
+        try:
+            check_cluster_configs(config_files)
+        except NameError as e:
+            logger.error(e)
+            sys.exit(1)
+        statuses = run_clusters(config_files, get_cluster_args(args))
+        if settings.NOOP:
+            logger.info('NOOP: would have written the status of the cluster'
+                        ' runs')
+        else:
+            write_clusters_status(config_files, statuses)
+        sys.exit(max(statuses))
+
+    if settings.EXPORT_MODE not in ceph.EXPORT_MODES:
+        logger.error('unsupported export_mode %s, must be one of %s' %
+                     (settings.EXPORT_MODE, ', '.join(ceph.EXPORT_MODES)))
+        sys.exit(1)
+    if settings.STREAM_FORMAT not in ceph.STREAM_FORMATS:
+        logger.error('unsupported stream_format %s, must be one of %s' %
+                     (settings.STREAM_FORMAT, ', '.join(ceph.STREAM_FORMATS)))
+        sys.exit(1)
+    if settings.INCREMENTAL and (settings.EXPORT_MODE != 'stream' or
+                                 settings.STREAM_FORMAT != 'raw'):
+        logger.error('incremental needs export_mode stream and stream_format'
+                     ' raw')
+        sys.exit(1)
+    if settings.ROTATION_ENGINE not in rotate.ROTATION_ENGINES:
+        logger.error('unsupported rotation_engine %s, must be one of %s' %
+                     (settings.ROTATION_ENGINE,
+                      ', '.join(rotate.ROTATION_ENGINES)))
+        sys.exit(1)
+    if settings.SCHEDULE not in schedule.SCHEDULES:
+        logger.error('unsupported schedule %s, must be one of %s' %
+                     (settings.SCHEDULE, ', '.join(schedule.SCHEDULES)))
+        sys.exit(1)
+    if (settings.CATALOG_CHECKSUM and
+            settings.CATALOG_CHECKSUM not in catalog.CHECKSUMS):
+        logger.error('unsupported catalog_checksum %s, must be one of %s or'
+                     ' empty' % (settings.CATALOG_CHECKSUM,
+                                 ', '.join(catalog.CHECKSUMS)))
+        sys.exit(1)
+    if settings.DELTA_SYNC and (settings.EXPORT_MODE != 'stream' or
+                                settings.STREAM_FORMAT != 'raw'):
+        # qemu-img lays out the clusters of each night's qcow2 differently,
+        # so its blocks hardly ever match at the same offsets
+        logger.error('delta_sync needs export_mode stream and stream_format'
+                     ' raw')
+        sys.exit(1)
+    if settings.DELTA_SYNC and settings.ROTATION_ENGINE != 'native':
+        # rsnapshot copies the backup script's output into the new
+        # generation, writing the whole file and losing the shared extents
+        logger.error('delta_sync needs rotation_engine native')
+        sys.exit(1)
+    if settings.DELTA_SYNC and not settings.NOOP:
+        # without reflinks each new file would be a full copy of the last
+        try:
+            reflink_ok = reflink.supports_reflink(
+                dirs.get_existing_parent(settings.BACKUP_BASE_PATH))
+        except (IOError, OSError) as e:
+            logger.error('cannot check for reflinks in %s: %s' %
+                         (settings.BACKUP_BASE_PATH, e))
+            reflink_ok = False
+        if not reflink_ok:
+            logger.error('delta_sync needs BACKUP_BASE_PATH on a filesystem'
+                         ' that supports reflinks, like btrfs or xfs with'
+                         ' reflink=1')
+            sys.exit(1)
+    if settings.CHUNK_STORE and (settings.INCREMENTAL or
+                                 settings.DELTA_SYNC):
+        logger.error('chunk_store does not work with incremental or'
+                     ' delta_sync')
+        sys.exit(1)
+    try:
+        pool_compression = compression.parse_pool_compression()
+    except NameError as e:
+        logger.error(e)
+        sys.exit(1)
+    for pool, (method, level, threads) in [('', (
+            settings.COMPRESSION, settings.COMPRESSION_LEVEL,
+            settings.COMPRESSION_THREADS))] + sorted(pool_compression.items()):
+        if method and method not in compression.COMPRESSION_METHODS:
+            logger.error('unsupported compression %s, must be one of %s or'
+                         ' empty' % (method,
+                                     ', '.join(compression.COMPRESSION_METHODS)))
+            sys.exit(1)
+        if method == 'qcow2' and settings.EXPORT_MODE == 'stream' and \
+                settings.STREAM_FORMAT != 'qcow2':
+            logger.error('compression qcow2 needs stream_format qcow2 in'
+                         ' export_mode stream')
+            sys.exit(1)
+        if method and (threads < 1 or level < 1 or level > 22):
+            logger.error('compression_threads must be at least 1 and'
+                         ' compression_level from 1 to 22')
+            sys.exit(1)
+    try:
+        throttle.parse_windows()
+    except NameError as e:
+        logger.error(e)
+        sys.exit(1)
+    if settings.CEPH_BACKEND not in backends.BACKENDS:
+        logger.error('unsupported ceph_backend %s, must be one of %s' %
+                     (settings.CEPH_BACKEND, ', '.join(backends.BACKENDS)))
+        sys.exit(1)
+    if (settings.INCREMENTAL and
+            not backends.get_backend().supports_export_diff):
+        logger.error('incremental is not supported by the %s ceph backend' %
+                     settings.CEPH_BACKEND)
+        sys.exit(1)
+
 
     # print out settings using and exit
     if args.__contains__('printsettings'):
@@ -462,31 +1433,23 @@ def ceph_rsnapshot():
         else:
             # convert snap_date (might be relative) to an absolute date
             # so that it's only computed once for this entire run
-            settings.SNAP_DATE = sh.date(date=settings.SNAP_DATE).strip('\n')
+            settings.SNAP_DATE = dates.get_absolute_date(settings.SNAP_DATE)
         # if it's there it's true
         logger.info('settings would have been:\n')
         logger.info(json.dumps(helpers.get_current_settings(), indent=2))
         logger.info('exiting')
         sys.exit(0)
 
-    # write lockfile
-    # TODO do this per ceph host or per ceph cluster
-    # http://stackoverflow.com/a/789383/5928049
-    pid = str(os.getpid())
-    pidfile = "/var/run/ceph_rsnapshot_cephhost_%s.pid" % settings.CEPH_HOST
-    if os.path.isfile(pidfile):
-        logger.error("pidfile %s already exists, exiting" % pidfile)
-        sys.exit(1)
-    logger.info("writing lockfile at %s" % pidfile)
-    file(pidfile, 'w').write(pid)
-
     logger.debug('running with settings:\n')
     logger.debug(json.dumps(helpers.get_current_settings(), indent=2))
 
+    # each pool is locked as it is backed up, instead of the whole run, so
+    # runs of other pools and clusters can go at once
+    chunk_store_lock = None
     try:
-        # we've made the lockfile, so rsnap the pools
         # clear this so we know if run worked or not
         all_result={}
+        run_started = time.time()
 
         # check if we have been passed SNAP_STATUS_FILE
         if settings.USE_SNAP_STATUS_FILE:
@@ -508,7 +1471,13 @@ def ceph_rsnapshot():
         # convert snap_date (might be relative) to an absolute date
         # so that it's only computed once for this entire run
         # FIXME does this need snap naming format
-        settings.SNAP_DATE = sh.date(date=settings.SNAP_DATE).strip('\n')
+        settings.SNAP_DATE = dates.get_absolute_date(settings.SNAP_DATE)
+
+        # keep other runs' chunk store gc from removing chunks stored by
+        # this run before their manifests are written
+        if settings.CHUNK_STORE and not settings.NOOP:
+            chunk_store_lock = locks.lock_chunk_store(
+                chunkstore.get_store_path(), shared=True, timeout=None)
 
         # iterate over pools
         pools_csv = settings.POOLS
@@ -522,36 +1491,51 @@ def ceph_rsnapshot():
             # store this pool in settings for other functions to access it
             settings.POOL = pool
 
-            # setup directories for this pool
-            dirs.setup_log_dirs_for_pool(pool)
-            dirs.setup_temp_conf_dir_for_pool(pool)
-            dirs.setup_backup_dirs_for_pool(pool)
-
-            # connect to ceph node and setup qcow export path
-            dirs.setup_qcow_temp_path(pool)
+            # skip the pool if another run is backing it up, from this ceph
+            # node or into this backup dir
+            try:
+                pool_locks = locks.lock_pool(pool)
+            except exceptions.LockHeldError as e:
+                e.log()
+                add_pool_result(all_result, {
+                    'successful': [], 'failed': [], 'orphans_rotated': [],
+                    'orphans_failed_to_rotate': [], 'orphans_reclaimed': [],
+                    'pools_locked': [pool]})
+                continue
 
             try:
-                # TODO pass args here instead of in settings?
-                pool_result = rsnap_pool(pool)
-                # now append to all_result
-                for key in pool_result:
-                    # they are all arrays so append
-                    # but we need to make the array first if not yet there
-                    if not all_result.has_key(key):
-                        all_result[key]=[]
-                    # now append
-                    all_result[key].extend(pool_result[key])
-            except NameError as e:
-                # TODO get some way to still have the list of images that
-                # it completed before failing
-                logger.error('rsnap pool %s failed error: %s' % (pool, e))
-                logger.exception(e)
-            except Exception as e:
-                logger.error('error with pool %s' % pool)
-                logger.exception(e)
-            logger.info('done with pool %s' % pool)
-            if not settings.KEEPCONF:
-                dirs.remove_temp_conf_dir()
+                # setup directories for this pool
+                dirs.setup_log_dirs_for_pool(pool)
+                dirs.setup_temp_conf_dir_for_pool(pool)
+                dirs.setup_backup_dirs_for_pool(pool)
+
+                # connect to ceph node and setup qcow export path
+                dirs.setup_qcow_temp_path(pool)
+
+                try:
+                    # TODO pass args here instead of in settings?
+                    pool_result = rsnap_pool(pool)
+                    # now append to all_result
+                    add_pool_result(all_result, pool_result)
+                except NameError as e:
+                    # TODO get some way to still have the list of images that
+                    # it completed before failing
+                    logger.error('rsnap pool %s failed error: %s' % (pool, e))
+                    logger.exception(e)
+                except Exception as e:
+                    logger.error('error with pool %s' % pool)
+                    logger.exception(e)
+                logger.info('done with pool %s' % pool)
+                if not settings.KEEPCONF:
+                    dirs.remove_temp_conf_dir()
+            finally:
+                locks.release(pool_locks)
+
+        if chunk_store_lock:
+            chunk_store_lock.release()
+        # now that every pool has rotated
+        gc_chunks()
+        compression.log_stats()
 
         # successful, so clean out snap dir
         snap_date = ceph.get_snapdate(snap_date=settings.SNAP_DATE)
@@ -574,15 +1558,30 @@ def ceph_rsnapshot():
         if all_result['orphans_rotated']:
             logger.info("orphans rotated:")
             logger.info(all_result['orphans_rotated'])
+        if all_result['orphans_reclaimed']:
+            logger.info("orphans reclaimed:")
+            logger.info(all_result['orphans_reclaimed'])
         if all_result['orphans_failed_to_rotate']:
             logger.error("orphans failed to rotate:")
             logger.error(all_result['orphans_failed_to_rotate'])
+        if all_result.get('pools_locked'):
+            logger.error("pools skipped, locked by another run:")
+            logger.error(all_result['pools_locked'])
         write_status(all_result)
+        metrics.write_textfile(all_result)
+        if settings.RECORD_HISTORY:
+            try:
+                history.record_run(all_result, started=run_started)
+            except Exception as e:
+                logger.error('error recording run in history database')
+                logger.exception(e)
         logger.info("done")
     finally:
-        # done with this pool so clear the pidfile
-        logger.info("removing lockfile at %s" % pidfile)
-        os.unlink(pidfile)
+        if chunk_store_lock:
+            chunk_store_lock.release()
+
+        # close ssh master connections to the ceph host
+        connections.close_all()
 
         if settings.NOOP:
             logger.info("end of NOOP run")
@@ -590,7 +1589,7 @@ def ceph_rsnapshot():
         # TODO should these still sys.exit or should they let the exceptions
         # go?
         if all_result:
-            if all_result['failed']:
+            if all_result['failed'] or all_result.get('pools_locked'):
                 sys.exit(1)
             elif all_result['orphans_failed_to_rotate']:
                 sys.exit(2)
@@ -600,3 +1599,7 @@ def ceph_rsnapshot():
             exit(3)
 
 # Nothing else down here - it all goes in the finally
+
+
+if __name__ == '__main__':
+    ceph_rsnapshot()
@@ -0,0 +1,233 @@
+# compression of exports on the ceph node: compressed qcow2 clusters in qcow
+# export mode, or zstd on the wire in stream export mode. keeps the ratio and
+# cpu time of each image for the run's report
+import glob
+import os
+import re
+import threading
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import catalog
+
+
+COMPRESSION_METHODS = ['qcow2', 'zstd']
+
+# bash time output of the compressing command, and the byte counts of its
+# input and output, on stderr of the ceph node commands
+TIME_FORMAT = 'ceph_rsnapshot_cpu %3U %3S'
+CPU_RE = re.compile(r'ceph_rsnapshot_cpu ([0-9.]+) ([0-9.]+)')
+BYTES_RE = re.compile(r'ceph_rsnapshot_(raw|compressed)_bytes ([0-9]+)')
+# stderr of the stream from the ceph node, kept in the generation
+STATS_SUFFIX = '.compression'
+# zstd levels above this need --ultra
+ZSTD_MAX_LEVEL = 19
+# qemu-img convert runs at most this many coroutines
+QEMU_IMG_MAX_COROUTINES = 16
+
+# raw bytes, compressed bytes and cpu seconds by (pool, image) for this run,
+# guarded by _lock since image workers record them concurrently
+_lock = threading.Lock()
+_images = {}
+
+
+def parse_pool_compression(value=None):
+    """ the per pool overrides in COMPRESSION_POOLS, comma separated
+        pool:method[:level[:threads]], as (method, level, threads) by pool.
+        raises NameError if an entry is malformed
+    """
+    if value is None:
+        value = settings.COMPRESSION_POOLS
+    overrides = {}
+    for entry in [entry for entry in value.split(',') if entry]:
+        fields = entry.split(':')
+        if len(fields) < 2 or len(fields) > 4 or not fields[0]:
+            raise NameError('compression_pools entry %s is not'
+                            ' pool:method[:level[:threads]]' % entry)
+        try:
+            level = int(fields[2]) if len(fields) > 2 else \
+                settings.COMPRESSION_LEVEL
+            threads = int(fields[3]) if len(fields) > 3 else \
+                settings.COMPRESSION_THREADS
+        except ValueError:
+            raise NameError('compression_pools entry %s has a level or'
+                            ' threads that is not a number' % entry)
+        overrides[fields[0]] = (fields[1], level, threads)
+    return overrides
+
+
+def get_compression(pool=''):
+    """ (method, level, threads) to export pool with, method '' for none
+    """
+    if not pool:
+        pool = settings.POOL
+    overrides = parse_pool_compression()
+    if pool in overrides:
+        return overrides[pool]
+    return (settings.COMPRESSION, settings.COMPRESSION_LEVEL,
+            settings.COMPRESSION_THREADS)
+
+
+def get_qemu_img_args(pool=''):
+    """ qemu-img convert args that compress the qcow2 clusters, in as many
+        coroutines as threads, with zstd instead of zlib for method zstd.
+        qemu-img has no compression level, so level is not used, and won't
+        write out of order (-W) while compressing
+    """
+    method, level, threads = get_compression(pool)
+    if not method:
+        return ''
+    args = '-c -m %s' % max(1, min(threads, QEMU_IMG_MAX_COROUTINES))
+    if method == 'zstd':
+        args += ' -o compression_type=zstd'
+    return args
+
+
+def get_timed_command(command):
+    """ command for bash, writing its cpu time to stderr after it
+    """
+    return 'TIMEFORMAT="%s"; time %s' % (TIME_FORMAT, command)
+
+
+def get_bash_command(command):
+    """ command run with bash -c, for the bash only time keyword and
+        process substitution on ceph nodes whose login shell may not be bash.
+        adds no single quotes, so it can go in the single quoted remote
+        commands of the stream scripts
+    """
+    return 'bash -c "%s"' % re.sub(r'(["\\$`])', r'\\\1', command)
+
+
+def get_stream_commands(pool=''):
+    """ (compress, decompress) commands to put either side of the stream in
+        stream export mode, ('', '') if not compressing it with zstd
+    """
+    method, level, threads = get_compression(pool)
+    if method != 'zstd':
+        return '', ''
+    ultra = ''
+    if level > ZSTD_MAX_LEVEL:
+        ultra = ' --ultra'
+    return ('zstd -q -c -T%s%s -%s' % (threads, ultra, level),
+            'zstd -q -d -c')
+
+
+def get_byte_count(name):
+    """ bash process substitution for tee that writes the bytes through it
+        to stderr
+    """
+    return '>(wc -c | sed "s/^/ceph_rsnapshot_%s_bytes /" >&2)' % name
+
+
+def get_compressed_stream_command(export_command, pool=''):
+    """ export_command with its output compressed on the ceph node, writing
+        the cpu time of the compression and the bytes before and after it to
+        stderr
+    """
+    compress, decompress = get_stream_commands(pool)
+    if not compress:
+        return export_command
+    return get_bash_command(
+        'set -o pipefail; %s | tee %s | { %s; } | tee %s' % (
+            export_command, get_byte_count('raw'),
+            get_timed_command(compress), get_byte_count('compressed')))
+
+
+def parse_stats(output):
+    """ (cpu seconds, raw bytes, compressed bytes) from the stderr of
+        compressing commands, the byte counts None if it has none
+    """
+    cpu_seconds = 0.0
+    for user, system in CPU_RE.findall(output):
+        cpu_seconds += float(user) + float(system)
+    counts = {'raw': None, 'compressed': None}
+    for name, count in BYTES_RE.findall(output):
+        counts[name] = int(count)
+    return cpu_seconds, counts['raw'], counts['compressed']
+
+
+def record(image, pool='', raw_bytes=0, compressed_bytes=0, cpu_seconds=0.0):
+    """ add to the raw and compressed bytes and cpu seconds of image
+    """
+    if not pool:
+        pool = settings.POOL
+    with _lock:
+        sample = _images.setdefault((pool, image), {
+            'raw_bytes': 0, 'compressed_bytes': 0, 'cpu_seconds': 0.0})
+        sample['raw_bytes'] += raw_bytes
+        sample['compressed_bytes'] += compressed_bytes
+        sample['cpu_seconds'] += cpu_seconds
+
+
+def record_generation(image, generation_dir, pool='', raw_bytes=0):
+    """ record what compressing the export in generation_dir came to: from
+        its stream stats file in stream export mode, else from the size of
+        its qcow against raw_bytes. returns the image's sample, or None if
+        the pool is not compressed
+    """
+    if not pool:
+        pool = settings.POOL
+    if not get_compression(pool)[0]:
+        return None
+    exports = [path for suffix in ['.raw', '.qcow2'] for path in
+               glob.glob('%s/*%s' % (generation_dir, suffix))]
+    cpu_seconds = 0.0
+    compressed_bytes = None
+    stats_files = glob.glob('%s/*%s' % (generation_dir, STATS_SUFFIX))
+    if stats_files:
+        with open(stats_files[0]) as f:
+            cpu_seconds, stream_bytes, compressed_bytes = parse_stats(
+                f.read())
+        # the stream's own bytes, else the export's virtual size for
+        # compressed qcow2 clusters converted on this node
+        raw_bytes = stream_bytes or sum([catalog.get_format(path)[1] for
+                                         path in exports])
+    if compressed_bytes is None:
+        compressed_bytes = sum([os.path.getsize(path) for path in exports])
+    record(image, pool=pool, raw_bytes=raw_bytes,
+           compressed_bytes=compressed_bytes, cpu_seconds=cpu_seconds)
+    return get_image_stats(image, pool=pool)
+
+
+def get_image_stats(image, pool=''):
+    if not pool:
+        pool = settings.POOL
+    with _lock:
+        return dict(_images.get((pool, image), {}))
+
+
+def get_stats():
+    """ raw and compressed bytes, cpu seconds and images of each pool
+    """
+    stats = {}
+    with _lock:
+        for (pool, image), sample in _images.items():
+            pool_stats = stats.setdefault(pool, {
+                'images': 0, 'raw_bytes': 0, 'compressed_bytes': 0,
+                'cpu_seconds': 0.0})
+            pool_stats['images'] += 1
+            for key in ['raw_bytes', 'compressed_bytes', 'cpu_seconds']:
+                pool_stats[key] += sample[key]
+    return stats
+
+
+def get_ratio(sample):
+    if not sample.get('compressed_bytes'):
+        return 0.0
+    return float(sample['raw_bytes']) / sample['compressed_bytes']
+
+
+def format_stats(sample):
+    return ('%s bytes to %s, ratio %.2f, %.1f cpu seconds' %
+            (sample['raw_bytes'], sample['compressed_bytes'],
+             get_ratio(sample), sample['cpu_seconds']))
+
+
+def log_stats():
+    """ log the compression ratio and cpu time of each pool this run
+    """
+    logger = logs.get_logger()
+    stats = get_stats()
+    for pool in sorted(stats):
+        logger.info('compression of pool %s: %s images, %s' % (
+            pool, stats[pool]['images'], format_stats(stats[pool])))
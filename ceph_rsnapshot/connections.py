@@ -0,0 +1,114 @@
+# persistent multiplexed ssh connections to the ceph node(s)
+import hashlib
+import os
+import threading
+
+import sh
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+
+
+# per cephhost counters, guarded by _lock since image workers can share them
+_lock = threading.Lock()
+_connections = {}
+
+
+def get_control_path(cephhost, control_dir=''):
+    """ path of the ssh ControlMaster socket for this cephhost, one per
+        process so a run closing its master doesn't cut off another run's.
+        cephhost is hashed, as ssh's %C is, to keep long host names within
+        the 108 bytes of a unix socket path
+    """
+    if not control_dir:
+        control_dir = settings.SSH_CONTROL_DIR
+    return '%s/ceph_rsnapshot_%s_%s.sock' % (
+        control_dir, hashlib.sha1(cephhost.encode('utf-8')).hexdigest()[:16],
+        os.getpid())
+
+
+def get_ssh_options(cephhost):
+    """ list of ssh -o options to multiplex commands over one master
+        connection for this cephhost. empty if multiplexing is disabled
+    """
+    if not multiplexing_enabled():
+        return []
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % get_control_path(cephhost),
+            '-o', 'ControlPersist=%s' % settings.SSH_CONTROL_PERSIST]
+
+
+def multiplexing_enabled():
+    """ multiplex only if enabled and we have somewhere to put the sockets
+    """
+    logger = logs.get_logger()
+    if not settings.SSH_MULTIPLEX:
+        return False
+    control_dir = settings.SSH_CONTROL_DIR
+    if os.path.isdir(control_dir):
+        return True
+    if settings.NOOP:
+        # don't make directories on noop, just use plain ssh
+        return False
+    logger.info('creating ssh control dir %s' % control_dir)
+    try:
+        os.makedirs(control_dir, 0o700)
+    except OSError as e:
+        # might have raced with another worker making it
+        if not os.path.isdir(control_dir):
+            logger.warning('cannot create ssh control dir %s, not'
+                           ' multiplexing ssh: %s' % (control_dir, e))
+            return False
+    return True
+
+
+def ssh(cephhost, command):
+    """ run a command on cephhost over the multiplexed master connection,
+        opening the master if there is none yet. drop in for
+        sh.ssh(cephhost, command) and raises the same sh errors
+    """
+    logger = logs.get_logger()
+    ssh_options = get_ssh_options(cephhost)
+    with _lock:
+        stats = _connections.setdefault(cephhost,
+                                        {'commands': 0, 'handshakes': 0})
+        stats['commands'] += 1
+        # no socket means this command will do a full handshake and become
+        # the master (or the master timed out from ControlPersist)
+        if not ssh_options or not os.path.exists(
+                get_control_path(cephhost)):
+            stats['handshakes'] += 1
+            if ssh_options:
+                logger.debug('opening ssh master connection to %s' % cephhost)
+    return sh.ssh(*(ssh_options + [cephhost, command]))
+
+
+def get_stats():
+    """ copy of the per cephhost command and handshake counters
+    """
+    with _lock:
+        return dict((cephhost, dict(stats, saved=stats['commands'] -
+                                    stats['handshakes']))
+                    for cephhost, stats in _connections.items())
+
+
+def close_all():
+    """ close all master connections and log how many handshakes they saved
+    """
+    logger = logs.get_logger()
+    for cephhost, stats in get_stats().items():
+        logger.info('ssh to %s: %s commands with %s handshakes, saved %s'
+                    ' handshakes' % (cephhost, stats['commands'],
+                                     stats['handshakes'], stats['saved']))
+        control_path = get_control_path(cephhost)
+        if not os.path.exists(control_path):
+            continue
+        try:
+            sh.ssh('-o', 'ControlPath=%s' % control_path, '-O', 'exit',
+                   cephhost)
+        except sh.ErrorReturnCode as e:
+            logger.warning('error closing ssh master connection to %s: %s' %
+                           (cephhost,
+                            e.stderr.decode('utf-8', 'replace').strip('\n')))
+    with _lock:
+        _connections.clear()
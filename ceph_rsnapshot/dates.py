@@ -0,0 +1,108 @@
+# in process snap date resolution, instead of running `date` every time
+import datetime
+import re
+import threading
+import time
+
+import sh
+
+
+# format used to pin a relative SNAP_DATE to an absolute one for the run
+ABSOLUTE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# `date --date` expressions we resolve ourselves, anything else goes to date
+RELATIVE_DATE_RE = re.compile(
+    r'^(?P<sign>[+-])?\s*(?P<count>[0-9]+)\s+'
+    r'(?P<unit>sec|second|min|minute|hour|day|week|fortnight)s?'
+    r'(?P<ago>\s+ago)?$')
+ABSOLUTE_DATE_RE = re.compile(
+    r'^(?P<year>[0-9]{4})-(?P<month>[0-9]{1,2})-(?P<day>[0-9]{1,2})'
+    r'(?:[ T](?P<hour>[0-9]{1,2}):(?P<minute>[0-9]{2})'
+    r'(?::(?P<second>[0-9]{2}))?)?$')
+
+UNIT_SECONDS = dict(sec=1, second=1, min=60, minute=60, hour=3600)
+UNIT_DAYS = dict(day=1, week=7, fortnight=14)
+
+# leave formats with date only extensions (%N, %:z), time zones or locale
+# dependent names to date so the output is always the same as date's
+DATE_FALLBACK_FORMAT_RE = re.compile(r'%[-_0^#]*[0-9]*[:]*[NzZaAbBhcxXpPrEO+]')
+
+# memoized formatted dates for this run, keyed by (date format, date string)
+_lock = threading.Lock()
+_formatted_dates = {}
+
+
+def resolve_date(date_string, now=None):
+    """ resolve a `date --date` string to a local datetime the way date does.
+        supports now/today/yesterday/tomorrow/empty, "N unit(s) [ago]" for
+        seconds through fortnights, and absolute YYYY-MM-DD [HH:MM[:SS]].
+        returns None for anything else
+    """
+    if now is None:
+        now = time.time()
+    date_string = ' '.join(date_string.lower().split())
+    now_datetime = datetime.datetime.fromtimestamp(int(now))
+    if date_string in ['now', 'today']:
+        return now_datetime
+    if date_string == '':
+        # date --date '' is the start of today
+        return now_datetime.replace(hour=0, minute=0, second=0)
+    if date_string == 'yesterday':
+        return now_datetime - datetime.timedelta(days=1)
+    if date_string == 'tomorrow':
+        return now_datetime + datetime.timedelta(days=1)
+    match = RELATIVE_DATE_RE.match(date_string)
+    if match:
+        count = int(match.group('count'))
+        if match.group('sign') == '-':
+            count = -count
+        if match.group('ago'):
+            count = -count
+        unit = match.group('unit')
+        if unit in UNIT_SECONDS:
+            # date counts these in elapsed seconds, across dst changes too
+            return datetime.datetime.fromtimestamp(
+                int(now) + count * UNIT_SECONDS[unit])
+        # and days in calendar days keeping the wall clock time
+        return now_datetime + datetime.timedelta(days=count * UNIT_DAYS[unit])
+    match = ABSOLUTE_DATE_RE.match(date_string)
+    if match:
+        try:
+            return datetime.datetime(
+                int(match.group('year')), int(match.group('month')),
+                int(match.group('day')), int(match.group('hour') or 0),
+                int(match.group('minute') or 0),
+                int(match.group('second') or 0))
+        except ValueError:
+            # not a real date, let date give the error
+            return None
+    return None
+
+
+def format_date(date_format, date_string):
+    """ date +date_format --date date_string, resolved in process when we
+        can and with date otherwise. memoized for the run. raises
+        sh.ErrorReturnCode from date for invalid dates
+    """
+    key = (date_format, date_string)
+    with _lock:
+        if key in _formatted_dates:
+            return _formatted_dates[key]
+    resolved = None
+    if not DATE_FALLBACK_FORMAT_RE.search(date_format):
+        resolved = resolve_date(date_string)
+    if resolved is not None and resolved.year >= 1900:
+        formatted = resolved.strftime(date_format)
+    else:
+        formatted = sh.date('+%s' % date_format,
+                            date=date_string).strip('\n')
+    with _lock:
+        _formatted_dates[key] = formatted
+    return formatted
+
+
+def get_absolute_date(date_string):
+    """ pin a possibly relative date string to an absolute one, so that it's
+        only computed once for the entire run
+    """
+    return format_date(ABSOLUTE_DATE_FORMAT, date_string)
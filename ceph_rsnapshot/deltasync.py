@@ -0,0 +1,162 @@
+# block level delta sync of raw stream exports against the previous
+# generation's file, on backup volumes that support reflinks
+import hashlib
+import os
+import struct
+import sys
+
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import reflink
+
+
+BLOCK_HASH = 'sha256'
+# block hash files start with this and the block size
+BLOCK_HASHES_HEADER = b'ceph_rsnapshot block hashes v1\n'
+BLOCK_HASHES_SUFFIX = '.blocks'
+
+
+def get_block_hashes_path(path):
+    return path + BLOCK_HASHES_SUFFIX
+
+
+def read_block(stream, block_size):
+    """ the next block_size bytes of stream, fewer only at its end
+    """
+    block = b''
+    while len(block) < block_size:
+        data = stream.read(block_size - len(block))
+        if not data:
+            break
+        block += data
+    return block
+
+
+def load_block_hashes(path, block_size):
+    """ the block hashes kept next to path, or None if there are none for
+        this block size
+    """
+    try:
+        with open(get_block_hashes_path(path), 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    header_length = len(BLOCK_HASHES_HEADER) + 8
+    if (not data.startswith(BLOCK_HASHES_HEADER) or
+            len(data) < header_length or
+            struct.unpack('>Q', data[len(BLOCK_HASHES_HEADER):
+                                     header_length])[0] != block_size):
+        return None
+    digest_size = hashlib.new(BLOCK_HASH).digest_size
+    return [data[offset:offset + digest_size] for offset in
+            range(header_length, len(data), digest_size)]
+
+
+def write_block_hashes(path, block_size, hashes):
+    temp_path = get_block_hashes_path(path) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(BLOCK_HASHES_HEADER + struct.pack('>Q', block_size))
+        f.write(b''.join(hashes))
+    os.rename(temp_path, get_block_hashes_path(path))
+
+
+def clone_file(source, target):
+    """ make target a reflink clone of source, sharing all its extents.
+        raises IOError if the filesystem can't clone, as a full copy would
+        write the whole file before a block is compared
+    """
+    target_dir = os.path.dirname(os.path.abspath(target))
+    if not reflink.supports_reflink(target_dir):
+        raise IOError('no reflinks on the filesystem of %s to delta sync'
+                      ' into' % target_dir)
+    reflink.clone(source, target)
+
+
+def delta_sync(stream, target_path, previous_path='', block_size=None):
+    """ write the contents of stream to target_path, starting from a copy of
+        previous_path and writing only the blocks whose strong hash differs
+        from that of the same block of previous_path. the block hashes of
+        target_path are kept next to it, so the next sync doesn't have to
+        read it. returns the block counts and bytes written
+    """
+    if block_size is None:
+        block_size = settings.DELTA_BLOCK_SIZE
+    previous_hashes = None
+    previous = None
+    if previous_path and os.path.isfile(previous_path):
+        clone_file(previous_path, target_path)
+        previous_hashes = load_block_hashes(previous_path, block_size)
+        if previous_hashes is None:
+            previous = open(previous_path, 'rb')
+    else:
+        previous_path = ''
+        open(target_path, 'wb').close()
+    stats = {'blocks': 0, 'changed_blocks': 0, 'bytes_written': 0}
+    hashes = []
+    offset = 0
+    try:
+        with open(target_path, 'r+b') as target:
+            while True:
+                block = read_block(stream, block_size)
+                if not block:
+                    break
+                digest = hashlib.new(BLOCK_HASH, block).digest()
+                hashes.append(digest)
+                previous_digest = None
+                if previous_hashes is not None:
+                    if stats['blocks'] < len(previous_hashes):
+                        previous_digest = previous_hashes[stats['blocks']]
+                elif previous is not None:
+                    previous.seek(offset)
+                    previous_digest = hashlib.new(
+                        BLOCK_HASH, previous.read(block_size)).digest()
+                if digest != previous_digest:
+                    stats['changed_blocks'] += 1
+                    # a new file is sparse already, so zeros need no write
+                    if previous_path or block.count(b'\0') != len(block):
+                        target.seek(offset)
+                        target.write(block)
+                        stats['bytes_written'] += len(block)
+                stats['blocks'] += 1
+                offset += len(block)
+            target.truncate(offset)
+    finally:
+        if previous is not None:
+            previous.close()
+    write_block_hashes(target_path, block_size, hashes)
+    return stats
+
+
+def format_stats(stats):
+    ratio = 0.0
+    if stats['blocks']:
+        ratio = float(stats['changed_blocks']) / stats['blocks']
+    return ('%s of %s blocks changed (%.1f%%), %s bytes written' %
+            (stats['changed_blocks'], stats['blocks'], ratio * 100,
+             stats['bytes_written']))
+
+
+def main():
+    """ delta sync stdin to the file given as the second argument, against
+        the previous file given as the third if any, in blocks of the size
+        given as the first. used by the stream scripts
+    """
+    if len(sys.argv) not in [3, 4]:
+        sys.stderr.write('usage: %s <block size> <file> [<previous file>]\n'
+                         % sys.argv[0])
+        sys.exit(2)
+    previous_path = ''
+    if len(sys.argv) == 4:
+        previous_path = sys.argv[3]
+    stream = getattr(sys.stdin, 'buffer', sys.stdin)
+    try:
+        stats = delta_sync(stream, sys.argv[2], previous_path=previous_path,
+                           block_size=int(sys.argv[1]))
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('error delta syncing %s: %s\n' % (sys.argv[2], e))
+        sys.exit(1)
+    sys.stdout.write('delta synced %s: %s\n' % (sys.argv[2],
+                                                 format_stats(stats)))
+
+
+if __name__ == '__main__':
+    main()
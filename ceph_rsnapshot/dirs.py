@@ -1,4 +1,4 @@
-from ceph_rsnapshot import settings, logs
+from ceph_rsnapshot import settings, logs, backends
 import os
 import sys
 import tempfile
@@ -125,7 +125,7 @@ def setup_qcow_temp_path(pool='', cephhost='', qcowtemppath='', noop=None):
     MKDIR_COMMAND = 'mkdir -p %s' % temp_path
     CHMOD_COMMAND = 'LANG='' LC_CTYPE='' chmod 700 %s' % temp_path
     try:
-        ls_result = sh.ssh(cephhost, LS_COMMAND)
+        ls_result = backends.get_backend().run(cephhost, LS_COMMAND)
     except sh.ErrorReturnCode as e:
         if e.exit_code == 2:
             # ls returns 2 for no such dir, this is OK, just make it
@@ -134,8 +134,8 @@ def setup_qcow_temp_path(pool='', cephhost='', qcowtemppath='', noop=None):
                     logger.info('NOOP: would have made qcow temp path %s' %
                                 temp_path)
                 else:
-                    sh.ssh(cephhost, MKDIR_COMMAND)
-                    sh.ssh(cephhost, CHMOD_COMMAND)
+                    backends.get_backend().run(cephhost, MKDIR_COMMAND)
+                    backends.get_backend().run(cephhost, CHMOD_COMMAND)
             except sh.ErrorReturnCode as e:
                 logger.error('error making or chmodding qcow temp dir:')
                 logger.exception(e.stderr)
@@ -159,7 +159,7 @@ def setup_qcow_temp_path(pool='', cephhost='', qcowtemppath='', noop=None):
             logger.info('NOOP: would have chmodded qcow temp path with command:'
                 ' %s' % CHMOD_COMMAND)
         else:
-            sh.ssh(cephhost, CHMOD_COMMAND)
+            backends.get_backend().run(cephhost, CHMOD_COMMAND)
     except sh.ErrorReturnCode as e:
         logger.error('error chmodding qcow temp dir:')
         logger.exception(e.stderr)
@@ -191,7 +191,7 @@ def check_qcow_temp_path_empty_for_pool(cephhost='', qcowtemppath='', pool='',
                 ' %s' % (temp_path, cephhost))
     LS_COMMAND = 'ls -a %s' % temp_path
     try:
-        ls_result = sh.ssh(cephhost, LS_COMMAND)
+        ls_result = backends.get_backend().run(cephhost, LS_COMMAND)
         if ls_result == EMPTY_DIR_LS_RESULT:
             return True
         else:
@@ -207,6 +207,56 @@ def check_qcow_temp_path_empty_for_pool(cephhost='', qcowtemppath='', pool='',
         raise
 
 
+def get_qcow_temp_path(pool='', image='', qcowtemppath=''):
+    """ path on the ceph node for temp qcows, qcow_temp_path/pool or the per
+        image subdirectory qcow_temp_path/pool/image if image is given
+    """
+    if not qcowtemppath:
+        qcowtemppath = settings.QCOW_TEMP_PATH
+    if not pool:
+        pool = settings.POOL
+    if image:
+        return '%s/%s/%s' % (qcowtemppath, pool, image)
+    return '%s/%s' % (qcowtemppath, pool)
+
+
+def setup_qcow_temp_path_for_image(image, cephhost='', qcowtemppath='',
+        pool='', noop=None):
+    """ ssh to ceph node, make the per image temp qcow export subdirectory
+        and check that it is empty, all in one round trip
+    """
+    logger = logs.get_logger()
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not noop:
+        noop = settings.NOOP
+    temp_path = get_qcow_temp_path(pool=pool, image=image,
+                                   qcowtemppath=qcowtemppath)
+    if noop:
+        logger.info('NOOP: would have made qcow temp path %s' % temp_path)
+        return True
+    logger.info('making qcow temp export path %s on ceph host %s and checking'
+                ' it is empty' % (temp_path, cephhost))
+    MKDIR_LS_COMMAND = ('mkdir -p -m 700 %s && ls -a %s' % (temp_path,
+                                                            temp_path))
+    try:
+        ls_result = backends.get_backend().run(cephhost, MKDIR_LS_COMMAND)
+        if ls_result == EMPTY_DIR_LS_RESULT:
+            return True
+        else:
+            logger.error('ERROR: temp qcow export directory %s not empty: %s',
+                         temp_path, ls_result)
+            return False
+    except sh.ErrorReturnCode as e:
+        logger.error('error making temp qcow export directory')
+        logger.exception(e.stderr)
+        raise
+    except Exception as e:
+        logger.error('error making temp qcow export directory')
+        logger.exception(e)
+        raise
+
+
 def check_empty_dir(directory):
     """ check a dir is empty
     """
@@ -218,6 +268,15 @@ def check_empty_dir(directory):
         raise NameError('directory %s does not exist' % directory)
 
 
+def get_existing_parent(directory):
+    """ directory, or its nearest parent that exists if it doesn't yet
+    """
+    directory = os.path.abspath(directory)
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return directory
+
+
 def make_empty_tempdir(prefix=''):
     """ make an empty tempdir
     """
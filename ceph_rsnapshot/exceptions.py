@@ -46,3 +46,13 @@ class SnapDateFormatMismatchError(CephRsnapshotException):
                 " {date_format}".format(
                     snap_date=snap_date, date_format=date_format))
 
+
+
+class LockHeldError(CephRsnapshotException):
+    """
+    Raised when a lock is held by another run
+    """
+    def __init__(self, lock_path, holder):
+        self.msg = ( "Lock {lock_path} is held by another run{holder}".format(
+                    lock_path=lock_path,
+                    holder=' (%s)' % holder if holder else ''))
@@ -0,0 +1,122 @@
+# free space reservation ledger for the qcow temp path on the ceph node
+import threading
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+
+
+# one ledger per (cephhost, path), guarded by _condition which is also
+# notified when a reservation is released
+_condition = threading.Condition()
+_ledgers = {}
+
+
+def _get_ledger(cephhost, path):
+    key = (cephhost, path)
+    if key not in _ledgers:
+        _ledgers[key] = {'available_bytes': 0, 'sampled_at': None,
+                         'sampling': False, 'reservations': {},
+                         'reserved_at': {}}
+    return _ledgers[key]
+
+
+def _sample(ledger, cephhost, path):
+    """ re-read real free space, minus what in flight exports still have
+        reserved. partly written exports are counted twice, which errs on
+        the safe side until they are released. called holding _condition,
+        which is let go for the remote df so other workers can reserve and
+        release meanwhile
+    """
+    # imported here as ceph imports this module
+    from ceph_rsnapshot import ceph
+    logger = logs.get_logger()
+    ledger['sampling'] = True
+    _condition.release()
+    try:
+        free_bytes = ceph.get_freespace(path, cephhost=cephhost)
+    finally:
+        _condition.acquire()
+        ledger['sampling'] = False
+        _condition.notify_all()
+    # reservations taken during the df were not written yet so are in
+    # free_bytes, and those released during it are left out to be safe
+    reserved_bytes = sum(ledger['reservations'].values())
+    ledger['available_bytes'] = free_bytes - reserved_bytes
+    ledger['sampled_at'] = time.time()
+    logger.info('free space on %s:%s is %s bytes with %s bytes reserved by %s'
+                ' exports' % (cephhost, path, free_bytes, reserved_bytes,
+                              len(ledger['reservations'])))
+
+
+def reserve(name, size, cephhost='', path='', min_freespace=None,
+            wait=True):
+    """ reserve size bytes of the qcow temp path for the export of name.
+        free space is sampled with get_freespace on first use and every
+        FREESPACE_RESAMPLE_SECONDS after. if there isn't room and other
+        exports hold reservations, wait for them to be released when wait is
+        set, re-sampling every FREESPACE_RESAMPLE_SECONDS, otherwise raise
+        NameError like export_qcow always has. reservations held longer than
+        that are taken as stale, so once only they are left it raises too
+    """
+    logger = logs.get_logger()
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not path:
+        path = settings.QCOW_TEMP_PATH
+    if min_freespace is None:
+        min_freespace = settings.MIN_FREESPACE
+    with _condition:
+        ledger = _get_ledger(cephhost, path)
+        while True:
+            if (ledger['sampled_at'] is None or time.time() -
+                    ledger['sampled_at'] > settings.FREESPACE_RESAMPLE_SECONDS):
+                if ledger['sampling']:
+                    # another worker is sampling it, use its sample
+                    _condition.wait(settings.FREESPACE_RESAMPLE_SECONDS)
+                    continue
+                _sample(ledger, cephhost, path)
+            if size <= ledger['available_bytes'] - min_freespace:
+                break
+            now = time.time()
+            # a reservation whose release was lost, say to an export that
+            # died before its qcow was removed, would otherwise be waited on
+            # for good
+            live = [reserved for reserved, reserved_at in
+                    ledger['reserved_at'].items() if now - reserved_at <=
+                    settings.FREESPACE_RESAMPLE_SECONDS]
+            if not (wait and live):
+                logger.error("not enough free space to export this qcow:"
+                             " need %s bytes, %s available less %s min"
+                             " freespace, %s stale reservations" %
+                             (size, ledger['available_bytes'], min_freespace,
+                              len(ledger['reservations']) - len(live)))
+                raise NameError('not enough space to export this qcow')
+            logger.info('not enough free space to export %s yet, waiting for'
+                        ' one of %s in flight exports to be removed' %
+                        (name, len(live)))
+            _condition.wait(settings.FREESPACE_RESAMPLE_SECONDS)
+            if time.time() - now >= settings.FREESPACE_RESAMPLE_SECONDS:
+                # timed out with nothing released, so look at the real free
+                # space again
+                ledger['sampled_at'] = None
+        ledger['reservations'][name] = size
+        ledger['reserved_at'][name] = time.time()
+        ledger['available_bytes'] -= size
+    return True
+
+
+def release(name, cephhost='', path=''):
+    """ release the reservation for name once its qcow has been removed
+    """
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if not path:
+        path = settings.QCOW_TEMP_PATH
+    with _condition:
+        ledger = _get_ledger(cephhost, path)
+        size = ledger['reservations'].pop(name, None)
+        ledger['reserved_at'].pop(name, None)
+        if size is not None:
+            ledger['available_bytes'] += size
+        _condition.notify_all()
@@ -28,6 +28,12 @@ def get_current_settings():
         POOLS=settings.POOLS,
         POOL=settings.POOL,
         QCOW_TEMP_PATH=settings.QCOW_TEMP_PATH,
+        EXPORT_MODE=settings.EXPORT_MODE,
+        STREAM_FORMAT=settings.STREAM_FORMAT,
+        INCREMENTAL=settings.INCREMENTAL,
+        FULL_EXPORT_EVERY=settings.FULL_EXPORT_EVERY,
+        NUM_WORKERS=settings.NUM_WORKERS,
+        PIPELINE_EXPORTS=settings.PIPELINE_EXPORTS,
         TEMP_CONF_DIR_PREFIX=settings.TEMP_CONF_DIR_PREFIX,
         TEMP_CONF_DIR=settings.TEMP_CONF_DIR,
         KEEPCONF=settings.KEEPCONF,
@@ -46,8 +52,47 @@ def get_current_settings():
         SNAP_DATE=settings.SNAP_DATE,
         USE_SNAP_STATUS_FILE=settings.USE_SNAP_STATUS_FILE,
         SNAP_STATUS_FILE_PATH=settings.SNAP_STATUS_FILE_PATH,
+        BATCH_DISCOVERY=settings.BATCH_DISCOVERY,
+        POOL_SIZE_INVENTORY=settings.POOL_SIZE_INVENTORY,
         MIN_FREESPACE=settings.MIN_FREESPACE,
+        FREESPACE_RESAMPLE_SECONDS=settings.FREESPACE_RESAMPLE_SECONDS,
+        CEPH_BACKEND=settings.CEPH_BACKEND,
+        FAKE_BACKEND_PATH=settings.FAKE_BACKEND_PATH,
+        FAKE_IMAGE_COUNT=settings.FAKE_IMAGE_COUNT,
+        FAKE_IMAGE_SIZE=settings.FAKE_IMAGE_SIZE,
+        FAKE_LATENCY_MS=settings.FAKE_LATENCY_MS,
+        METRICS_TEXTFILE=settings.METRICS_TEXTFILE,
+        RECORD_HISTORY=settings.RECORD_HISTORY,
+        HISTORY_DB=settings.HISTORY_DB,
+        SCHEDULE=settings.SCHEDULE,
+        SCHEDULE_HISTORY_RUNS=settings.SCHEDULE_HISTORY_RUNS,
+        ROTATION_ENGINE=settings.ROTATION_ENGINE,
+        ORPHAN_WORKERS=settings.ORPHAN_WORKERS,
+        RECLAIM_ORPHANS=settings.RECLAIM_ORPHANS,
+        CATALOG=settings.CATALOG,
+        CATALOG_DB=settings.CATALOG_DB,
+        CATALOG_CHECKSUM=settings.CATALOG_CHECKSUM,
+        DELTA_SYNC=settings.DELTA_SYNC,
+        DELTA_BLOCK_SIZE=settings.DELTA_BLOCK_SIZE,
+        CHUNK_STORE=settings.CHUNK_STORE,
+        CHUNK_STORE_PATH=settings.CHUNK_STORE_PATH,
+        CHUNK_AVG_SIZE=settings.CHUNK_AVG_SIZE,
+        REFLINK=settings.REFLINK,
+        COMPRESSION=settings.COMPRESSION,
+        COMPRESSION_LEVEL=settings.COMPRESSION_LEVEL,
+        COMPRESSION_THREADS=settings.COMPRESSION_THREADS,
+        COMPRESSION_POOLS=settings.COMPRESSION_POOLS,
+        EXPORT_BWLIMIT=settings.EXPORT_BWLIMIT,
+        TRANSFER_BWLIMIT=settings.TRANSFER_BWLIMIT,
+        BWLIMIT_WINDOWS=settings.BWLIMIT_WINDOWS,
+        CLUSTER_CONFIGS=settings.CLUSTER_CONFIGS,
+        CLUSTER_WORKERS=settings.CLUSTER_WORKERS,
+        LOCK_PATH=settings.LOCK_PATH,
+        LOCK_TIMEOUT=settings.LOCK_TIMEOUT,
         SH_LOGGING=settings.SH_LOGGING,
+        SSH_MULTIPLEX=settings.SSH_MULTIPLEX,
+        SSH_CONTROL_DIR=settings.SSH_CONTROL_DIR,
+        SSH_CONTROL_PERSIST=settings.SSH_CONTROL_PERSIST,
     ))
 
 
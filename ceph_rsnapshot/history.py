@@ -0,0 +1,313 @@
+# run history in a local sqlite database, for per image throughput trends
+import sqlite3
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import ceph
+from ceph_rsnapshot import metrics
+
+
+# per image phases kept in the history, each as seconds and bytes columns
+HISTORY_PHASES = ['conf_write', 'export', 'rsync', 'chunk_store', 'catalog',
+                  'cleanup']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' started REAL NOT NULL,'
+    ' finished REAL NOT NULL,'
+    ' cephhost TEXT NOT NULL,'
+    ' snap_date TEXT NOT NULL,'
+    ' num_workers INTEGER NOT NULL,'
+    ' successful INTEGER NOT NULL,'
+    ' failed INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS images ('
+    ' run_id INTEGER NOT NULL REFERENCES runs (id),'
+    ' pool TEXT NOT NULL,'
+    ' image TEXT NOT NULL,'
+    ' snap TEXT NOT NULL,'
+    ' successful INTEGER NOT NULL,'
+    ' provisioned_size INTEGER,'
+    ' used_size INTEGER,'
+    + ''.join([' %s_seconds REAL NOT NULL DEFAULT 0,'
+               ' %s_bytes INTEGER NOT NULL DEFAULT 0,' % (phase, phase)
+               for phase in HISTORY_PHASES]) +
+    ' total_seconds REAL NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS images_by_image ON images (pool, image,'
+    ' run_id)',
+]
+
+
+def get_history_db():
+    """ HISTORY_DB, or ceph_rsnapshot_history.sqlite in LOG_BASE_PATH
+    """
+    if settings.HISTORY_DB:
+        return settings.HISTORY_DB
+    return '%s/ceph_rsnapshot_history.sqlite' % settings.LOG_BASE_PATH
+
+
+def connect(history_db=''):
+    """ open the history database, making its tables if they are not there
+        and adding the columns of phases added since it was made
+    """
+    if not history_db:
+        history_db = get_history_db()
+    conn = sqlite3.connect(history_db)
+    conn.row_factory = sqlite3.Row
+    with conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        columns = [row['name'] for row in
+                   conn.execute('PRAGMA table_info(images)')]
+        for phase in HISTORY_PHASES:
+            for unit, column_type in [('seconds', 'REAL'),
+                                      ('bytes', 'INTEGER')]:
+                column = '%s_%s' % (phase, unit)
+                if column not in columns:
+                    conn.execute('ALTER TABLE images ADD COLUMN %s %s NOT'
+                                 ' NULL DEFAULT 0' % (column, column_type))
+    return conn
+
+
+def get_image_record(result, snap):
+    """ history row for one image result of rsnap_pool, with its sizes from
+        the per run size cache and its phases from metrics
+    """
+    logger = logs.get_logger()
+    image = result['image']
+    pool = result['pool']
+    record = {'pool': pool, 'image': image, 'snap': snap,
+              'successful': int(bool(result['successful'])),
+              'provisioned_size': None, 'used_size': None,
+              'total_seconds': 0.0}
+    try:
+        sizes = ceph.get_rbd_sizes(image, pool=pool)
+        record['provisioned_size'] = sizes['provisioned_size']
+        record['used_size'] = sizes['used_size']
+    except Exception as e:
+        logger.warning('cannot get sizes of %s/%s for history: %s' %
+                       (pool, image, e))
+    phases = metrics.get_image_phases(image, pool=pool)
+    for phase in HISTORY_PHASES:
+        sample = phases.get(phase, {'seconds': 0.0, 'bytes': 0})
+        record['%s_seconds' % phase] = sample['seconds']
+        record['%s_bytes' % phase] = sample['bytes']
+        record['total_seconds'] += sample['seconds']
+    return record
+
+
+def record_run(all_result, started, finished=None, history_db=''):
+    """ append this run and a row per image in it to the history database.
+        returns the run id
+    """
+    logger = logs.get_logger()
+    if finished is None:
+        finished = time.time()
+    if settings.NOOP:
+        logger.info('NOOP: would have recorded run in history database %s' %
+                    (history_db or get_history_db()))
+        return None
+    snap = ceph.get_snapdate(snap_date=settings.SNAP_DATE)
+    records = [get_image_record(result, snap) for result in
+               all_result.get('successful', []) + all_result.get('failed', [])]
+    columns = ['run_id', 'pool', 'image', 'snap', 'successful',
+               'provisioned_size', 'used_size'] + [
+        '%s_%s' % (phase, unit) for phase in HISTORY_PHASES for unit in
+        ['seconds', 'bytes']] + ['total_seconds']
+    conn = connect(history_db)
+    try:
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO runs (started, finished, cephhost, snap_date,'
+                ' num_workers, successful, failed) VALUES (?, ?, ?, ?, ?, ?,'
+                ' ?)', (started, finished, settings.CEPH_HOST, snap,
+                        settings.NUM_WORKERS,
+                        len(all_result.get('successful', [])),
+                        len(all_result.get('failed', []))))
+            run_id = cursor.lastrowid
+            for record in records:
+                record['run_id'] = run_id
+            conn.executemany(
+                'INSERT INTO images (%s) VALUES (%s)' % (
+                    ', '.join(columns), ', '.join(['?'] * len(columns))),
+                [[record[column] for column in columns] for record in records])
+    finally:
+        conn.close()
+    logger.info('recorded run %s with %s images in history database %s' %
+                (run_id, len(records), history_db or get_history_db()))
+    return run_id
+
+
+def get_throughput(row):
+    """ bytes per second an image was backed up at, from the rsync bytes (or
+        export bytes if there were none) over its total time
+    """
+    moved_bytes = row['rsync_bytes'] or row['export_bytes']
+    if not moved_bytes or not row['total_seconds']:
+        return None
+    return moved_bytes / row['total_seconds']
+
+
+def get_runs(conn, runs, cephhost=None):
+    """ the last runs runs, of cephhost only if given, newest first
+    """
+    if cephhost is None:
+        return conn.execute('SELECT * FROM runs ORDER BY id DESC LIMIT ?',
+                            (runs,)).fetchall()
+    return conn.execute('SELECT * FROM runs WHERE cephhost = ? ORDER BY id'
+                        ' DESC LIMIT ?', (cephhost, runs)).fetchall()
+
+
+def get_image_history(conn, runs, cephhost=None):
+    """ rows of the successful backups of each image in the last runs runs,
+        of cephhost only if given, keyed by (cephhost, pool, image), as
+        clusters backed up into one history can have pools of the same name,
+        oldest first
+    """
+    run_ids = [row['id'] for row in get_runs(conn, runs, cephhost)]
+    history = {}
+    if not run_ids:
+        return history
+    for row in conn.execute(
+            'SELECT images.*, runs.started, runs.cephhost FROM images JOIN'
+            ' runs ON images.run_id = runs.id WHERE images.successful = 1 AND'
+            ' images.run_id IN (%s) ORDER BY images.run_id' %
+            ', '.join(['?'] * len(run_ids)), run_ids):
+        history.setdefault((row['cephhost'], row['pool'], row['image']),
+                           []).append(row)
+    return history
+
+
+def mean(values):
+    return sum(values) / float(len(values))
+
+
+def get_slowest(conn, runs=7, limit=20, cephhost=None):
+    """ images with the highest mean total seconds over the last runs runs
+    """
+    slowest = []
+    for (host, pool, image), rows in get_image_history(conn, runs,
+                                                        cephhost).items():
+        throughputs = [throughput for throughput in
+                       [get_throughput(row) for row in rows] if throughput]
+        slowest.append({
+            'cephhost': host,
+            'image': '%s/%s' % (pool, image),
+            'runs': len(rows),
+            'mean_seconds': mean([row['total_seconds'] for row in rows]),
+            'last_seconds': rows[-1]['total_seconds'],
+            'mean_mb_per_second': (mean(throughputs) / 1024 / 1024 if
+                                   throughputs else None),
+        })
+    slowest.sort(key=lambda entry: entry['mean_seconds'], reverse=True)
+    return slowest[:limit]
+
+
+def get_regressions(conn, runs=7, factor=1.5, limit=20, cephhost=None):
+    """ images whose last backup took factor times longer, or ran at a
+        factor times lower throughput, than their mean over the runs before
+        it
+    """
+    regressions = []
+    for (host, pool, image), rows in get_image_history(conn, runs,
+                                                        cephhost).items():
+        if len(rows) < 2:
+            continue
+        last = rows[-1]
+        previous = rows[:-1]
+        mean_seconds = mean([row['total_seconds'] for row in previous])
+        previous_throughputs = [throughput for throughput in
+                                [get_throughput(row) for row in previous]
+                                if throughput]
+        last_throughput = get_throughput(last)
+        slowdown = None
+        if mean_seconds:
+            slowdown = last['total_seconds'] / mean_seconds
+        throughput_drop = None
+        if previous_throughputs and last_throughput:
+            throughput_drop = mean(previous_throughputs) / last_throughput
+        if (slowdown or 0) < factor and (throughput_drop or 0) < factor:
+            continue
+        regressions.append({
+            'cephhost': host,
+            'image': '%s/%s' % (pool, image),
+            'last_seconds': last['total_seconds'],
+            'mean_seconds': mean_seconds,
+            'slowdown': slowdown,
+            'throughput_drop': throughput_drop,
+        })
+    regressions.sort(key=lambda entry: max(entry['slowdown'] or 0,
+                                           entry['throughput_drop'] or 0),
+                     reverse=True)
+    return regressions[:limit]
+
+
+def get_growth(conn, runs=30, limit=20, by='seconds', cephhost=None):
+    """ per day growth of each image's used size and backup seconds between
+        its first and last backup in the last runs runs, fastest growing by
+        seconds or bytes first
+    """
+    growth = []
+    for (host, pool, image), rows in get_image_history(conn, runs,
+                                                        cephhost).items():
+        if len(rows) < 2:
+            continue
+        first = rows[0]
+        last = rows[-1]
+        days = (last['started'] - first['started']) / 86400.0
+        if days <= 0:
+            continue
+        growth.append({
+            'cephhost': host,
+            'image': '%s/%s' % (pool, image),
+            'used_size': last['used_size'],
+            'bytes_per_day': ((last['used_size'] or 0) -
+                              (first['used_size'] or 0)) / days,
+            'seconds': last['total_seconds'],
+            'seconds_per_day': (last['total_seconds'] -
+                                first['total_seconds']) / days,
+        })
+    growth.sort(key=lambda entry: entry['%s_per_day' % by], reverse=True)
+    return growth[:limit]
+
+
+def predict_run(conn, runs=7, num_workers=None, cephhost=None):
+    """ predicted length of the next run (of cephhost if given), from the
+        mean seconds of each image backed up in the last run spread over
+        num_workers, next to how long the last runs actually took
+    """
+    if num_workers is None:
+        num_workers = settings.NUM_WORKERS
+    history = get_image_history(conn, runs, cephhost)
+    recent_runs = get_runs(conn, runs, cephhost)
+    if not recent_runs:
+        return None
+    last_run = recent_runs[0]
+    image_seconds = [mean([row['total_seconds'] for row in rows]) for rows in
+                     history.values() if rows[-1]['run_id'] == last_run['id']]
+    durations = [row['finished'] - row['started'] for row in recent_runs]
+    return {
+        'images': len(image_seconds),
+        'image_seconds': sum(image_seconds),
+        'predicted_seconds': sum(image_seconds) / max(num_workers, 1),
+        'last_run_seconds': durations[0],
+        'mean_run_seconds': mean(durations),
+    }
+
+
+def format_rows(rows, columns):
+    """ rows of dicts as a text table of columns
+    """
+    def format_value(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return '%.2f' % value
+        return str(value)
+    table = [columns] + [[format_value(row[column]) for column in columns]
+                         for row in rows]
+    widths = [max([len(line[index]) for line in table]) for index in
+              range(len(columns))]
+    return '\n'.join([' '.join([value.rjust(width) for value, width in
+                                zip(line, widths)]) for line in table])
@@ -0,0 +1,165 @@
+# incremental stream exports via rbd export-diff
+import glob
+import os
+import struct
+import sys
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import ceph
+
+
+RBD_DIFF_V1_HEADER = b'rbd diff v1\n'
+RBD_DIFF_V2_HEADER = b'rbd diff v2\n'
+
+# size of the zero buffer used to apply zero records
+ZERO_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def get_generation_path(image, generation=0, pool=''):
+    """ path of a backup generation of an image,
+        backup_base_path/pool/image/interval.N
+    """
+    if not pool:
+        pool = settings.POOL
+    return '%s/%s/%s/%s.%s' % (settings.BACKUP_BASE_PATH, pool, image,
+                               settings.RETAIN_INTERVAL, generation)
+
+
+def get_previous_export(image, pool=''):
+    """ find the raw export in the newest generation of this image.
+        returns (snap, chain) where chain is how many incrementals were
+        applied since the last full export, or (None, 0) if there is none
+    """
+    logger = logs.get_logger()
+    generation_path = get_generation_path(image, pool=pool)
+    raw_files = glob.glob('%s/%s@*.raw' % (generation_path, image))
+    if len(raw_files) != 1:
+        if raw_files:
+            logger.warning('found %s raw exports in %s, not using any of them'
+                           ' for an incremental' % (len(raw_files),
+                                                    generation_path))
+        return (None, 0)
+    raw_file = raw_files[0]
+    snap = os.path.basename(raw_file)[len(image) + 1:-len('.raw')]
+    chain = 0
+    chain_file = '%s/%s@%s.chain' % (generation_path, image, snap)
+    try:
+        with open(chain_file) as f:
+            chain = int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        # no chain file means it was a full export
+        pass
+    return (snap, chain)
+
+
+def choose_from_snap(image, snap, pool=''):
+    """ decide whether to export this image@snap as an incremental.
+        returns (from_snap, chain) for the rbd export-diff, or (None, 0)
+        for a full export
+    """
+    logger = logs.get_logger()
+    if not settings.INCREMENTAL:
+        return (None, 0)
+    previous_snap, chain = get_previous_export(image, pool=pool)
+    if not previous_snap:
+        logger.info('no previous raw export of %s, doing a full export' %
+                    image)
+        return (None, 0)
+    if previous_snap == snap:
+        logger.info('newest generation of %s is already from snap %s, doing'
+                    ' a full export' % (image, snap))
+        return (None, 0)
+    if chain + 1 >= settings.FULL_EXPORT_EVERY:
+        logger.info('%s incrementals of %s since the last full export,'
+                    ' doing a full export' % (chain, image))
+        return (None, 0)
+    if not ceph.check_snap(image, snap=previous_snap, pool=pool):
+        logger.info('previous snap %s of %s is gone from the ceph node,'
+                    ' doing a full export' % (previous_snap, image))
+        return (None, 0)
+    logger.info('exporting %s@%s as an incremental from snap %s' %
+                (image, snap, previous_snap))
+    return (previous_snap, chain + 1)
+
+
+def _read_exact(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise ValueError('rbd diff stream ended early, wanted %s bytes got %s'
+                         % (length, len(data)))
+    return data
+
+
+def _write_zeros(target, offset, length):
+    target.seek(offset)
+    zeros = b'\0' * min(length, ZERO_CHUNK_SIZE)
+    while length > 0:
+        chunk = min(length, len(zeros))
+        target.write(zeros[:chunk])
+        length -= chunk
+
+
+def _copy_data(stream, target, offset, length):
+    target.seek(offset)
+    while length > 0:
+        chunk = _read_exact(stream, min(length, ZERO_CHUNK_SIZE))
+        target.write(chunk)
+        length -= len(chunk)
+
+
+def apply_diff(stream, target_path):
+    """ apply an rbd export-diff stream (format v1 or v2) to a raw image file
+        in place. returns the number of bytes of data written
+    """
+    header = _read_exact(stream, len(RBD_DIFF_V1_HEADER))
+    if header not in [RBD_DIFF_V1_HEADER, RBD_DIFF_V2_HEADER]:
+        raise ValueError('not an rbd diff stream, header %r' % header)
+    v2 = header == RBD_DIFF_V2_HEADER
+    data_bytes = 0
+    with open(target_path, 'r+b') as target:
+        while True:
+            tag = _read_exact(stream, 1)
+            if tag == b'e':
+                break
+            if v2:
+                # v2 records carry their length, which we don't need
+                _read_exact(stream, 8)
+            if tag in [b'f', b't']:
+                name_length = struct.unpack('<I', _read_exact(stream, 4))[0]
+                _read_exact(stream, name_length)
+            elif tag == b's':
+                size = struct.unpack('<Q', _read_exact(stream, 8))[0]
+                target.truncate(size)
+            elif tag == b'w':
+                offset, length = struct.unpack('<QQ', _read_exact(stream, 16))
+                _copy_data(stream, target, offset, length)
+                data_bytes += length
+            elif tag == b'z':
+                offset, length = struct.unpack('<QQ', _read_exact(stream, 16))
+                _write_zeros(target, offset, length)
+            else:
+                raise ValueError('unknown rbd diff record %r' % tag)
+    return data_bytes
+
+
+def main():
+    """ apply an rbd export-diff from stdin to the raw image file given as
+        the only argument. used by the incremental stream scripts
+    """
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: %s <raw image file>\n' % sys.argv[0])
+        sys.exit(2)
+    stream = getattr(sys.stdin, 'buffer', sys.stdin)
+    try:
+        data_bytes = apply_diff(stream, sys.argv[1])
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('error applying rbd diff to %s: %s\n' %
+                         (sys.argv[1], e))
+        sys.exit(1)
+    sys.stdout.write('applied %s bytes of rbd diff to %s\n' % (data_bytes,
+                                                              sys.argv[1]))
+
+
+if __name__ == '__main__':
+    main()
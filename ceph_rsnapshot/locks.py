@@ -0,0 +1,178 @@
+# flock locks on files in LOCK_PATH, per pool on the ceph node and per pool
+# backup dir, so runs against other clusters and pools can go at once in
+# other processes while no two runs touch the same pool or chunk store
+import errno
+import fcntl
+import os
+import re
+import socket
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import exceptions
+
+
+LOCK_SUFFIX = '.lock'
+# how often to try a busy lock again while waiting for it
+LOCK_POLL_SECONDS = 1
+
+
+def get_lock_path(name, lock_path=''):
+    """ LOCK_PATH/<name>.lock, with anything but safe characters in name
+        made _
+    """
+    if not lock_path:
+        lock_path = settings.LOCK_PATH
+    return '%s/%s%s' % (lock_path, re.sub(r'[^a-zA-Z0-9._-]', '_', name),
+                        LOCK_SUFFIX)
+
+
+def is_running(pid):
+    """ whether a process with pid is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Lock(object):
+    """ an flock, exclusive or shared, on a lock file. an exclusive holder
+        writes its pid, host and start time into the file and empties it
+        on release, so one that died holding it (whose flock the kernel has
+        dropped) is found out by what it left behind
+    """
+
+    def __init__(self, name, shared=False, lock_path=''):
+        self.name = name
+        self.shared = shared
+        self.path = get_lock_path(name, lock_path)
+        self.fd = None
+
+    def read_holder(self):
+        """ (pid, host, started) written by the last exclusive holder, or
+            None if it released the lock
+        """
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        fields = os.read(self.fd, 1024).decode('utf-8', 'replace').split()
+        if len(fields) != 3 or not fields[0].isdigit():
+            return None
+        try:
+            return int(fields[0]), fields[1], float(fields[2])
+        except ValueError:
+            return None
+
+    def describe_holder(self, holder):
+        pid, host, started = holder
+        description = 'pid %s on %s since %s' % (
+            pid, host, time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(started)))
+        if host == socket.gethostname() and not is_running(pid):
+            description += ', which is gone'
+        return description
+
+    def acquire(self, timeout=0):
+        """ take the lock, waiting up to timeout seconds for another run to
+            release it, or for as long as it takes if timeout is None.
+            raises LockHeldError if it is still held
+        """
+        logger = logs.get_logger()
+        lock_dir = os.path.dirname(self.path)
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir, 0o755)
+            except OSError:
+                # made by another run meanwhile
+                if not os.path.isdir(lock_dir):
+                    raise
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # keep it out of rsync, ssh and the other commands run under it
+        fcntl.fcntl(self.fd, fcntl.F_SETFD,
+                    fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    self.close()
+                    raise
+            if deadline is not None and time.time() >= deadline:
+                holder = self.read_holder()
+                self.close()
+                raise exceptions.LockHeldError(
+                    self.path, holder and self.describe_holder(holder))
+            time.sleep(LOCK_POLL_SECONDS)
+        if self.shared:
+            return self
+        holder = self.read_holder()
+        if holder:
+            logger.warning('lock %s was not released by %s, taking it over' %
+                           (self.path, self.describe_holder(holder)))
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, ('%s %s %.3f\n' % (os.getpid(), socket.gethostname(),
+                                             time.time())).encode('utf-8'))
+        logger.debug('took lock %s' % self.path)
+        return self
+
+    def release(self):
+        if self.fd is None:
+            return
+        if not self.shared:
+            os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.close()
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def lock_pool(pool='', timeout=None):
+    """ take the locks on pool on the ceph node and on its backup dir, so no
+        other run exports it or writes to its backup dir meanwhile. waits up
+        to timeout, default LOCK_TIMEOUT, seconds for them. returns the locks
+        held, none on NOOP. raises LockHeldError if one is still held
+    """
+    if not pool:
+        pool = settings.POOL
+    if timeout is None:
+        timeout = settings.LOCK_TIMEOUT
+    if settings.NOOP:
+        return []
+    held = []
+    try:
+        for name in ['source_%s_%s_%s' % (settings.CEPH_HOST,
+                                          settings.CEPH_CLUSTER, pool),
+                     'backup_%s_%s' % (settings.BACKUP_BASE_PATH, pool)]:
+            held.append(Lock(name).acquire(timeout=timeout))
+    except Exception:
+        release(held)
+        raise
+    return held
+
+
+def lock_chunk_store(store_path, shared=False, timeout=0):
+    """ take the lock on the chunk store at store_path: shared by runs
+        storing chunks, exclusive for gc
+    """
+    return Lock('chunk_store_%s' % store_path, shared=shared).acquire(
+        timeout=timeout)
+
+
+def release(held):
+    for lock in reversed(held):
+        lock.release()
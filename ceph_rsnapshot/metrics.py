@@ -0,0 +1,229 @@
+# per phase timings and bytes of a run, for the status file and prometheus
+import os
+import tempfile
+import threading
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import compression
+
+
+PHASES = ['discovery', 'conf_write', 'export', 'rsync', 'chunk_store',
+          'catalog', 'cleanup', 'orphan_rotation']
+
+# upper bounds in seconds of the phase duration histogram buckets
+HISTOGRAM_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600]
+
+# per (pool, phase) samples for this run, and per (pool, image) seconds and
+# bytes of each phase, guarded by _lock since image workers record them
+# concurrently
+_lock = threading.Lock()
+_phases = {}
+_images = {}
+
+
+class PhaseTimer(object):
+    """ context manager that records the time spent in its block as one
+        sample of phase for pool (and image if given), along with any bytes
+        set on it
+    """
+
+    def __init__(self, phase, pool='', image=''):
+        if not pool:
+            pool = settings.POOL
+        self.phase = phase
+        self.pool = pool
+        self.image = image
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.phase, time.time() - self.start, pool=self.pool,
+               image=self.image, nbytes=self.bytes)
+        return False
+
+
+def record(phase, seconds, pool='', image='', nbytes=0):
+    """ record one sample of phase taking seconds and moving nbytes, for
+        image if given
+    """
+    if not pool:
+        pool = settings.POOL
+    with _lock:
+        sample = _phases.setdefault((pool, phase), {
+            'count': 0, 'seconds': 0.0, 'bytes': 0,
+            'buckets': [0] * len(HISTOGRAM_BUCKETS)})
+        sample['count'] += 1
+        sample['seconds'] += seconds
+        sample['bytes'] += nbytes
+        for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bucket:
+                sample['buckets'][index] += 1
+        if image:
+            image_phase = _images.setdefault((pool, image), {}).setdefault(
+                phase, {'seconds': 0.0, 'bytes': 0})
+            image_phase['seconds'] += seconds
+            image_phase['bytes'] += nbytes
+
+
+def get_phases():
+    """ copy of the samples, keyed by (pool, phase)
+    """
+    with _lock:
+        return dict((key, dict(sample, buckets=list(sample['buckets'])))
+                    for key, sample in _phases.items())
+
+
+def get_image_phases(image, pool=''):
+    """ seconds and bytes of each phase recorded for image, keyed by phase
+    """
+    if not pool:
+        pool = settings.POOL
+    with _lock:
+        return dict((phase, dict(sample)) for phase, sample in
+                    _images.get((pool, image), {}).items())
+
+
+def get_totals():
+    """ count, seconds and bytes of each phase summed over all pools
+    """
+    totals = dict((phase, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                  for phase in PHASES)
+    for (pool, phase), sample in get_phases().items():
+        for key in ['count', 'seconds', 'bytes']:
+            totals[phase][key] += sample[key]
+    return totals
+
+
+def get_dir_bytes(path):
+    """ bytes allocated to the files under path, so sparse exports count
+        only their data
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except OSError:
+                continue
+    return total
+
+
+def get_perfdata():
+    """ nagios perfdata of the total seconds and bytes of each phase, and the
+        throughput of the export and rsync phases
+    """
+    totals = get_totals()
+    perfdata = []
+    for phase in PHASES:
+        perfdata.append('%s_seconds=%.3fs' % (phase, totals[phase]['seconds']))
+        perfdata.append('%s_bytes=%sB' % (phase, totals[phase]['bytes']))
+    for phase in ['export', 'rsync']:
+        if totals[phase]['seconds']:
+            perfdata.append('%s_bytes_per_second=%.0fB' % (
+                phase, totals[phase]['bytes'] / totals[phase]['seconds']))
+    return ' '.join(perfdata)
+
+
+def get_textfile(all_result=None):
+    """ node_exporter textfile collector contents: per pool and phase
+        duration histograms and bytes, and image counts from all_result
+    """
+    phases = get_phases()
+    lines = [
+        '# HELP ceph_rsnapshot_phase_seconds time spent per image (or per'
+        ' pool for discovery) in each phase of the last run',
+        '# TYPE ceph_rsnapshot_phase_seconds histogram',
+    ]
+    for (pool, phase) in sorted(phases):
+        sample = phases[(pool, phase)]
+        labels = 'pool="%s",phase="%s"' % (pool, phase)
+        for bucket, count in zip(HISTOGRAM_BUCKETS, sample['buckets']):
+            lines.append('ceph_rsnapshot_phase_seconds_bucket{%s,le="%s"} %s'
+                         % (labels, bucket, count))
+        lines.append('ceph_rsnapshot_phase_seconds_bucket{%s,le="+Inf"} %s' %
+                     (labels, sample['count']))
+        lines.append('ceph_rsnapshot_phase_seconds_sum{%s} %.3f' %
+                     (labels, sample['seconds']))
+        lines.append('ceph_rsnapshot_phase_seconds_count{%s} %s' %
+                     (labels, sample['count']))
+    lines.extend([
+        '# HELP ceph_rsnapshot_phase_bytes bytes moved in each phase of the'
+        ' last run',
+        '# TYPE ceph_rsnapshot_phase_bytes gauge',
+    ])
+    for (pool, phase) in sorted(phases):
+        lines.append('ceph_rsnapshot_phase_bytes{pool="%s",phase="%s"} %s' %
+                     (pool, phase, phases[(pool, phase)]['bytes']))
+    compression_stats = compression.get_stats()
+    if compression_stats:
+        lines.extend([
+            '# HELP ceph_rsnapshot_compression_ratio raw over compressed bytes'
+            ' of the exports of the last run',
+            '# TYPE ceph_rsnapshot_compression_ratio gauge',
+        ])
+        for pool in sorted(compression_stats):
+            lines.append('ceph_rsnapshot_compression_ratio{pool="%s"} %.3f' %
+                         (pool, compression.get_ratio(compression_stats[pool])))
+        lines.extend([
+            '# HELP ceph_rsnapshot_compression_cpu_seconds cpu time spent'
+            ' compressing the exports of the last run',
+            '# TYPE ceph_rsnapshot_compression_cpu_seconds gauge',
+        ])
+        for pool in sorted(compression_stats):
+            lines.append('ceph_rsnapshot_compression_cpu_seconds{pool="%s"}'
+                         ' %.3f' % (pool,
+                                    compression_stats[pool]['cpu_seconds']))
+    if all_result:
+        lines.extend([
+            '# HELP ceph_rsnapshot_images images and orphans by result in the'
+            ' last run',
+            '# TYPE ceph_rsnapshot_images gauge',
+        ])
+        counts = {}
+        for result in sorted(all_result):
+            for entry in all_result[result]:
+                # no_rotate_orphans puts a note here instead of orphans
+                if isinstance(entry, dict):
+                    key = (entry['pool'], result)
+                    counts[key] = counts.get(key, 0) + 1
+        for (pool, result) in sorted(counts):
+            lines.append('ceph_rsnapshot_images{pool="%s",result="%s"} %s' %
+                         (pool, result, counts[(pool, result)]))
+    lines.extend([
+        '# HELP ceph_rsnapshot_last_run_timestamp_seconds when the last run'
+        ' finished',
+        '# TYPE ceph_rsnapshot_last_run_timestamp_seconds gauge',
+        'ceph_rsnapshot_last_run_timestamp_seconds %.0f' % time.time(),
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(all_result=None, textfile=''):
+    """ write get_textfile to METRICS_TEXTFILE, atomically so node_exporter
+        never reads half of it
+    """
+    logger = logs.get_logger()
+    if not textfile:
+        textfile = settings.METRICS_TEXTFILE
+    if not textfile:
+        return
+    if settings.NOOP:
+        logger.info('NOOP: would have written metrics to %s' % textfile)
+        return
+    logger.info('writing metrics to %s' % textfile)
+    fd, temp_file = tempfile.mkstemp(prefix='.ceph_rsnapshot_metrics_',
+                                     dir=os.path.dirname(textfile))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(get_textfile(all_result))
+        os.chmod(temp_file, 0o644)
+        os.rename(temp_file, textfile)
+    except (IOError, OSError) as e:
+        logger.error('error writing metrics to %s: %s' % (textfile, e))
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
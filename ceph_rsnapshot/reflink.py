@@ -0,0 +1,81 @@
+# copy on write clones of files with the FICLONE ioctl, so generations on
+# btrfs, xfs and other reflink capable backup volumes share unchanged extents
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+
+from ceph_rsnapshot import logs
+
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+# whether each filesystem supports reflinks, by st_dev, probed once per run
+_lock = threading.Lock()
+_supported = {}
+
+
+def clone(source, target):
+    """ make target a reflink clone of source, with its mode and times.
+        raises IOError if the filesystem can't clone
+    """
+    with open(source, 'rb') as source_file:
+        with open(target, 'wb') as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, target)
+
+
+def supports_reflink(path):
+    """ whether the filesystem of directory path can clone files, found by
+        cloning a probe file in it
+    """
+    logger = logs.get_logger()
+    dev = os.stat(path).st_dev
+    with _lock:
+        if dev in _supported:
+            return _supported[dev]
+    fd, probe_path = tempfile.mkstemp(prefix='.reflink_probe.', dir=path)
+    clone_path = probe_path + '.clone'
+    try:
+        os.write(fd, b'ceph_rsnapshot')
+        os.close(fd)
+        clone(probe_path, clone_path)
+        supported = True
+    except (IOError, OSError) as e:
+        logger.debug('no reflinks on the filesystem of %s: %s' % (path, e))
+        supported = False
+    finally:
+        for temp_path in [probe_path, clone_path]:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    with _lock:
+        _supported[dev] = supported
+    return supported
+
+
+def unshare_tree(path):
+    """ replace every file under path that is hardlinked elsewhere with a
+        reflink clone of itself, so it can be written in place without
+        changing the other links. returns False, having left the rest of the
+        files hardlinked, if the filesystem can't clone
+    """
+    if not supports_reflink(path):
+        return False
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            file_stat = os.lstat(file_path)
+            if not os.path.isfile(file_path) or os.path.islink(file_path) or \
+                    file_stat.st_nlink < 2:
+                continue
+            temp_path = os.path.join(dirpath, '.%s.reflink' % filename)
+            try:
+                clone(file_path, temp_path)
+            except (IOError, OSError):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return False
+            os.rename(temp_path, file_path)
+    return True
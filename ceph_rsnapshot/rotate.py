@@ -0,0 +1,266 @@
+# rsnapshot's generation rotation done in process, for ROTATION_ENGINE native
+# and for orphans
+import os
+import re
+import shutil
+import stat
+import time
+
+import sh
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import templates
+from ceph_rsnapshot import reflink
+from ceph_rsnapshot import throttle
+
+
+ROTATION_ENGINES = ['rsnapshot', 'native']
+
+# the same rsync and ssh args as rsnapshot.template gives rsnapshot
+RSYNC_ARGS = ['-aA', '--delete', '--numeric-ids', '--delete-excluded']
+SSH_COMMAND = '/usr/bin/ssh -c arcfour'
+# into reflink clones, so only the changed ranges are written and the rest
+# stays shared with the previous generation
+INPLACE_RSYNC_ARGS = ['--inplace', '--no-whole-file']
+
+
+def get_generation_dir(destination, generation, interval=''):
+    """ destination/interval.generation, as rsnapshot names them
+    """
+    if not interval:
+        interval = settings.RETAIN_INTERVAL
+    return '%s/%s.%s' % (destination, interval, generation)
+
+
+def copy_dir_metadata(source, dest):
+    """ mode, owner and times of directory source onto dest, as cp -a does
+    """
+    source_stat = os.lstat(source)
+    os.chmod(dest, stat.S_IMODE(source_stat.st_mode))
+    try:
+        os.chown(dest, source_stat.st_uid, source_stat.st_gid)
+    except OSError:
+        # not root, keep our own
+        pass
+    os.utime(dest, (source_stat.st_atime, source_stat.st_mtime))
+
+
+def link_tree(source, dest):
+    """ copy the tree at source to dest with every file hardlinked, like
+        cp -al
+    """
+    os.mkdir(dest)
+    for name in os.listdir(source):
+        source_path = os.path.join(source, name)
+        dest_path = os.path.join(dest, name)
+        mode = os.lstat(source_path).st_mode
+        if stat.S_ISDIR(mode):
+            link_tree(source_path, dest_path)
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(source_path), dest_path)
+        else:
+            os.link(source_path, dest_path)
+    # after the entries, as adding them changes the mtime
+    copy_dir_metadata(source, dest)
+
+
+def remove_tree(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def rotate(destination, interval='', retain_number=None, link_newest=True):
+    """ rotate the generations of destination the way rsnapshot does for its
+        lowest interval: remove the oldest, move the others up one and leave
+        interval.0 hardlinked to interval.1, ready to be synced into. without
+        link_newest interval.0 is moved up too, leaving none
+    """
+    logger = logs.get_logger()
+    if not interval:
+        interval = settings.RETAIN_INTERVAL
+    if retain_number is None:
+        retain_number = settings.RETAIN_NUMBER
+    if not os.path.isdir(destination):
+        os.makedirs(destination, 0o700)
+    if retain_number < 2:
+        # only interval.0, which is synced in place
+        if not link_newest:
+            remove_tree(get_generation_dir(destination, 0, interval))
+        return
+    oldest = get_generation_dir(destination, retain_number - 1, interval)
+    if os.path.lexists(oldest):
+        logger.debug('removing %s' % oldest)
+        remove_tree(oldest)
+    if link_newest:
+        last = 0
+    else:
+        last = -1
+    for generation in range(retain_number - 2, last, -1):
+        generation_dir = get_generation_dir(destination, generation, interval)
+        if os.path.isdir(generation_dir):
+            os.rename(generation_dir, get_generation_dir(
+                destination, generation + 1, interval))
+    newest = get_generation_dir(destination, 0, interval)
+    if link_newest and os.path.isdir(newest):
+        link_tree(newest, get_generation_dir(destination, 1, interval))
+
+
+def sync(source, generation_dir, pool='', inplace=False, bwlimit=0):
+    """ rsync source into generation_dir with rsnapshot's rsync args,
+        updating its files in place if inplace and at no more than bwlimit
+        KB/s if set. returns the sh result
+    """
+    logger = logs.get_logger()
+    args = list(RSYNC_ARGS) + settings.EXTRA_ARGS.split()
+    if inplace:
+        args.extend(INPLACE_RSYNC_ARGS)
+    if bwlimit:
+        args.append('--bwlimit=%s' % bwlimit)
+    if ':' in source:
+        # remote source, over ssh with the conf's ssh args
+        args.append('--rsh=%s %s' % (
+            SSH_COMMAND, templates.get_conf_constants(pool)['ssh_args']))
+    args.extend([source, '%s/.' % generation_dir])
+    logger.debug('running rsync %s' % ' '.join(args))
+    return sh.rsync(*args)
+
+
+def rotate_orphan(image, pool=''):
+    """ rotate an orphan's generations and leave an empty newest one, what
+        syncing it from an empty source comes to, with only renames and the
+        removal of the oldest generation
+    """
+    if not pool:
+        pool = settings.POOL
+    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+    log_rsnap(image, pool, 'rotating orphan %s' % destination)
+    rotate(destination, link_newest=False)
+    os.mkdir(get_generation_dir(destination, 0), 0o700)
+    log_rsnap(image, pool, 'completed successfully')
+
+
+def is_rotated_out(destination, interval=''):
+    """ whether destination holds only generations with no files in any of
+        them, as an orphan does once all its data has rotated off
+    """
+    if not interval:
+        interval = settings.RETAIN_INTERVAL
+    generation_re = re.compile(r'^%s\.[0-9]+$' % re.escape(interval))
+    for name in os.listdir(destination):
+        path = os.path.join(destination, name)
+        if (not generation_re.match(name) or os.path.islink(path) or
+                not os.path.isdir(path)):
+            return False
+        for dirpath, dirnames, filenames in os.walk(path):
+            if filenames:
+                return False
+            for dirname in dirnames:
+                if os.path.islink(os.path.join(dirpath, dirname)):
+                    return False
+    return True
+
+
+def get_rotated_out(images, pool=''):
+    """ the images of pool whose backup dirs have no data left
+    """
+    if not pool:
+        pool = settings.POOL
+    rotated_out = []
+    for image in images:
+        destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+        if os.path.isdir(destination) and is_rotated_out(destination):
+            rotated_out.append(image)
+    return rotated_out
+
+
+def reclaim(image, pool=''):
+    """ remove the backup dir of an image with no data left
+    """
+    if not pool:
+        pool = settings.POOL
+    shutil.rmtree('%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image))
+
+
+def replace_contents(source, generation_dir):
+    """ make generation_dir hold exactly the entries of source, moving them
+        in by rename instead of copying
+    """
+    names = os.listdir(source)
+    for name in os.listdir(generation_dir):
+        if name not in names:
+            remove_tree(os.path.join(generation_dir, name))
+    for name in names:
+        dest_path = os.path.join(generation_dir, name)
+        if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+            shutil.rmtree(dest_path)
+        os.rename(os.path.join(source, name), dest_path)
+
+
+def run_backup_script(backup_script, destination, generation_dir, env=None):
+    """ run backup_script in destination/tmp as rsnapshot does, with env
+        added to its environment, then move what it made into
+        generation_dir. returns the sh result of the script
+    """
+    temp_dir = '%s/tmp' % destination
+    remove_tree(temp_dir)
+    os.mkdir(temp_dir, 0o700)
+    try:
+        result = sh.Command(backup_script)(_cwd=temp_dir,
+                                           _env=dict(os.environ, **(env or {})))
+        replace_contents(temp_dir, generation_dir)
+    finally:
+        remove_tree(temp_dir)
+    return result
+
+
+def log_rsnap(image, pool, message):
+    """ append message to the image's rsnap log, where rsnapshot logs to
+    """
+    log_path = '%s/rsnap/%s/%s.log' % (settings.LOG_BASE_PATH, pool, image)
+    with open(log_path, 'a') as log_file:
+        log_file.write('[%s] ceph_rsnapshot: %s\n' % (
+            time.strftime('%Y-%m-%dT%H:%M:%S'), message))
+
+
+def rsnap(image, pool='', source='', backup_script='', bwlimit=0):
+    """ what rsnapshot -c <image conf> <interval> does, in process: rotate
+        the image's generations, then sync source (the temp qcow dir on the
+        ceph node by default) or the output of backup_script into the new
+        one. with REFLINK on a filesystem that supports it, the new
+        generation's files are reflink clones of the previous ones that rsync
+        updates in place. returns the stdout of rsync or the script, and
+        raises their sh.ErrorReturnCode or OSError from the rotation. the
+        transfer is limited to bwlimit KB/s if set
+    """
+    if not pool:
+        pool = settings.POOL
+    logger = logs.get_logger()
+    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+    if not source and not backup_script:
+        source = templates.get_source(image, pool=pool)
+    log_rsnap(image, pool, 'rotating %s' % destination)
+    rotate(destination)
+    generation_dir = get_generation_dir(destination, 0)
+    if not os.path.isdir(generation_dir):
+        os.mkdir(generation_dir, 0o700)
+    if backup_script:
+        logger.info('running backup script %s for image %s' % (backup_script,
+                                                               image))
+        stdout = run_backup_script(
+            backup_script, destination, generation_dir,
+            env={throttle.BWLIMIT_ENV: str(bwlimit)}).stdout
+    else:
+        inplace = False
+        if settings.REFLINK:
+            inplace = reflink.unshare_tree(generation_dir)
+            if inplace:
+                log_rsnap(image, pool, 'reflinked %s' % generation_dir)
+        stdout = sync(source, generation_dir, pool=pool, inplace=inplace,
+                      bwlimit=bwlimit).stdout
+    # rsnapshot touches the new generation so its mtime is the backup time
+    os.utime(generation_dir, None)
+    log_rsnap(image, pool, 'completed successfully')
+    return stdout
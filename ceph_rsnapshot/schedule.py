@@ -0,0 +1,134 @@
+# order a pool's images longest job first, from their past backup times and
+# rbd sizes, so the biggest start early and the small ones fill the gaps
+import heapq
+import os
+import time
+
+from ceph_rsnapshot import logs
+from ceph_rsnapshot import settings
+from ceph_rsnapshot import ceph
+from ceph_rsnapshot import history
+
+
+SCHEDULES = ['source', 'longest_first']
+
+
+def get_past_seconds(pool='', runs=None, cephhost=''):
+    """ mean seconds of each image of pool on cephhost over its backups in
+        the last runs runs of cephhost, and the pool's mean bytes per second
+        over them (None if unknown), from the history database if there is
+        one
+    """
+    if not pool:
+        pool = settings.POOL
+    if not cephhost:
+        cephhost = settings.CEPH_HOST
+    if runs is None:
+        runs = settings.SCHEDULE_HISTORY_RUNS
+    history_db = history.get_history_db()
+    if not os.path.isfile(history_db):
+        return {}, None
+    conn = history.connect(history_db)
+    try:
+        image_history = history.get_image_history(conn, runs,
+                                                  cephhost=cephhost)
+    finally:
+        conn.close()
+    seconds = {}
+    throughputs = []
+    for (row_cephhost, row_pool, image), rows in image_history.items():
+        if row_pool != pool:
+            continue
+        seconds[image] = history.mean([row['total_seconds'] for row in rows])
+        throughputs.extend([throughput for throughput in
+                            [history.get_throughput(row) for row in rows]
+                            if throughput])
+    if not throughputs:
+        return seconds, None
+    return seconds, history.mean(throughputs)
+
+
+def get_used_sizes(images, pool=''):
+    """ rbd used size of each image, None where it can't be had
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    used_sizes = {}
+    for image in images:
+        try:
+            used_sizes[image] = ceph.get_rbd_sizes(image,
+                                                   pool=pool)['used_size']
+        except Exception as e:
+            logger.warning('cannot get used size of %s to schedule it: %s' %
+                           (image, e))
+            used_sizes[image] = None
+    return used_sizes
+
+
+def estimate_seconds(images, pool=''):
+    """ predicted seconds of each image: its mean from the history, else its
+        used size at the pool's mean throughput, else None
+    """
+    if not pool:
+        pool = settings.POOL
+    past_seconds, throughput = get_past_seconds(pool)
+    used_sizes = get_used_sizes(images, pool=pool)
+    estimates = {}
+    for image in images:
+        if image in past_seconds:
+            estimates[image] = past_seconds[image]
+        elif throughput and used_sizes[image] is not None:
+            estimates[image] = used_sizes[image] / throughput
+        else:
+            estimates[image] = None
+    return estimates, used_sizes
+
+
+def predict_seconds(seconds, num_workers):
+    """ how long jobs of seconds take, started in that order on num_workers
+        workers each taking the next job as it frees up
+    """
+    workers = [0.0] * max(min(num_workers, len(seconds)), 1)
+    for job_seconds in seconds:
+        heapq.heappush(workers, heapq.heappop(workers) + job_seconds)
+    return max(workers)
+
+
+def order_images(images, pool='', num_workers=None):
+    """ images longest predicted first, by used size where none has a
+        prediction, logging the order and when the pool should be done.
+        returns the ordered images
+    """
+    logger = logs.get_logger()
+    if not pool:
+        pool = settings.POOL
+    if num_workers is None:
+        num_workers = settings.NUM_WORKERS
+    estimates, used_sizes = estimate_seconds(images, pool=pool)
+    predicted = [image for image in images if estimates[image] is not None]
+    if predicted:
+        ordered = sorted(images, key=lambda image: (
+            -(estimates[image] or 0), -(used_sizes[image] or 0), image))
+    else:
+        ordered = sorted(images, key=lambda image: (
+            -(used_sizes[image] or 0), image))
+    logger.info('scheduling %s images in pool %s longest first: %s' % (
+        len(ordered), pool, ', '.join([
+            '%s (%s)' % (image, '%.0fs' % estimates[image] if
+                         estimates[image] is not None else
+                         '%s bytes' % used_sizes[image])
+            for image in ordered])))
+    if predicted:
+        seconds = predict_seconds([estimates[image] or 0.0 for image in
+                                   ordered], num_workers)
+        logger.info('pool %s predicted to be done in %.0fs, at %s%s' % (
+            pool, seconds, time.strftime('%Y-%m-%d %H:%M:%S',
+                                         time.localtime(time.time() +
+                                                        seconds)),
+            '' if len(predicted) == len(images) else
+            ', not counting %s images with no history' %
+            (len(images) - len(predicted))))
+    else:
+        logger.info('no history to predict when pool %s will be done' % pool)
+    return ordered
@@ -25,6 +25,9 @@ ADDITIONAL_SAFE_CHARS = dict(
     SNAP_NAMING_DATE_FORMAT='%',
     SNAP_DATE=" ",
     EXTRA_ARGS=" ",
+    COMPRESSION_POOLS=":,",
+    BWLIMIT_WINDOWS=",",
+    CLUSTER_CONFIGS=",",
 )
 
 
@@ -42,10 +45,34 @@ SETTINGS = dict(
 
     # path on the ceph node to use for the temporary export of qcows
     # if it does not exist, the script will create it and intervening dirs
-    # also this script will create subdirectories for each pool
-    # and will chmod those pool directories 700
+    # also this script will create subdirectories for each pool and each
+    # image in it, and will chmod those directories 700
     QCOW_TEMP_PATH='/tmp/qcows',
 
+    # how to get each image into its backup generation:
+    # qcow - export a temp qcow to QCOW_TEMP_PATH on the ceph node and have
+    #   rsnapshot pull it over ssh
+    # stream - have rsnapshot run a script that streams rbd export over ssh
+    #   straight into the new generation, nothing is written on the ceph node
+    EXPORT_MODE='qcow',
+    # file format of streamed exports in the generation, qcow2 (converted on
+    # this node, needs qemu-img here) or raw (sparse)
+    STREAM_FORMAT='qcow2',
+    # with stream exports in raw format, transfer only the rbd export-diff
+    # since the snap in the newest generation and apply it to a copy of that
+    # generation's raw file
+    INCREMENTAL=False,
+    # do a full export instead once an image has this many generations since
+    # its last full export
+    FULL_EXPORT_EVERY=7,
+
+    # number of images to export and rsnap at once within a pool
+    NUM_WORKERS=1,
+
+    # with one worker, export the next image while the previous one is being
+    # rsnapped, so at most two qcows are on the ceph node at once
+    PIPELINE_EXPORTS=False,
+
     # prefix for temp dir to store temporary rsnapshot conf files
     TEMP_CONF_DIR_PREFIX='ceph_rsnapshot_temp_conf_',
 
@@ -118,11 +145,148 @@ SETTINGS = dict(
     USE_SNAP_STATUS_FILE=False,
     SNAP_STATUS_FILE_PATH="/var/spool/ceph-snapshot",
 
+    # discover all images, snaps and sizes in a pool with one rbd ls -l call
+    # instead of an rbd info per image
+    BATCH_DISCOVERY=True,
+    # get provisioned and used sizes of all images in a pool with one rbd du
+    # call instead of an rbd du per image
+    POOL_SIZE_INVENTORY=True,
+
     # min free bytes to leave on ceph node for exporting qcow temporarily
     MIN_FREESPACE=5 * 1024 * 1024 * 1024,  # 5GB
+    # free space on the ceph node is sampled once and then tracked by
+    # reserving each in flight export's size, re-sampling this often. exports
+    # waiting for space give up once only reservations older than this are
+    # left
+    FREESPACE_RESAMPLE_SECONDS=300,
+
+    # how to reach ceph: ssh - run rbd and qemu-img on CEPH_HOST over ssh,
+    # fake - a synthetic local ceph node for benchmarking without a cluster
+    CEPH_BACKEND='ssh',
+    # the fake backend's pools each have FAKE_IMAGE_COUNT images of
+    # FAKE_IMAGE_SIZE bytes, kept under FAKE_BACKEND_PATH on this node, and
+    # every call to it takes an extra FAKE_LATENCY_MS milliseconds
+    FAKE_BACKEND_PATH='/tmp/ceph_rsnapshot_fake',
+    FAKE_IMAGE_COUNT=10,
+    FAKE_IMAGE_SIZE=64 * 1024 * 1024,  # 64MB
+    FAKE_LATENCY_MS=0,
+
+    # node_exporter textfile collector file to write per pool and phase
+    # timings, bytes and image counts to at the end of each run, for example
+    # /var/lib/node_exporter/textfile_collector/ceph_rsnapshot.prom
+    # empty to not write one
+    METRICS_TEXTFILE='',
+
+    # append every run and per image sizes, phase times, bytes and outcome to
+    # a local sqlite database, HISTORY_DB or if empty
+    # LOG_BASE_PATH/ceph_rsnapshot_history.sqlite
+    RECORD_HISTORY=True,
+    HISTORY_DB='',
+
+    # order each pool's images are backed up in:
+    # longest_first - slowest first by their mean time over the last
+    #   SCHEDULE_HISTORY_RUNS runs in the history database, else by rbd used
+    #   size, so big images start early and small ones fill in around them
+    # source - the order rbd ls lists them in
+    SCHEDULE='longest_first',
+    SCHEDULE_HISTORY_RUNS=7,
+
+    # how each image's generations are rotated and synced:
+    # rsnapshot - run rsnapshot with the image's conf
+    # native - rotate interval.NN in process the way rsnapshot does (rename,
+    #   and hardlink interval.0 to interval.1) and run only rsync, or the
+    #   stream script. the generation layout is the same either way
+    ROTATION_ENGINE='rsnapshot',
+
+    # number of orphans to rotate at once within a pool. orphans are rotated
+    # with renames only, no rsnapshot or rsync
+    ORPHAN_WORKERS=8,
+
+    # remove the backup dirs of orphans with no data left in any generation
+    # instead of rotating them forever
+    RECLAIM_ORPHANS=True,
+
+    # keep a catalog of the generations and files of every image on this
+    # node up to date after each image, in CATALOG_DB or if empty
+    # LOG_BASE_PATH/ceph_rsnapshot_catalog.sqlite. new files are checksummed
+    # with CATALOG_CHECKSUM (md5, sha1, sha256 or sha512), empty for none.
+    # checksumming reads every new export again in full after it is written
+    CATALOG=True,
+    CATALOG_DB='',
+    CATALOG_CHECKSUM='',
+
+    # write only the changed blocks of each export into its new generation
+    # file, a reflink clone of the previous generation's file, comparing
+    # DELTA_BLOCK_SIZE blocks by sha256 (kept next to each file in a .blocks
+    # file). needs STREAM_FORMAT raw in stream export mode, ROTATION_ENGINE
+    # native, and BACKUP_BASE_PATH on a filesystem that supports reflinks
+    DELTA_SYNC=False,
+    DELTA_BLOCK_SIZE=4 * 1024 * 1024,  # 4MB
+
+    # keep the exports in a content defined chunk store shared by all images
+    # and generations, at CHUNK_STORE_PATH or if empty .chunk_store in
+    # BACKUP_BASE_PATH, leaving a .manifest in place of each export. chunks
+    # average CHUNK_AVG_SIZE bytes, and those no generation refers to any
+    # more are removed at the end of each run. not with INCREMENTAL or
+    # DELTA_SYNC, as they need the previous export file
+    CHUNK_STORE=False,
+    CHUNK_STORE_PATH='',
+    CHUNK_AVG_SIZE=1024 * 1024,  # 1MB
+
+    # with ROTATION_ENGINE native, make the new generation's files reflink
+    # clones of the previous generation's and rsync only the changed ranges
+    # into them in place, so generations share unchanged extents, when
+    # BACKUP_BASE_PATH is on a filesystem that supports reflinks (btrfs, xfs).
+    # hardlinked as before on other filesystems
+    REFLINK=True,
+
+    # compress exports on the ceph node, trading its cpu for network and
+    # disk. qcow2 writes compressed qcow2 clusters (zlib, or zstd with
+    # method zstd) in qcow export mode, and in stream export mode with
+    # STREAM_FORMAT qcow2 converts to them on this node. zstd compresses the
+    # stream over the wire in stream export mode. COMPRESSION_LEVEL is the
+    # zstd level (qemu-img has none), COMPRESSION_THREADS the zstd threads or
+    # qemu-img coroutines. COMPRESSION_POOLS overrides them per pool, comma
+    # separated pool:method[:level[:threads]]. empty for no compression
+    COMPRESSION='',
+    COMPRESSION_LEVEL=3,
+    COMPRESSION_THREADS=4,
+    COMPRESSION_POOLS='',
+
+    # limit in KB/s of reading exports from ceph (qemu-img) and of
+    # transferring them to this node (rsync), for all of a pool's workers
+    # together, 0 for none. stream exports are held to the lower of the two.
+    # BWLIMIT_WINDOWS overrides them for times of day, comma separated
+    # [pool/]HHMM-HHMM/EXPORT_KBPS/TRANSFER_KBPS in local time, the first
+    # window for the pool that covers the time winning over those for all
+    # pools
+    EXPORT_BWLIMIT=0,
+    TRANSFER_BWLIMIT=0,
+    BWLIMIT_WINDOWS='',
+
+    # comma separated config files of ceph clusters (or hosts) to back up at
+    # once, each in its own run of ceph_rsnapshot with that config. give
+    # each its own BACKUP_BASE_PATH and LOG_BASE_PATH. empty to back up
+    # just CEPH_HOST with this config
+    CLUSTER_CONFIGS='',
+    # how many of CLUSTER_CONFIGS to run at once, 0 for all of them
+    CLUSTER_WORKERS=0,
+    # dir for the lock files each run takes per pool on the ceph node, per
+    # pool backup dir and on the chunk store
+    LOCK_PATH='/var/run/ceph_rsnapshot',
+    # seconds to wait for another run to release a pool before skipping it
+    LOCK_TIMEOUT=0,
 
     # enable for extra logging for sh calls
     SH_LOGGING=False,
+
+    # multiplex all ssh commands to a ceph host over one persistent master
+    # connection instead of doing a full ssh handshake for every command
+    SSH_MULTIPLEX=True,
+    # directory on this node for the ssh control sockets, made 700 if missing
+    SSH_CONTROL_DIR='/tmp/ceph_rsnapshot_ssh',
+    # seconds an idle master connection stays open (ssh ControlPersist)
+    SSH_CONTROL_PERSIST=600,
 )
 
 
@@ -140,6 +304,15 @@ def setup_stdout_logger(level=logging.INFO):
 
 
 def load_settings(config_file=''):
+    settings = read_settings(config_file)
+    globals().update(settings)
+    return settings
+
+
+def read_settings(config_file=''):
+    """ the settings of config_file, or of the first config file found in
+        DEFAULT_CONFIG_HIERARCHY, over the defaults, without loading them
+    """
     logger = setup_stdout_logger()
     if config_file == '':
         for conf_file in DEFAULT_CONFIG_HIERARCHY:
@@ -168,5 +341,4 @@ def load_settings(config_file=''):
         logger.debug('no config file found - using default settings')
     if settings['TEMP_CONF_DIR'] and not user_did_provide_keepconf:
         settings['KEEPCONF'] = True
-    globals().update(settings)
     return settings
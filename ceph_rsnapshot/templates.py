@@ -1,80 +1,297 @@
-from ceph_rsnapshot import settings, logs, dirs, ceph
+from ceph_rsnapshot import settings, logs, dirs, ceph, connections
+from ceph_rsnapshot import backends
+from ceph_rsnapshot import incremental
+from ceph_rsnapshot import compression
+from ceph_rsnapshot import throttle
+import hashlib
 import tempfile
+import threading
 import sys
 import os
 
 import jinja2
 
 
-def get_template():
-    logger = logs.get_logger()
-    env = jinja2.Environment(loader=jinja2.PackageLoader('ceph_rsnapshot'))
-    template = env.get_template('rsnapshot.template')
-    return template
+# compiled templates by name, the per run constants of each pool's confs,
+# and the source, backup_script and bwlimit of each conf written this run by
+# path so retries reuse it. guarded by _lock since image workers write confs
+_lock = threading.Lock()
+_templates = {}
+_conf_constants = {}
+_written_confs = {}
 
 
-def write_conf(image, pool='', source='', template='',
-               snap_naming_date_format='', snap_date='', snap=''):
-    if not snap_naming_date_format:
-        snap_naming_date_format = settings.SNAP_NAMING_DATE_FORMAT
-    if not snap_date:
-        snap_date = settings.SNAP_DATE
-    if not snap:
-        snap = ceph.get_snapdate(snap_naming_date_format=snap_naming_date_format,
-                            snap_date=snap_date)
+def get_template(name='rsnapshot.template'):
+    """ the compiled template, loaded once per run
+    """
+    with _lock:
+        if name not in _templates:
+            env = jinja2.Environment(
+                loader=jinja2.PackageLoader('ceph_rsnapshot'))
+            _templates[name] = env.get_template(name)
+        return _templates[name]
+
+
+def get_conf_path(image, pool=''):
+    """ conf file of the form /tmp_conf_dir/pool/imagename.conf
+    """
+    if not pool:
+        pool = settings.POOL
+    return '%s/%s/%s.conf' % (settings.TEMP_CONF_DIR, pool, image)
+
+
+def get_stream_script_path(image, pool=''):
+    if not pool:
+        pool = settings.POOL
+    return '%s/%s/%s.sh' % (settings.TEMP_CONF_DIR, pool, image)
+
+
+def get_conf_constants(pool=''):
+    """ template values that are the same for every conf of the pool, worked
+        out once per run
+    """
     if not pool:
         pool = settings.POOL
     host = settings.CEPH_HOST
-    temp_path = settings.QCOW_TEMP_PATH
-    backup_base_path = settings.BACKUP_BASE_PATH
+    key = (pool, host, settings.TEMP_CONF_DIR)
+    with _lock:
+        if key not in _conf_constants:
+            _conf_constants[key] = dict(
+                pool=pool,
+                retain_interval=settings.RETAIN_INTERVAL,
+                retain_number=settings.RETAIN_NUMBER,
+                log_base_path=settings.LOG_BASE_PATH,
+                subdir='.',
+                extra_args=settings.EXTRA_ARGS,
+                ssh_args=' '.join(connections.get_ssh_options(host)))
+        return _conf_constants[key]
 
-    # get logger we setup earlier
-    logger = logs.get_logger()
 
-    # only reopen template if we don't have it - ie, are we part of a pool run
+def get_source(image, pool=''):
+    """ rsync source of the image's temp qcow dir on the ceph node
+    """
+    if not pool:
+        pool = settings.POOL
+    return backends.get_backend().get_rsync_source(
+        settings.CEPH_HOST, dirs.get_qcow_temp_path(pool=pool, image=image))
+
+
+def render_conf(image, pool='', source='', template='', backup_script='',
+                bwlimit=0):
+    """ the rsnap conf for image. source defaults to the image's temp qcow
+        dir on the ceph node, and backup_script replaces source if given.
+        rsync is limited to bwlimit KB/s if set
+    """
+    if not pool:
+        pool = settings.POOL
     if not template:
         template = get_template()
-
     # create source path string if an override wasn't passed to us
-    # note using the . to tell rsnap where to start the relative dir
     if source == '':
-        source = 'root@%s:%s/%s/.' % (
-            settings.CEPH_HOST, settings.QCOW_TEMP_PATH, pool)
+        source = get_source(image, pool=pool)
+    if backup_script:
+        source = backup_script
+    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH, pool, image)
+    return template.render(
+        nickname=image,
+        source=source,
+        destination=destination,
+        # clusters backed up at once can have pools and images of the same
+        # name, so tell their rsnapshot lockfiles apart by destination
+        destination_hash=hashlib.sha1(
+            destination.encode('utf-8')).hexdigest()[:16],
+        backup_script=backup_script,
+        bwlimit=bwlimit,
+        **get_conf_constants(pool))
 
-    destination = '%s/%s/%s' % (settings.BACKUP_BASE_PATH,
-                                settings.POOL, image)
 
-    logger.info('writing conf for image %s to rsnap from %s to %s' %
-                (image, source, destination))
+def write_conf_file(conf_path, contents, mode=0o600):
+    """ write contents to conf_path atomically, with a temp file in the same
+        dir renamed over it, with mode
+    """
+    fd, temp_path = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(conf_path),
+        dir=os.path.dirname(conf_path))
+    try:
+        with os.fdopen(fd, 'w') as conf_file:
+            conf_file.write(contents)
+        os.chmod(temp_path, mode)
+        os.rename(temp_path, conf_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
-    my_template = template.render(nickname=image,
-                                  pool=pool,
-                                  source=source,
-                                  destination=destination,
-                                  retain_interval=settings.RETAIN_INTERVAL,
-                                  retain_number=settings.RETAIN_NUMBER,
-                                  log_base_path=settings.LOG_BASE_PATH,
-                                  subdir='.',
-                                  extra_args=settings.EXTRA_ARGS)
+
+def write_conf(image, pool='', source='', template='', backup_script='',
+               bwlimit=None):
+    """ write the rsnap conf for image, unless the same one was already
+        written this run by write_confs or an earlier try. rsync is limited
+        to bwlimit KB/s, by default the pool's transfer rate now unless
+        running backup_script. returns the conf path
+    """
+    if not pool:
+        pool = settings.POOL
+    if bwlimit is None:
+        bwlimit = 0
+        if not backup_script:
+            bwlimit = throttle.get_rate('transfer', pool)
+    # get logger we setup earlier
+    logger = logs.get_logger()
+    conf_path = get_conf_path(image, pool=pool)
+    with _lock:
+        written = _written_confs.get(conf_path)
+    if written == (source, backup_script, bwlimit) and \
+            os.path.isfile(conf_path):
+        logger.debug('reusing conf for image %s' % image)
+        return conf_path
+    my_template = render_conf(image, pool=pool, source=source,
+                              template=template, backup_script=backup_script,
+                              bwlimit=bwlimit)
+    logger.info('writing conf for image %s to rsnap from %s to %s/%s/%s' %
+                (image, backup_script or source or 'the ceph node',
+                 settings.BACKUP_BASE_PATH, pool, image))
 
     if settings.NOOP:
-        logger.info('NOOP: would have written conf file to %s/%s/%s.conf' %
-                    (settings.TEMP_CONF_DIR, pool, image))
+        logger.info('NOOP: would have written conf file to %s' % conf_path)
         logger.info('NOOP: conf file contents would have been: \n%s' %
                     my_template)
         # fake conf file name to return
-        return '%s/%s/%s.conf' % (settings.TEMP_CONF_DIR, pool, image)
+        return conf_path
+    try:
+        write_conf_file(conf_path, my_template)
+    except Exception as e:
+        logger.error('error with temp conf file for image: %s error: %s' %
+            (image, e))
+        raise
+    with _lock:
+        _written_confs[conf_path] = (source, backup_script, bwlimit)
+    return conf_path
+
+
+def write_confs(images, pool='', source='', template=''):
+    """ write the rsnap confs for all images of a pool in one pass, so the
+        image workers only have to reuse them. in stream export mode the
+        confs run each image's stream script, unless source is given.
+        returns the conf paths by image
+    """
+    if not pool:
+        pool = settings.POOL
+    logger = logs.get_logger()
+    if not template:
+        template = get_template()
+    logger.info('writing confs for %s images in pool %s' % (len(images),
+                                                           pool))
+    conf_paths = {}
+    for image in images:
+        backup_script = ''
+        if settings.EXPORT_MODE == 'stream' and not source:
+            backup_script = get_stream_script_path(image, pool=pool)
+        conf_paths[image] = write_conf(image, pool=pool, source=source,
+                                       template=template,
+                                       backup_script=backup_script)
+    return conf_paths
+
+
+def write_stream_script(image, pool='', template='',
+                        snap_naming_date_format='', snap_date='', snap=''):
+    """ write the rsnapshot backup_script that streams this image@snap from
+        the ceph node into the new generation, without a temp qcow on the
+        ceph node. returns the script path
+    """
+    if not snap_naming_date_format:
+        snap_naming_date_format = settings.SNAP_NAMING_DATE_FORMAT
+    if not snap_date:
+        snap_date = settings.SNAP_DATE
+    if not snap:
+        snap = ceph.get_snapdate(snap_naming_date_format=snap_naming_date_format,
+                            snap_date=snap_date)
+    if not pool:
+        pool = settings.POOL
+    host = settings.CEPH_HOST
+    logger = logs.get_logger()
+    if not template:
+        template = get_template('stream.template')
+    script_path = get_stream_script_path(image, pool=pool)
+    from_snap, chain = incremental.choose_from_snap(image, snap, pool=pool)
+    if from_snap:
+        export_command = ceph.get_export_diff_stream_command(
+            image, from_snap, snap=snap, pool=pool)
+        # rsnapshot rotates before running backup scripts, so the newest
+        # generation from before this run is generation 1
+        previous_raw_file = '%s/%s@%s.raw' % (
+            incremental.get_generation_path(image, generation=1, pool=pool),
+            image, from_snap)
     else:
-        # conf file of the form /tmp_conf_dir/pool/imagename.conf
-        try:
-            conf_file = open('%s/%s/%s.conf' %
-                         (settings.TEMP_CONF_DIR, pool, image), 'w')
-            conf_file.write(my_template)
-        except Exception as e:
-            logger.error('error with temp conf file for orphan: %s error: %s' %
-                (image, e))
-            raise
-    return conf_file.name
+        export_command = ceph.get_export_stream_command(image, snap=snap,
+                                                        pool=pool)
+        previous_raw_file = ''
+        if settings.DELTA_SYNC and settings.STREAM_FORMAT == 'raw':
+            # delta sync the full export against the previous one
+            previous_snap, previous_chain = incremental.get_previous_export(
+                image, pool=pool)
+            if previous_snap:
+                previous_raw_file = '%s/%s@%s.raw' % (
+                    incremental.get_generation_path(image, generation=1,
+                                                    pool=pool),
+                    image, previous_snap)
+    export_command = compression.get_compressed_stream_command(export_command,
+                                                               pool=pool)
+    compression_file = '%s@%s%s' % (image, snap, compression.STATS_SUFFIX)
+    receive = ''
+    compress, decompress = compression.get_stream_commands(pool)
+    if decompress:
+        receive = ' 2>%s' % compression_file
+    if throttle.is_configured(pool):
+        # the limit of each run is passed in its environment
+        receive += ' | %s -m ceph_rsnapshot.throttle ${%s:-0}' % (
+            sys.executable, throttle.BWLIMIT_ENV)
+    if decompress:
+        receive += ' | %s' % decompress
+    raw_file = '%s@%s.raw' % (image, snap)
+    qcow_file = '%s@%s.qcow2' % (image, snap)
+    convert_command = '/usr/bin/qemu-img convert -f raw -O qcow2 %s %s' % (
+        raw_file, qcow_file)
+    if compression.get_compression(pool)[0] == 'qcow2':
+        # compressed clusters, converting on this node
+        convert_command = '{ %s; } 2>>%s' % (compression.get_timed_command(
+            '%s %s' % (convert_command, compression.get_qemu_img_args(pool))),
+            compression_file)
+    my_template = template.render(
+        image=image,
+        pool=pool,
+        snap=snap,
+        remote_shell=backends.get_backend().get_remote_shell(host),
+        export_command=export_command,
+        from_snap=from_snap,
+        previous_raw_file=previous_raw_file,
+        python=sys.executable,
+        delta_sync=settings.DELTA_SYNC,
+        delta_block_size=settings.DELTA_BLOCK_SIZE,
+        chain=chain,
+        chain_file='%s@%s.chain' % (image, snap),
+        raw_file=raw_file,
+        qcow_file=qcow_file,
+        receive=receive,
+        compressed=bool(decompress),
+        compression_file=compression_file,
+        convert_command=convert_command,
+        stream_format=settings.STREAM_FORMAT)
+    logger.info('writing stream script for image %s to %s' % (image,
+                                                              script_path))
+    if settings.NOOP:
+        logger.info('NOOP: would have written stream script to %s' %
+                    script_path)
+        logger.info('NOOP: stream script contents would have been: \n%s' %
+                    my_template)
+        return script_path
+    try:
+        write_conf_file(script_path, my_template, mode=0o700)
+    except Exception as e:
+        logger.error('error with stream script for image: %s error: %s' %
+            (image, e))
+        raise
+    return script_path
 
 # note using mkdtemp to make a tmep dir for these so not using mkstemp
 # mkstemp
@@ -86,10 +303,15 @@ def remove_conf(image, pool=''):
         pool = settings.POOL
     # get logger we setup earlier
     logger = logs.get_logger()
+    conf_path = get_conf_path(image, pool=pool)
     if settings.NOOP:
-        logger.info('NOOP: would have removed conf file %s/%s/%s.conf' %
-                    (settings.TEMP_CONF_DIR, pool, image))
+        logger.info('NOOP: would have removed conf file %s' % conf_path)
     else:
         logger.info('removing temp rsnap conf file for image %s' % image)
-        os.remove('%s/%s/%s.conf' % (settings.TEMP_CONF_DIR, pool, image))
+        with _lock:
+            _written_confs.pop(conf_path, None)
+        os.remove(conf_path)
         # FIXME raise error if error
+        script_path = get_stream_script_path(image, pool=pool)
+        if os.path.isfile(script_path):
+            os.remove(script_path)
@@ -0,0 +1,175 @@
+# bandwidth limits on reading exports from ceph and transferring them to
+# this node, per pool and time of day window, split between the image workers
+import sys
+import threading
+import time
+
+from ceph_rsnapshot import settings
+
+
+# the stream scripts read their limit in KB/s from this, set per run of them
+BWLIMIT_ENV = 'CEPH_RSNAPSHOT_BWLIMIT'
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class TokenBucket(object):
+    """ rate bytes per second, bursting up to a second's worth. consume
+        sleeps while the bucket is in debt
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledReader(object):
+    """ file like reader of stream at no more than kbps KB/s, or as fast as
+        it comes if kbps is 0
+    """
+
+    def __init__(self, stream, kbps):
+        self.stream = stream
+        self.bucket = None
+        if kbps:
+            self.bucket = TokenBucket(kbps * 1024)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.bucket and data:
+            self.bucket.consume(len(data))
+        return data
+
+
+def parse_time(value):
+    """ minutes into the day of HHMM, 2400 being the end of it
+    """
+    if len(value) != 4 or not value.isdigit() or int(value[:2]) > 24 or \
+            int(value[2:]) > 59 or (value[:2] == '24' and value[2:] != '00'):
+        raise NameError('%s is not a HHMM time' % value)
+    return int(value[:2]) * 60 + int(value[2:])
+
+
+def parse_windows(value=None):
+    """ the windows in BWLIMIT_WINDOWS, comma separated
+        [pool/]HHMM-HHMM/EXPORT_KBPS/TRANSFER_KBPS, as (pool or None, start
+        minute, end minute, export KB/s, transfer KB/s). raises NameError if
+        one is malformed
+    """
+    if value is None:
+        value = settings.BWLIMIT_WINDOWS
+    windows = []
+    for entry in [entry for entry in value.split(',') if entry]:
+        fields = entry.split('/')
+        pool = None
+        if len(fields) == 4:
+            pool = fields.pop(0)
+        if len(fields) != 3 or fields[0].count('-') != 1:
+            raise NameError('bwlimit_windows entry %s is not'
+                            ' [pool/]HHMM-HHMM/EXPORT_KBPS/TRANSFER_KBPS' %
+                            entry)
+        start, end = fields[0].split('-')
+        try:
+            export_kbps, transfer_kbps = int(fields[1]), int(fields[2])
+        except ValueError:
+            raise NameError('bwlimit_windows entry %s has a limit that is not'
+                            ' a number' % entry)
+        windows.append((pool, parse_time(start), parse_time(end), export_kbps,
+                        transfer_kbps))
+    return windows
+
+
+def in_window(start, end, minute):
+    """ whether minute is in start to end, which may wrap past midnight
+    """
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def get_limits(pool='', now=None):
+    """ (export, transfer) KB/s for all of pool's workers at now: from the
+        first window for pool covering now, else the first window for all
+        pools, else EXPORT_BWLIMIT and TRANSFER_BWLIMIT. 0 is no limit
+    """
+    if not pool:
+        pool = settings.POOL
+    if now is None:
+        now = time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+    windows = parse_windows()
+    for window_pool in [pool, None]:
+        for (for_pool, start, end, export_kbps, transfer_kbps) in windows:
+            if for_pool == window_pool and in_window(start, end, minute):
+                return export_kbps, transfer_kbps
+    return settings.EXPORT_BWLIMIT, settings.TRANSFER_BWLIMIT
+
+
+def get_rate(kind, pool='', now=None):
+    """ KB/s for one export or transfer (kind) of pool, its share of the
+        pool's limit between the NUM_WORKERS that may run at once
+    """
+    export_kbps, transfer_kbps = get_limits(pool, now=now)
+    kbps = export_kbps if kind == 'export' else transfer_kbps
+    if not kbps:
+        return 0
+    return max(kbps // max(settings.NUM_WORKERS, 1), 1)
+
+
+def get_stream_rate(pool='', now=None):
+    """ KB/s for one stream export, which reads from ceph and transfers at
+        once, so is held to the lower of the two
+    """
+    rates = [rate for rate in [get_rate('export', pool, now=now),
+                               get_rate('transfer', pool, now=now)] if rate]
+    if not rates:
+        return 0
+    return min(rates)
+
+
+def is_configured(pool=''):
+    """ whether pool has any limit at any time of day
+    """
+    if not pool:
+        pool = settings.POOL
+    if settings.EXPORT_BWLIMIT or settings.TRANSFER_BWLIMIT:
+        return True
+    return any(window[0] in [pool, None] for window in parse_windows())
+
+
+def main():
+    """ copy stdin to stdout at no more than the KB/s given as the only
+        argument, for the stream scripts
+    """
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: %s <KB/s>\n' % sys.argv[0])
+        sys.exit(2)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    reader = ThrottledReader(stdin, int(sys.argv[1] or 0))
+    try:
+        while True:
+            data = reader.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            stdout.write(data)
+        stdout.flush()
+    except (IOError, OSError) as e:
+        sys.stderr.write('error throttling stream: %s\n' % e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
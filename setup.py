@@ -102,6 +102,10 @@ setup(
     entry_points={
         'console_scripts': [
             'ceph_rsnapshot = ceph_rsnapshot.cli:ceph_rsnapshot',
+            'ceph_rsnapshot_history = ceph_rsnapshot.cli:ceph_rsnapshot_history',
+            'ceph_rsnapshot_reclaim = ceph_rsnapshot.cli:ceph_rsnapshot_reclaim',
+            'ceph_rsnapshot_catalog = ceph_rsnapshot.cli:ceph_rsnapshot_catalog',
+            'ceph_rsnapshot_chunks = ceph_rsnapshot.cli:ceph_rsnapshot_chunks',
         ],
     },
 )